@@ -0,0 +1,444 @@
+"""
+This module contains AppointmentColumns, an in-memory, columnar copy of the
+appointments database for reporting. The appointments are held in NumPy
+arrays with one element per appointment, and the names of the doctors,
+symptoms, months and genders are dictionary-encoded as small integers, so
+that counts grouped by any of them are computed by vectorised operations
+instead of by SQLite row by row.
+
+It requires NumPy ('pip install numpy').
+
+Written by Minhwa (Mina) Lee
+"""
+
+import threading
+
+try:
+    import numpy as np
+except ImportError as error:
+    raise ImportError('app_analytics requires NumPy '
+                      '(pip install numpy)') from error
+
+from app_db import APP_FILTERS, STAT_DIMENSIONS
+from app_migrations import month_number
+
+# The tables copied, in the order their data versions are compared.
+TABLES = ('app', 'patients', 'doctors', 'symptoms')
+
+# The primary key of each table.
+_KEYS = {'app': 'app_id', 'patients': 'patient_id', 'doctors': 'doctor_id',
+         'symptoms': 'symptom_id'}
+
+# Number of rows fetched from SQLite at a time while loading.
+LOAD_BATCH = 100000
+
+# Age of the patients whose age is missing or not a number.
+_NO_AGE = -1
+
+# Time of the appointments that have no scheduled_at, which no range of
+# times includes.
+_NO_TIME = np.iinfo(np.int64).min
+
+
+def _sort_key(label, name=None):
+    # SQL sorts NULL first, and get_app_stats months in calendar order.
+    if name == 'month':
+        return month_number(label) or 13, label is not None, label
+
+    return label is not None, label
+
+
+class Dictionary:
+    """
+    Encodes strings as consecutive integer codes, in order of first use.
+    """
+
+    def __init__(self):
+        self.labels = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def encode(self, values):
+        """
+        :param values: iterable of strings, or None
+        :return: NumPy array of the codes of values
+        """
+        values = list(values)
+
+        for value in set(values).difference(self.codes):
+            self.codes[value] = len(self.labels)
+            self.labels.append(value)
+
+        return np.fromiter(map(self.codes.__getitem__, values), np.int32,
+                           len(values))
+
+
+class AppointmentColumns:
+    """
+    A columnar copy of the app, patients, doctors and symptoms tables.
+
+    Each appointment is an element of the arrays app_id, patient_id,
+    doctor_id, symptom_id, month (a code of self.months), scheduled_at, and
+    age and
+    gender (a code of self.genders) of its patient. The ages and genders of
+    the patients, and the names of the doctors and symptoms, are also held
+    in arrays indexed by their primary key.
+
+    refresh() brings the copy up to date by loading the rows whose primary
+    key is above the highest one already loaded. If rows were deleted, which
+    it finds out from the number of rows and the highest primary key of
+    each table, it loads everything again. The names of the doctors and
+    symptoms are few, so they are all loaded again whenever their table
+    changes, since SQLite gives the primary key of a deleted last row to
+    the next row inserted.
+
+    get_app_stats() takes the same arguments and returns the same counts
+    as AppointmentDatabase.get_app_stats, so it can answer /stats.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.versions = None
+
+        self.app_id = np.zeros(0, np.int64)
+        self.patient_id = np.zeros(0, np.int32)
+        self.doctor_id = np.zeros(0, np.int32)
+        self.symptom_id = np.zeros(0, np.int32)
+        self.month = np.zeros(0, np.int32)
+        self.months = Dictionary()
+        self.scheduled_at = np.zeros(0, np.int64)
+        # The age and gender code of the patient of each appointment.
+        self.age = np.zeros(0, np.int16)
+        self.gender = np.zeros(0, np.int32)
+
+        self.patient_age = np.zeros(0, np.int16)
+        self.patient_gender = np.zeros(0, np.int32)
+        self.genders = Dictionary()
+
+        # The highest primary key and the number of rows loaded from each
+        # table.
+        self.high_water = dict.fromkeys(TABLES, 0)
+        self.row_counts = dict.fromkeys(TABLES, 0)
+
+        self._clear_names('doctors')
+        self._clear_names('symptoms')
+
+    def _clear_names(self, table):
+        if table == 'doctors':
+            self.doctor_names = []
+            self.doctor_ids = {}
+        else:
+            self.symptom_names = []
+            self.symptom_ids = {}
+
+        self.high_water[table] = 0
+        self.row_counts[table] = 0
+
+    def __len__(self):
+        return len(self.app_id)
+
+    def refresh(self, db):
+        """
+        Load the rows added to the database since the last refresh, unless
+        the data versions of the tables show that nothing changed.
+
+        :param db: an AppointmentDatabase to read from
+        :return: number of appointments loaded
+        """
+        versions = db.get_data_versions(TABLES)
+
+        with self._lock:
+            if versions == self.versions:
+                return 0
+
+            started = not db.conn.in_transaction
+            if started:
+                # Read every table from the same snapshot.
+                db.conn.execute('BEGIN')
+
+            try:
+                changed = [table for table, old, new in zip(
+                    TABLES, self.versions or [None] * len(TABLES), versions)
+                    if old != new]
+
+                for table in ('doctors', 'symptoms'):
+                    if table in changed:
+                        self._clear_names(table)
+
+                loaded = self._load(db.conn)
+
+                if self._deleted(db.conn, changed):
+                    self._clear()
+                    loaded = self._load(db.conn)
+            finally:
+                if started:
+                    db.conn.rollback()
+
+            self.versions = versions
+            return loaded
+
+    def _deleted(self, conn, tables):
+        """
+        Tell whether rows were deleted from any of tables since they were
+        loaded, which the high-water marks can't tell apart: the table then
+        has a different number of rows or highest primary key than what
+        was loaded.
+        """
+        cur = conn.cursor()
+        cur.row_factory = None
+
+        for table in tables:
+            if table == 'app':
+                # The summary table counts the appointments without
+                # reading app.
+                cur.execute('SELECT COALESCE(SUM(app_count), 0), '
+                            '(SELECT COALESCE(MAX(app_id), 0) FROM app) '
+                            'FROM app_month_counts')
+            else:
+                cur.execute('SELECT COUNT(*), COALESCE(MAX({}), 0) '
+                            'FROM {}'.format(_KEYS[table], table))
+
+            if cur.fetchone() != (self.row_counts[table],
+                                  self.high_water[table]):
+                return True
+
+        return False
+
+    def _fetch(self, conn, query, table):
+        """
+        Yield the rows of query above the high-water mark of table, in
+        batches of at most LOAD_BATCH, and raise the mark past them. The
+        query must select the primary key first and order by it.
+        """
+        cur = conn.cursor()
+        # Plain tuples are much faster to build than sqlite3.Row objects.
+        cur.row_factory = None
+        cur.execute(query, (self.high_water[table],))
+
+        while True:
+            rows = cur.fetchmany(LOAD_BATCH)
+
+            if not rows:
+                break
+
+            self.high_water[table] = rows[-1][0]
+            self.row_counts[table] += len(rows)
+            yield rows
+
+    def _load(self, conn):
+        """
+        Append the rows above the high-water marks to the arrays.
+
+        :return: number of appointments appended
+        """
+        for table, key, column, names, ids in (
+                ('doctors', 'doctor_id', 'doctor', self.doctor_names,
+                 self.doctor_ids),
+                ('symptoms', 'symptom_id', 'symptom', self.symptom_names,
+                 self.symptom_ids)):
+            query = 'SELECT {0}, {1} FROM {2} WHERE {0} > ? ' \
+                    'ORDER BY {0}'.format(key, column, table)
+
+            for rows in self._fetch(conn, query, table):
+                names.extend([None] * (rows[-1][0] + 1 - len(names)))
+
+                for row_id, name in rows:
+                    names[row_id] = name
+                    ids[name] = row_id
+
+        for rows in self._fetch(conn, 'SELECT patient_id, '
+                                      "CASE WHEN typeof(age) = 'integer' "
+                                      'THEN age ELSE {} END, gender '
+                                      'FROM patients WHERE patient_id > ? '
+                                      'ORDER BY patient_id'.format(_NO_AGE),
+                                'patients'):
+            patient_ids, ages, genders = zip(*rows)
+            patient_ids = np.array(patient_ids, np.int64)
+            size = int(patient_ids[-1]) + 1
+
+            if size > len(self.patient_age):
+                grown = np.full(size, _NO_AGE, np.int16)
+                grown[:len(self.patient_age)] = self.patient_age
+                self.patient_age = grown
+
+                grown = np.zeros(size, np.int32)
+                grown[:len(self.patient_gender)] = self.patient_gender
+                self.patient_gender = grown
+
+            self.patient_age[patient_ids] = np.array(ages, np.int64).clip(
+                _NO_AGE, 32767)
+            self.patient_gender[patient_ids] = self.genders.encode(genders)
+
+        columns = {name: [getattr(self, name)] for name in
+                   ('app_id', 'patient_id', 'doctor_id', 'symptom_id',
+                    'month', 'scheduled_at', 'age', 'gender')}
+        loaded = 0
+
+        for rows in self._fetch(conn, 'SELECT app_id, patient_id, doctor_id, '
+                                      'symptom_id, month, '
+                                      'COALESCE(scheduled_at, {}) FROM app '
+                                      'WHERE app_id > ? '
+                                      'ORDER BY app_id'.format(_NO_TIME),
+                                'app'):
+            app_ids, patient_ids, doctor_ids, symptom_ids, months, times = \
+                zip(*rows)
+
+            patient_ids = np.array(patient_ids, np.int32)
+
+            columns['app_id'].append(np.array(app_ids, np.int64))
+            columns['patient_id'].append(patient_ids)
+            columns['age'].append(self.patient_age[patient_ids])
+            columns['gender'].append(self.patient_gender[patient_ids])
+            columns['doctor_id'].append(np.array(doctor_ids, np.int32))
+            columns['symptom_id'].append(np.array(symptom_ids, np.int32))
+            columns['month'].append(self.months.encode(months))
+            columns['scheduled_at'].append(np.array(times, np.int64))
+            loaded += len(rows)
+
+        if loaded:
+            for name, arrays in columns.items():
+                setattr(self, name, np.concatenate(arrays))
+
+        return loaded
+
+    def select(self, filters=None):
+        """
+        Find the appointments that match every filter.
+
+        :param filters: dict mapping names of APP_FILTERS to their values
+        :return: NumPy array of the positions of the appointments in the
+        arrays, or a slice of all of them if there are no filters
+        """
+        if not filters:
+            return slice(None)
+
+        mask = np.ones(len(self.app_id), bool)
+
+        for name, value in filters.items():
+            if name not in APP_FILTERS:
+                raise ValueError('unknown filter {}'.format(name))
+
+            if name == 'doctor':
+                mask &= self.doctor_id == self.doctor_ids.get(value, -1)
+            elif name == 'symptom':
+                mask &= self.symptom_id == self.symptom_ids.get(value, -1)
+            elif name == 'month':
+                mask &= self.month == self.months.codes.get(value, -1)
+            elif name == 'patient_id':
+                mask &= self.patient_id == int(value)
+            elif name == 'gender':
+                mask &= self.gender == self.genders.codes.get(value, -1)
+            elif name == 'from':
+                mask &= self.scheduled_at >= int(value)
+            elif name == 'to':
+                mask &= (self.scheduled_at < int(value)) & \
+                    (self.scheduled_at != _NO_TIME)
+            elif name == 'age_min':
+                mask &= (self.age >= int(value)) & (self.age != _NO_AGE)
+            else:
+                mask &= (self.age <= int(value)) & (self.age != _NO_AGE)
+
+        return np.flatnonzero(mask)
+
+    def _dimension(self, name, rows, age_bucket):
+        """
+        :return: (codes, number of codes, labels) of a dimension of
+        STAT_DIMENSIONS for the appointments at rows
+        """
+        if name == 'doctor':
+            return (self.doctor_id[rows], len(self.doctor_names),
+                    self.doctor_names)
+
+        if name == 'symptom':
+            return (self.symptom_id[rows], len(self.symptom_names),
+                    self.symptom_names)
+
+        if name == 'month':
+            return self.month[rows], len(self.months), self.months.labels
+
+        if name == 'gender':
+            return self.gender[rows], len(self.genders), self.genders.labels
+
+        # Code 0 is for a missing age, and code i + 1 for the bucket of
+        # ages i * age_bucket to (i + 1) * age_bucket - 1.
+        ages = self.age[rows].astype(np.int32)
+        codes = np.where(ages == _NO_AGE, 0, ages // age_bucket + 1)
+        count = int(codes.max()) + 1 if len(codes) else 1
+        labels = [None] + [i * age_bucket for i in range(count - 1)]
+
+        return codes, count, labels
+
+    def get_app_stats(self, by, filters=None, age_bucket=10):
+        """
+        Count the appointments that match filters, grouped by one
+        dimension of STAT_DIMENSIONS, or cross-tabulated by two, like
+        AppointmentDatabase.get_app_stats.
+
+        :param by: list of one or two names of STAT_DIMENSIONS
+        :param filters: dict mapping names of APP_FILTERS to their values
+        :param age_bucket: the width in years of the age buckets
+        :return: list of dicts with a key for each dimension and app_count,
+        in order of the dimensions
+        """
+        by = list(by)
+
+        if not 1 <= len(by) <= 2 or len(set(by)) != len(by):
+            raise ValueError('one or two different dimensions required')
+
+        for name in by:
+            if name not in STAT_DIMENSIONS:
+                raise ValueError('unknown dimension {}'.format(name))
+
+        age_bucket = int(age_bucket)
+
+        with self._lock:
+            rows = self.select(filters)
+            dimensions = [self._dimension(name, rows, age_bucket)
+                          for name in by]
+
+        # Combine the codes of the dimensions into one code per group.
+        keys, size, _ = dimensions[0]
+        for codes, count, _ in dimensions[1:]:
+            keys = keys.astype(np.int64) * count + codes
+            size *= count
+
+        counts = np.bincount(keys, minlength=size)
+        groups = []
+
+        for key in np.flatnonzero(counts):
+            group = {}
+            remainder = int(key)
+
+            for name, (_, count, labels) in reversed(list(zip(by,
+                                                              dimensions))):
+                remainder, code = divmod(remainder, count)
+                group[name] = labels[code]
+
+            group = {name: group[name] for name in by}
+            group['app_count'] = int(counts[key])
+            groups.append(group)
+
+        groups.sort(key=lambda group: [_sort_key(group[name], name)
+                                       for name in by])
+        return groups
+
+    def age_histogram(self, bins=10, filters=None):
+        """
+        Compute a histogram of the ages of the patients of the appointments
+        that match filters, with NumPy's histogram.
+
+        :param bins: number of equal-width bins, or a list of bin edges
+        :param filters: dict mapping names of APP_FILTERS to their values
+        :return: (counts, edges) pair of lists, where counts[i] is the
+        number of appointments with an age from edges[i] to edges[i + 1]
+        """
+        with self._lock:
+            ages = self.age[self.select(filters)]
+
+        counts, edges = np.histogram(ages[ages != _NO_AGE], bins)
+        return counts.tolist(), edges.tolist()
@@ -7,16 +7,64 @@ symptoms in each requests through terminal.
 Written by Minhwa (Mina) Lee
 """
 
-from flask import Flask, g, jsonify, request, render_template
+from flask import (Flask, Response, g, jsonify, request, render_template,
+                   stream_with_context)
 from flask.views import MethodView
+import functools
+import json
 import os
+import time
 import sqlite3
-from app_db import AppointmentDatabase
+from urllib.parse import urlencode
+from app_args import (ArgumentError, format_after, get_after_arg,
+                      get_app_filters, get_app_query, get_ids_arg,
+                      get_int_arg, get_schedule, get_time_arg)
+from app_db import (APP_DURATION, SEARCH_COLUMNS, STAT_DIMENSIONS,
+                    AppointmentConflict)
+from app_metrics import MetricsRegistry
+from app_responses import RecordJSONProvider, VersionedResponseCache
+import app_resources
 from collections import OrderedDict
 
 app = Flask(__name__)
+app.json = RecordJSONProvider(app)
 
 app.config['DATABASE'] = os.path.join(app.root_path, 'appointments.sqlite')
+app.config['DATABASE_POOL_SIZE'] = 5
+app.config['DATABASE_POOL_IDLE_TIMEOUT'] = 300
+app.config['RESPONSE_CACHE_SIZE'] = 256
+# The file shared by the workers, and kept across restarts, that the
+# responses of the expensive views are also cached in, e.g.
+# 'response_cache.sqlite' (None to turn it off; app_server.py sets it with
+# --response-cache), and the maximum size of the bodies kept there.
+app.config['RESPONSE_CACHE_FILE'] = None
+app.config['RESPONSE_CACHE_BYTES'] = 64 * 1024 * 1024
+app.config['PAGE_SIZE'] = 100
+app.config['MAX_PAGE_SIZE'] = 1000
+app.config['GROUP_PREVIEW_SIZE'] = 10
+app.config['SEARCH_LIMIT'] = 20
+app.config['STATS_AGE_BUCKET'] = 10
+# True to answer /stats from an in-memory NumPy copy of the tables
+# (app_analytics.py), which needs NumPy, instead of from SQL.
+app.config['STATS_ANALYTICS'] = False
+app.config['METRICS_ENABLED'] = True
+# The rotating file that statements slower than SLOW_QUERY_THRESHOLD
+# seconds are logged to, e.g. 'slow_queries.log', or None for no log.
+app.config['SLOW_QUERY_LOG'] = None
+app.config['SLOW_QUERY_THRESHOLD'] = 0.1
+app.config['WRITE_BATCH_SIZE'] = 64
+app.config['WRITE_BATCH_DELAY'] = 0
+# Set by app_server.py in its worker processes: the pools open read-only
+# connections and writes are sent to the writer process at WRITE_SERVER, an
+# (address, authkey) pair.
+app.config['DATABASE_READ_ONLY'] = False
+app.config['WRITE_SERVER'] = None
+
+# Query and request timings, exposed on /metrics.
+metrics = MetricsRegistry()
+app.extensions['metrics'] = metrics
+
+app_resources.init_app(app)
 
 
 #  Referenced from Professor Sommer's Code
@@ -37,12 +85,63 @@ def get_db():
     """
     Returns a AppointmentDatabase instance for accessing the database.
     If the database file does not yet exist, it creates a new database.
+
+    The instance is checked out of the connection pool once per request and
+    returned to it at the end of the request (see app_resources.py).
+    """
+
+    return app_resources.get_db(app)
+
+
+def get_writer():
     """
+    Returns the WriteQueue that every write of the request handlers goes
+    through (see app_resources.py).
+    """
+
+    return app_resources.get_writer(app)
+
 
-    if not hasattr(g, 'app_db'):
-        g.apps_db = AppointmentDatabase(app.config['DATABASE'])
+def get_analytics():
+    """
+    Returns the AppointmentColumns copy of the application's database, up
+    to date with the rows written since the last call.
+    """
 
-    return g.apps_db
+    return app_resources.get_analytics(app)
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Records when the request started, for the request latency metrics.
+    """
+
+    if app.config['METRICS_ENABLED']:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Records the time taken to build the response, per route. For streamed
+    responses that is the time until the body starts.
+    """
+
+    start = g.pop('request_start', None)
+
+    if start is not None:
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(request.method, rule, response.status_code,
+                                time.perf_counter() - start)
+
+    return response
+
+
+# Answers repeat and conditional GET requests from the tables' data versions.
+response_cache = VersionedResponseCache(
+    get_db, maxsize=app.config['RESPONSE_CACHE_SIZE'],
+    get_store=functools.partial(app_resources.get_response_store, app))
 
 
 #  Referenced from Professor Sommer's Code
@@ -80,28 +179,165 @@ def handle_invalid_usage(error):
     return error.to_response()
 
 
+@app.errorhandler(ArgumentError)
+def handle_invalid_argument(error):
+    """
+    Returns a 422 JSON response for an invalid request parameter.
+
+    :param error: the ArgumentError
+    :return: a response containing the error message
+    """
+    return RequestError(422, str(error)).to_response()
+
+
+def page_response(get_page, id_key, sort_key=None):
+    """
+    Returns a JSON response containing one page of a collection.
+
+    The page size is given by the 'limit' parameter and the page starts
+    after the primary key given by the 'after_id' parameter. If there are
+    more items, the primary key to continue from is sent in the
+    X-Next-After-Id header, and the URL of the next page in a Link header.
+
+    A collection sorted by another key than its primary key continues
+    from the 'after' parameter of get_after_arg instead, the value of the
+    sort key and the primary key of the last item, so that the next page
+    doesn't depend on that item still existing.
+
+    :param get_page: an AppointmentDatabase get_*_page method, which takes
+    the 'after' position as its after argument if sort_key is given
+    :param id_key: name of the primary key in each item
+    :param sort_key: name of the key the items are sorted by, or None if
+    they are sorted by id_key
+    :return: JSON response
+    """
+    limit = get_int_arg(request.args, 'limit', app.config['PAGE_SIZE'], 1,
+                        app.config['MAX_PAGE_SIZE'])
+    after_id = get_int_arg(request.args, 'after_id', 0, 0)
+
+    # Asking for one extra item tells us whether there is a next page.
+    if sort_key is None:
+        items = get_page(limit + 1, after_id)
+    else:
+        items = get_page(limit + 1, after_id,
+                         after=get_after_arg(request.args))
+    response = jsonify(items[:limit])
+
+    if len(items) > limit:
+        last = items[limit - 1]
+        next_after_id = last[id_key]
+
+        args = request.args.to_dict()
+        args['limit'] = limit
+
+        if sort_key is None:
+            args['after_id'] = next_after_id
+        else:
+            args.pop('after_id', None)
+            args['after'] = format_after(last[sort_key], next_after_id)
+
+        response.headers['X-Next-After-Id'] = str(next_after_id)
+        response.headers['Link'] = '<{}?{}>; rel="next"'.format(
+            request.base_url, urlencode(args))
+
+    return response
+
+
+def wants_stream():
+    """
+    Returns True if the client asked for a streamed export of a whole
+    collection, with the 'stream' parameter or by accepting NDJSON.
+    """
+    return request.args.get('stream') == '1' or wants_ndjson()
+
+
+def wants_ndjson():
+    """
+    Returns True if the client asked for newline-delimited JSON.
+    """
+    if request.args.get('stream') == 'ndjson':
+        return True
+
+    best = request.accept_mimetypes.best_match(['application/json',
+                                                'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+def stream_response(batches):
+    """
+    Returns a response that streams a whole collection to the client, as a
+    JSON array or as NDJSON (one JSON object per line), encoding one batch
+    of rows at a time so that memory use does not depend on the size of the
+    collection.
+
+    The request context, and so the pooled database connection, is kept
+    until the last batch has been sent.
+
+    :param batches: iterable of lists of dicts, e.g. from iter_all_apps()
+    :return: a streaming response
+    """
+    dumps = app.json.dumps
+
+    if wants_ndjson():
+        def generate():
+            for batch in batches:
+                yield ''.join([dumps(row) + '\n' for row in batch])
+
+        mimetype = 'application/x-ndjson'
+    else:
+        def generate():
+            separator = '['
+            for batch in batches:
+                yield separator + ','.join([dumps(row) for row in batch])
+                separator = ','
+
+            yield ']' if separator == ',' else '[]'
+
+        mimetype = 'application/json'
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
 class AppointmentsView(MethodView):
     """
     This view handles all the /apps requests.
     """
 
+    @response_cache.versioned('app', 'patients', 'doctors', 'symptoms',
+                              persist=True)
     def get(self, app_id):
         """
         Handle GET requests.
 
-        Returns JSON representing all of the appointments
+        Returns JSON representing a page of the appointments
         if app_id is None, or a single appointment if app_id exists.
+        Pages are selected with the 'limit' and 'after_id' or 'after'
+        parameters, as in page_response(), and the appointments filtered
+        and sorted as given by get_app_query().
+        The whole collection is streamed if wants_stream() is True.
 
         :param app_id: id of an appointment, or None for all appointments
         :return: JSON response
         """
         if app_id is None:
-            all_apps = get_db().get_all_apps()
-            return jsonify(all_apps)
+            sort, filters = get_app_query(request.args)
+            key = sort.lstrip('-')
+            sort_key = None if key == 'app_id' else key
+
+            if wants_stream():
+                return stream_response(get_db().iter_all_apps(
+                    sort=sort, filters=filters))
+
+            try:
+                return page_response(functools.partial(
+                    get_db().get_apps_page, sort=sort, filters=filters),
+                    'app_id', sort_key)
+            except ValueError:
+                raise RequestError(404, 'after_id not found')
         else:
             appointment = get_db().get_app_by_id(app_id)
 
-            if app is not None:
+            if appointment is not None:
                 response = jsonify(appointment)
             else:
                 raise RequestError(404, 'appointment not found')
@@ -113,61 +349,315 @@ class AppointmentsView(MethodView):
         Implements POST /apps
 
         Requires the form parameters 'FirstN', 'LastN', 'gender', 'age',
-        'birth', 'doctor FirstN', 'month', and 'Symptom'.
+        'birth', 'doctor FirstN', 'Symptom', and either 'month' or
+        'scheduled_at', as given to get_schedule(). An appointment that
+        overlaps another one of the doctor is refused with status 409.
 
         :return: JSON response representing the new appointment's information
         """
 
         for parameter in ('FirstN', 'LastN', 'gender', 'age', 'birth',
-                          'doctor', 'month', 'symptom'):
+                          'doctor', 'symptom'):
             if parameter not in request.form:
                 error = 'parameter {} required'.format(parameter)
                 raise RequestError(422, error)
 
-        response = jsonify(get_db().insert_app(request.form['FirstN'],
-                                               request.form['LastN'],
-                                               request.form['gender'],
-                                               request.form['age'],
-                                               request.form['birth'],
-                                               request.form['doctor'],
-                                               request.form['month'],
-                                               request.form['symptom']))
+        scheduled_at, ends_at = get_schedule(request.form)
 
-        return response
+        try:
+            app = get_writer().insert_app(request.form['FirstN'],
+                                          request.form['LastN'],
+                                          request.form['gender'],
+                                          request.form['age'],
+                                          request.form['birth'],
+                                          request.form['doctor'],
+                                          request.form.get('month'),
+                                          request.form['symptom'],
+                                          scheduled_at, ends_at)
+        except AppointmentConflict as conflict:
+            raise RequestError(409, str(conflict))
+
+        return jsonify(app)
 
     def delete(self, app_id):
         """
-        Handle DELETE requests. The app_id must be provided.
+        Handle DELETE requests. Without app_id, the appointments whose ids are
+        given by the 'ids' parameter are deleted, e.g. ?ids=1,2,3, and the
+        response gives the number deleted.
 
-        :param app_id: id of an appointment
+        :param app_id: id of an appointment, or None
         :return: JSON response containing a message
         """
-        if get_db().get_app_by_id(app_id) is None:
-            raise RequestError(404, 'appointment not found')
+        if app_id is None:
+            deleted = get_writer().delete_app_many(
+                get_ids_arg(request.args))
+            return jsonify({'deleted': deleted})
 
-        get_db().delete_app(app_id)
+        if not get_writer().delete_app_many([app_id]):
+            raise RequestError(404, 'appointment not found')
 
         return jsonify({'message': 'appointment deleted successfully'})
 
 
+@app.route('/apps/bulk', methods=['POST'])
+def post_apps_bulk():
+    """
+    Implements POST /apps/bulk
+
+    The body is either a JSON array of appointments or, with the content
+    type application/x-ndjson, one JSON appointment per line. Each
+    appointment is an object with the same keys as the form parameters of
+    POST /apps.
+
+    :return: JSON response with the number of appointments inserted and
+    failed, and a result for each appointment
+    """
+
+    if request.mimetype == 'application/x-ndjson':
+        apps = []
+
+        for number, line in enumerate(
+                request.get_data(as_text=True).splitlines(), 1):
+            if not line.strip():
+                continue
+
+            try:
+                apps.append(json.loads(line))
+            except ValueError:
+                raise RequestError(422, 'invalid JSON on line {}'.format(
+                    number))
+    else:
+        apps = request.get_json(force=True, silent=True)
+
+        if not isinstance(apps, list):
+            raise RequestError(422, 'a JSON array of appointments required')
+
+    results = get_writer().insert_apps_bulk(apps)
+    inserted = sum(1 for result in results if 'app_id' in result)
+
+    return jsonify({'inserted': inserted,
+                    'failed': len(results) - inserted,
+                    'results': results})
+
+
+@app.route('/app_doctors')
+@response_cache.versioned('app', 'patients', 'doctors', 'symptoms',
+                          persist=True)
+def get_apps_by_doctors():
+    """
+    Implements GET /app_doctors
+
+    Returns JSON listing each doctor with their number of appointments,
+    read from the precomputed counts, and the first appointments of each
+    doctor. The number of appointments listed per doctor is given by the
+    'preview' parameter.
+
+    :return: JSON response
+    """
+    db = get_db()
+    preview = get_int_arg(request.args, 'preview',
+                          app.config['GROUP_PREVIEW_SIZE'], 0,
+                          app.config['MAX_PAGE_SIZE'])
+
+    groups = db.get_app_counts_by_doctor()
+    for group in groups:
+        group['apps'] = db.get_apps_by_doctor_id(group['doctor_id'], preview)
+
+    return jsonify(groups)
+
+
+@app.route('/app_months')
+@response_cache.versioned('app', 'patients', 'doctors', 'symptoms',
+                          persist=True)
+def get_apps_by_months():
+    """
+    Implements GET /app_months
+
+    Returns JSON listing each month with its number of appointments, read
+    from the precomputed counts, and the first appointments of each month.
+    The number of appointments listed per month is given by the 'preview'
+    parameter.
+
+    :return: JSON response
+    """
+    db = get_db()
+    preview = get_int_arg(request.args, 'preview',
+                          app.config['GROUP_PREVIEW_SIZE'], 0,
+                          app.config['MAX_PAGE_SIZE'])
+
+    groups = db.get_app_counts_by_month()
+    for group in groups:
+        group['apps'] = db.get_apps_by_month(group['month'], preview)
+
+    return jsonify(groups)
+
+
+@app.route('/app_days')
+@response_cache.versioned('app', persist=True)
+def get_apps_by_days():
+    """
+    Implements GET /app_days
+
+    Returns JSON listing each day, in UTC, from the 'from' time up to the
+    'to' time (see get_time_arg) with its number of appointments, for a
+    calendar, e.g. '/app_days?from=2024-04-01&to=2024-05-01'. Days without
+    appointments are left out.
+
+    :return: JSON response
+    """
+    start = get_time_arg(request.args, 'from')
+    end = get_time_arg(request.args, 'to')
+
+    if start is None or end is None:
+        raise RequestError(422, 'parameters from and to required')
+
+    return jsonify(get_db().get_app_counts_by_day(start, end))
+
+
+@app.route('/doctors/<int:doctor_id>/free_slot')
+def get_free_slot(doctor_id):
+    """
+    Implements GET /doctors/<doctor_id>/free_slot
+
+    Returns JSON with the start ('scheduled_at') and end ('ends_at') of the
+    first slot of 'duration' minutes (30 by default) when the doctor is
+    free, from the 'from' time on (now by default), e.g.
+    '/doctors/1/free_slot?from=2024-04-01T09:00:00&duration=60'. With the
+    'to' time, a slot that doesn't end by then is not found. The response
+    isn't cached, as it depends on the current time.
+
+    :param doctor_id: id of the doctor
+    :return: JSON response
+    """
+    db = get_db()
+    start = get_time_arg(request.args, 'from', int(time.time()))
+    end = get_time_arg(request.args, 'to')
+    duration = 60 * get_int_arg(request.args, 'duration',
+                                APP_DURATION // 60, 1, 24 * 60)
+
+    if db.get_doctor_by_id(doctor_id) is None:
+        raise RequestError(404, 'doctor not found')
+
+    slot = db.find_free_slot(doctor_id, start, duration, end)
+
+    if slot is None:
+        raise RequestError(404, 'no free slot before the to time')
+
+    return jsonify({'doctor_id': doctor_id, 'scheduled_at': slot,
+                    'ends_at': slot + duration})
+
+
+@app.route('/stats')
+@response_cache.versioned('app', 'patients', 'doctors', 'symptoms',
+                          persist=True)
+def get_stats():
+    """
+    Implements GET /stats
+
+    Returns JSON with the number of appointments grouped by the dimension
+    given by the 'by' parameter ('doctor', 'month', 'symptom', 'age' or
+    'gender'), or cross-tabulated by two of them, e.g. 'by=doctor,gender'.
+    Without 'by', returns the total and the counts by each dimension.
+    The appointments counted can be filtered like those of /apps, and
+    'bucket' sets the width of the age buckets.
+
+    With STATS_ANALYTICS on, the counts are computed by get_analytics()
+    instead of by SQL.
+
+    :return: JSON response
+    """
+    db = get_analytics() if app.config['STATS_ANALYTICS'] else get_db()
+    filters = get_app_filters(request.args)
+    bucket = get_int_arg(request.args, 'bucket',
+                         app.config['STATS_AGE_BUCKET'], 1)
+
+    if 'by' in request.args:
+        try:
+            return jsonify(db.get_app_stats(request.args['by'].split(','),
+                                            filters, bucket))
+        except ValueError as error:
+            raise RequestError(422, str(error))
+
+    stats = OrderedDict()
+    for name in STAT_DIMENSIONS:
+        stats[name] = db.get_app_stats([name], filters, bucket)
+    stats['total'] = sum(group['app_count'] for group in stats['month'])
+
+    return jsonify(stats)
+
+
+@app.route('/search')
+@response_cache.versioned('patients', 'doctors', 'symptoms')
+def search():
+    """
+    Implements GET /search
+
+    Returns JSON with the patients, doctors and symptoms whose names
+    contain a word starting with each word of the 'q' parameter, best
+    matches first. The 'type' parameter limits the search to a
+    comma-separated list of 'patients', 'doctors' and 'symptoms', and
+    'limit' sets the number of matches of each.
+
+    :return: JSON response
+    """
+    if not request.args.get('q', '').strip():
+        raise RequestError(422, 'parameter q required')
+
+    kinds = tuple(SEARCH_COLUMNS)
+    if 'type' in request.args:
+        kinds = tuple(request.args['type'].split(','))
+
+        for kind in kinds:
+            if kind not in SEARCH_COLUMNS:
+                raise RequestError(422, 'unknown type {}'.format(kind))
+
+    limit = get_int_arg(request.args, 'limit', app.config['SEARCH_LIMIT'],
+                        1, app.config['MAX_PAGE_SIZE'])
+
+    return jsonify(get_db().search(request.args['q'], limit, kinds))
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    Implements GET /metrics
+
+    Returns the query and request timings in the Prometheus text format, or
+    404 if METRICS_ENABLED is off.
+
+    :return: text response
+    """
+
+    if not app.config['METRICS_ENABLED']:
+        raise RequestError(404, 'metrics are disabled')
+
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 class DoctorsView(MethodView):
     """
     This view handles all the /doctors requests.
     """
 
+    @response_cache.versioned('doctors')
     def get(self, doctor_id):
         """
         Handle GET requests.
 
-        Returns JSON representing all of the doctors if doctor_id is None,
-        or just one doctor if doctor_id exists.
+        Returns JSON representing a page of the doctors if doctor_id is
+        None, or just one doctor if doctor_id exists.
+        Pages are selected with the 'limit' and 'after_id' parameters.
+        The whole collection is streamed if wants_stream() is True.
 
         :param doctor_id: id of a doctor, or None for all doctors
         :return: JSON response
         """
         if doctor_id is None:
-            all_doctors = get_db().get_all_doctors()
-            return jsonify(all_doctors)
+            if wants_stream():
+                return stream_response(get_db().iter_all_doctors())
+
+            return page_response(get_db().get_doctors_page, 'doctor_id')
         else:
             doctor = get_db().get_doctor_by_id(doctor_id)
 
@@ -190,21 +680,27 @@ class DoctorsView(MethodView):
         if 'doctor' not in request.form:
             raise RequestError(422, 'doctor first name required')
         else:
-            response = jsonify(get_db().insert_doctor(request.form['doctor']))
+            doctor = get_writer().insert_doctor(request.form['doctor'])
+            response = jsonify(doctor)
 
         return response
 
     def delete(self, doctor_id):
         """
-        Handle DELETE requests. The doctor_id must be provided.
+        Handle DELETE requests. Without doctor_id, the doctors whose ids are
+        given by the 'ids' parameter are deleted, e.g. ?ids=1,2,3, and the
+        response gives the number deleted.
 
-        :param doctor_id: id of a doctor
+        :param doctor_id: id of a doctor, or None
         :return: JSON response containing a message
         """
-        if get_db().get_doctor_by_id(doctor_id) is None:
-            raise RequestError(404, 'doctor not found')
+        if doctor_id is None:
+            deleted = get_writer().delete_doctor_many(
+                get_ids_arg(request.args))
+            return jsonify({'deleted': deleted})
 
-        get_db().delete_doctor(doctor_id)
+        if not get_writer().delete_doctor_many([doctor_id]):
+            raise RequestError(404, 'doctor not found')
 
         return jsonify({'message': 'doctor deleted successfully'})
 
@@ -214,19 +710,25 @@ class PatientsView(MethodView):
     This view handles all the /patients requests.
     """
 
+    @response_cache.versioned('patients')
     def get(self, patient_id):
         """
         Handle GET requests.
 
-        Returns JSON representing all of the patients
+        Returns JSON representing a page of the patients
         if patient_id is None, or just one patient if patient_id exists.
+        Pages are selected with the 'limit' and 'after_id' parameters.
+        The whole collection is streamed if wants_stream() is True.
 
         :param patient_id:  id of a patient, or None for
         all patients
         :return: JSON response
         """
         if patient_id is None:
-            return jsonify(get_db().get_all_patients())
+            if wants_stream():
+                return stream_response(get_db().iter_all_patients())
+
+            return page_response(get_db().get_patients_page, 'patient_id')
         else:
             patient = get_db().get_patient_by_id(patient_id)
 
@@ -254,24 +756,30 @@ class PatientsView(MethodView):
                 raise RequestError(422, error)
 
         else:
-            response = jsonify(get_db().insert_patient(request.form['FirstN'],
-                                                       request.form['LastN'],
-                                                       request.form['gender'],
-                                                       request.form['age'],
-                                                       request.form['birth']))
+            patient = get_writer().insert_patient(request.form['FirstN'],
+                                                  request.form['LastN'],
+                                                  request.form['gender'],
+                                                  request.form['age'],
+                                                  request.form['birth'])
+            response = jsonify(patient)
         return response
 
     def delete(self, patient_id):
         """
-        Handle DELETE requests. The patient_id must be provided.
+        Handle DELETE requests. Without patient_id, the patients whose ids are
+        given by the 'ids' parameter are deleted, e.g. ?ids=1,2,3, and the
+        response gives the number deleted.
 
-        :param patient_id: id of a patient
+        :param patient_id: id of a patient, or None
         :return: JSON response containing a message
         """
-        if get_db().get_patient_by_id(patient_id) is None:
-            raise RequestError(404, 'patient not found')
+        if patient_id is None:
+            deleted = get_writer().delete_patient_many(
+                get_ids_arg(request.args))
+            return jsonify({'deleted': deleted})
 
-        get_db().delete_patient(patient_id)
+        if not get_writer().delete_patient_many([patient_id]):
+            raise RequestError(404, 'patient not found')
 
         return jsonify({'message': 'patient deleted successfully'})
 
@@ -281,18 +789,24 @@ class SymptomsView(MethodView):
     This view handles all the /symptoms requests.
     """
 
+    @response_cache.versioned('symptoms')
     def get(self, symptom_id):
         """
         Handle GET requests.
 
-        Returns JSON representing all of the symptoms if symptom_id is None,
-        or just one symptom if symptom_id exists.
+        Returns JSON representing a page of the symptoms if symptom_id is
+        None, or just one symptom if symptom_id exists.
+        Pages are selected with the 'limit' and 'after_id' parameters.
+        The whole collection is streamed if wants_stream() is True.
 
         :param symptom_id: id of a symptom, or None for all symptoms
         :return: JSON response
         """
         if symptom_id is None:
-            return jsonify(get_db().get_all_symptoms())
+            if wants_stream():
+                return stream_response(get_db().iter_all_symptoms())
+
+            return page_response(get_db().get_symptoms_page, 'symptom_id')
         else:
             symptom = get_db().get_symptoms_by_id(symptom_id)
 
@@ -315,22 +829,27 @@ class SymptomsView(MethodView):
         if 'symptom' not in request.form:
             raise RequestError(422, 'symptom name required')
         else:
-            response = jsonify(get_db().insert_symptoms
+            response = jsonify(get_writer().insert_symptoms
                                (request.form['symptom']))
 
         return response
 
     def delete(self, symptom_id):
         """
-        Handle DELETE requests. The symptom_id must be provided.
+        Handle DELETE requests. Without symptom_id, the symptoms whose ids are
+        given by the 'ids' parameter are deleted, e.g. ?ids=1,2,3, and the
+        response gives the number deleted.
 
-        :param symptom_id: id of a symptom
+        :param symptom_id: id of a symptom, or None
         :return: JSON response containing a message
         """
-        if get_db().get_symptoms_by_id(symptom_id) is None:
-            raise RequestError(404, 'symptom not found')
+        if symptom_id is None:
+            deleted = get_writer().delete_symptom_many(
+                get_ids_arg(request.args))
+            return jsonify({'deleted': deleted})
 
-        get_db().delete_symptom(symptom_id)
+        if not get_writer().delete_symptom_many([symptom_id]):
+            raise RequestError(404, 'symptom not found')
 
         return jsonify({'message': 'symptom deleted successfully'})
 
@@ -340,7 +859,7 @@ class SymptomsView(MethodView):
 # Register AppointmentsView as the handler for all the /apps requests.
 apps_view = AppointmentsView.as_view('app_view')
 app.add_url_rule('/apps', defaults={'app_id': None},
-                 view_func=apps_view, methods=['GET'])
+                 view_func=apps_view, methods=['GET', 'DELETE'])
 app.add_url_rule('/apps', view_func=apps_view, methods=['POST'])
 app.add_url_rule('/apps/<int:app_id>', view_func=apps_view,
                  methods=['GET', 'DELETE'])
@@ -348,7 +867,7 @@ app.add_url_rule('/apps/<int:app_id>', view_func=apps_view,
 # Register DoctorsView as the handler for all the /doctors requests
 doctors_view = DoctorsView.as_view('doctors_view')
 app.add_url_rule('/doctors', defaults={'doctor_id': None},
-                 view_func=doctors_view, methods=['GET'])
+                 view_func=doctors_view, methods=['GET', 'DELETE'])
 app.add_url_rule('/doctors', view_func=doctors_view, methods=['POST'])
 app.add_url_rule('/doctors/<int:doctor_id>', view_func=doctors_view,
                  methods=['GET', 'DELETE'])
@@ -356,7 +875,7 @@ app.add_url_rule('/doctors/<int:doctor_id>', view_func=doctors_view,
 # Register PatientsView as the handler for all the /patients requests
 patients_view = PatientsView.as_view('patients_view')
 app.add_url_rule('/patients', defaults={'patient_id': None},
-                 view_func=patients_view, methods=['GET'])
+                 view_func=patients_view, methods=['GET', 'DELETE'])
 app.add_url_rule('/patients', view_func=patients_view, methods=['POST'])
 app.add_url_rule('/patients/<int:patient_id>', view_func=patients_view,
                  methods=['GET', 'DELETE'])
@@ -364,7 +883,7 @@ app.add_url_rule('/patients/<int:patient_id>', view_func=patients_view,
 # Register SymptomsView as the handler for all the /symptoms requests
 symptoms_view = SymptomsView.as_view('symptoms_view')
 app.add_url_rule('/symptoms', defaults={'symptom_id': None},
-                 view_func=symptoms_view, methods=['GET'])
+                 view_func=symptoms_view, methods=['GET', 'DELETE'])
 app.add_url_rule('/symptoms', view_func=symptoms_view, methods=['POST'])
 app.add_url_rule('/symptoms/<int:symptom_id>', view_func=symptoms_view,
                  methods=['GET', 'DELETE'])
@@ -0,0 +1,571 @@
+"""
+This is an asynchronous variant of the API of app_api.py, built on Quart
+(the asyncio implementation of the Flask API), for serving many concurrent
+clients from one process. It provides the same /apps, /patients, /doctors
+and /symptoms routes. Database calls are run by a DatabaseExecutor, so a
+request waiting on SQLite doesn't hold up the others.
+
+Run it with an ASGI server, e.g. 'hypercorn app_api_async:app'.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import asyncio
+import functools
+import os
+import threading
+from urllib.parse import urlencode
+
+try:
+    from quart import Quart, Response, jsonify, request
+    from quart.views import MethodView
+except ImportError as error:
+    raise ImportError('app_api_async requires Quart '
+                      '(pip install quart hypercorn)') from error
+
+from app_args import (ArgumentError, format_after, get_after_arg,
+                      get_app_query, get_ids_arg, get_int_arg,
+                      get_schedule)
+from app_db import AppointmentConflict
+from app_executor import DatabaseExecutor
+from app_responses import (RecordJSONProvider, ResponseBodies,
+                           ResponseStore, cached_response,
+                           conditional_headers, store_key)
+
+app = Quart(__name__)
+app.json = RecordJSONProvider(app)
+
+app.config['DATABASE'] = os.path.join(app.root_path, 'appointments.sqlite')
+app.config['DATABASE_READERS'] = 4
+app.config['WRITE_BATCH_SIZE'] = 64
+app.config['WRITE_BATCH_DELAY'] = 0
+app.config['RESPONSE_CACHE_SIZE'] = 256
+# The ResponseStore file that the /apps pages are also cached in, shared
+# with app_api and app_api_html (None to turn it off), as in app_api.py.
+app.config['RESPONSE_CACHE_FILE'] = None
+app.config['RESPONSE_CACHE_BYTES'] = 64 * 1024 * 1024
+app.config['PAGE_SIZE'] = 100
+app.config['MAX_PAGE_SIZE'] = 1000
+
+_executor_lock = threading.Lock()
+
+
+def get_db():
+    """
+    Returns the DatabaseExecutor for the application's database file,
+    creating it on first use. Its methods are coroutine functions.
+    """
+
+    with _executor_lock:
+        executor = app.extensions.get('appointment_executor')
+
+        if (executor is None
+                or executor.sqlite_filename != app.config['DATABASE']):
+            if executor is not None:
+                executor.close()
+
+            executor = DatabaseExecutor(
+                app.config['DATABASE'],
+                readers=app.config['DATABASE_READERS'],
+                batch_size=app.config['WRITE_BATCH_SIZE'],
+                batch_delay=app.config['WRITE_BATCH_DELAY'])
+            app.extensions['appointment_executor'] = executor
+
+    return executor
+
+
+def get_response_store():
+    """
+    Returns the ResponseStore configured by RESPONSE_CACHE_FILE and
+    RESPONSE_CACHE_BYTES, opening it on first use, or None if
+    RESPONSE_CACHE_FILE is None. Its methods block, so they are run in a
+    thread.
+    """
+
+    path = app.config['RESPONSE_CACHE_FILE']
+
+    if path is None:
+        return None
+
+    with _executor_lock:
+        store = app.extensions.get('response_store')
+
+        if (store is None or store.path != path
+                or store.max_bytes != app.config['RESPONSE_CACHE_BYTES']):
+            if store is not None:
+                store.close()
+
+            store = ResponseStore(path, app.config['RESPONSE_CACHE_BYTES'])
+            app.extensions['response_store'] = store
+
+    return store
+
+
+@app.after_serving
+async def close_db():
+    """
+    Stops the DatabaseExecutor when the server shuts down.
+    """
+
+    with _executor_lock:
+        executor = app.extensions.pop('appointment_executor', None)
+
+    if executor is not None:
+        executor.close()
+
+
+class RequestError(Exception):
+
+    def __init__(self, status_code, error_message):
+        super().__init__(self)
+
+        self.status_code = status_code
+        self.error_message = error_message
+
+    def to_response(self):
+        """
+        Create a Response object containing the error message as JSON.
+
+        :return: the response
+        """
+
+        response = jsonify({'error': self.error_message})
+        response.status_code = self.status_code
+        return response
+
+
+@app.errorhandler(RequestError)
+async def handle_invalid_usage(error):
+    """
+    Returns a JSON response built from a RequestError.
+
+    :param error: the RequestError
+    :return: a response containing the error message
+    """
+    return error.to_response()
+
+
+@app.errorhandler(ArgumentError)
+async def handle_invalid_argument(error):
+    """
+    Returns a 422 JSON response for an invalid request parameter.
+
+    :param error: the ArgumentError
+    :return: a response containing the error message
+    """
+    return RequestError(422, str(error)).to_response()
+
+
+# Bodies of GET responses, keyed by request and data versions.
+response_bodies = ResponseBodies(maxsize=app.config['RESPONSE_CACHE_SIZE'],
+                                 get_store=get_response_store)
+
+
+def versioned(*tables, persist=False):
+    """
+    Decorator for a GET view whose response depends only on the request and
+    on the contents of the given tables, like
+    VersionedResponseCache.versioned of app_responses.py, which it shares
+    the validators and ResponseBodies with, reading the data versions
+    through the DatabaseExecutor instead: up to date clients are answered
+    with 304, and responses are cached until the data changes, also in the
+    ResponseStore with persist.
+
+    :param tables: names of the tables the view reads
+    :param persist: True to also keep the bodies in the ResponseStore
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            versions = await get_db().get_data_versions(tables)
+            etag, headers, not_modified = conditional_headers(request,
+                                                              versions)
+
+            if not_modified:
+                return Response('', status=304, headers=headers)
+
+            key = store_key(app, request, get_db().schema_version)
+
+            # The ResponseStore blocks, so it is used from a thread.
+            if persist:
+                cached = await asyncio.to_thread(response_bodies.lookup, key,
+                                                 etag, persist)
+            else:
+                cached = response_bodies.lookup(key, etag)
+
+            if cached is not None:
+                return cached_response(Response, cached, headers)
+
+            response = await view(*args, **kwargs)
+            response.headers.update(headers)
+
+            if response.status_code == 200:
+                body = await response.get_data()
+
+                if persist:
+                    await asyncio.to_thread(response_bodies.save, key, etag,
+                                            body, response, persist)
+                else:
+                    response_bodies.save(key, etag, body, response)
+
+            return response
+
+        return wrapper
+
+    return decorate
+
+
+async def page_response(get_page, id_key, sort_key=None):
+    """
+    Returns a JSON response containing one page of a collection, selected
+    by the 'limit' and 'after_id' or 'after' parameters, like page_response
+    of app_api.py.
+
+    :param get_page: a get_*_page coroutine function of the executor
+    :param id_key: name of the primary key in each item
+    :param sort_key: name of the key the items are sorted by, or None if
+    they are sorted by id_key
+    :return: JSON response
+    """
+    limit = get_int_arg(request.args, 'limit', app.config['PAGE_SIZE'], 1,
+                        app.config['MAX_PAGE_SIZE'])
+    after_id = get_int_arg(request.args, 'after_id', 0, 0)
+
+    # Asking for one extra item tells us whether there is a next page.
+    if sort_key is None:
+        items = await get_page(limit + 1, after_id)
+    else:
+        items = await get_page(limit + 1, after_id,
+                               after=get_after_arg(request.args))
+    response = jsonify(items[:limit])
+
+    if len(items) > limit:
+        last = items[limit - 1]
+        next_after_id = last[id_key]
+
+        args = request.args.to_dict()
+        args['limit'] = limit
+
+        if sort_key is None:
+            args['after_id'] = next_after_id
+        else:
+            args.pop('after_id', None)
+            args['after'] = format_after(last[sort_key], next_after_id)
+
+        response.headers['X-Next-After-Id'] = str(next_after_id)
+        response.headers['Link'] = '<{}?{}>; rel="next"'.format(
+            request.base_url, urlencode(args))
+
+    return response
+
+
+async def require_form(*parameters):
+    """
+    Returns the request's form, or raises a RequestError if one of the
+    given parameters is missing.
+    """
+    form = await request.form
+
+    for parameter in parameters:
+        if parameter not in form:
+            raise RequestError(422, 'parameter {} required'.format(parameter))
+
+    return form
+
+
+class AppointmentsView(MethodView):
+    """
+    This view handles all the /apps requests.
+    """
+
+    @versioned('app', 'patients', 'doctors', 'symptoms', persist=True)
+    async def get(self, app_id):
+        """
+        Handle GET requests.
+
+        Returns JSON representing a page of the appointments if app_id is
+        None, filtered and sorted as given by get_app_query(), or a single
+        appointment if app_id exists.
+
+        :param app_id: id of an appointment, or None for all appointments
+        :return: JSON response
+        """
+        if app_id is None:
+            sort, filters = get_app_query(request.args)
+            key = sort.lstrip('-')
+            sort_key = None if key == 'app_id' else key
+
+            try:
+                return await page_response(functools.partial(
+                    get_db().get_apps_page, sort=sort, filters=filters),
+                    'app_id', sort_key)
+            except ValueError:
+                raise RequestError(404, 'after_id not found')
+
+        appointment = await get_db().get_app_by_id(app_id)
+
+        if appointment is None:
+            raise RequestError(404, 'appointment not found')
+
+        return jsonify(appointment)
+
+    async def post(self):
+        """
+        Implements POST /apps
+
+        Requires the form parameters 'FirstN', 'LastN', 'gender', 'age',
+        'birth', 'doctor', 'symptom', and either 'month' or 'scheduled_at',
+        as for POST /apps of app_api.py. An appointment that overlaps
+        another one of the doctor is refused with status 409.
+
+        :return: JSON response representing the new appointment
+        """
+        form = await require_form('FirstN', 'LastN', 'gender', 'age',
+                                  'birth', 'doctor', 'symptom')
+        scheduled_at, ends_at = get_schedule(form)
+
+        try:
+            app = await get_db().insert_app(
+                form['FirstN'], form['LastN'], form['gender'], form['age'],
+                form['birth'], form['doctor'], form.get('month'),
+                form['symptom'], scheduled_at, ends_at)
+        except AppointmentConflict as conflict:
+            raise RequestError(409, str(conflict))
+
+        return jsonify(app)
+
+    async def delete(self, app_id):
+        """
+        Handle DELETE requests. Without app_id, the appointments whose ids are
+        given by the 'ids' parameter are deleted, e.g. ?ids=1,2,3, and the
+        response gives the number deleted.
+
+        :param app_id: id of an appointment, or None
+        :return: JSON response containing a message
+        """
+        if app_id is None:
+            deleted = await get_db().delete_app_many(
+                get_ids_arg(request.args))
+            return jsonify({'deleted': deleted})
+
+        if not await get_db().delete_app_many([app_id]):
+            raise RequestError(404, 'appointment not found')
+
+        return jsonify({'message': 'appointment deleted successfully'})
+
+
+class DoctorsView(MethodView):
+    """
+    This view handles all the /doctors requests.
+    """
+
+    @versioned('doctors')
+    async def get(self, doctor_id):
+        """
+        Handle GET requests.
+
+        Returns JSON representing a page of the doctors if doctor_id is
+        None, or a single doctor if doctor_id exists.
+
+        :param doctor_id: id of a doctor, or None for all doctors
+        :return: JSON response
+        """
+        if doctor_id is None:
+            return await page_response(get_db().get_doctors_page,
+                                       'doctor_id')
+
+        doctor = await get_db().get_doctor_by_id(doctor_id)
+
+        if doctor is None:
+            raise RequestError(404, 'doctor not found')
+
+        return jsonify(doctor)
+
+    async def post(self):
+        """
+        Handles a POST request to insert a new doctor.
+
+        Requires the form parameter 'doctor'
+
+        :return: JSON response representing the new doctor
+        """
+        form = await require_form('doctor')
+
+        return jsonify(await get_db().insert_doctor(form['doctor']))
+
+    async def delete(self, doctor_id):
+        """
+        Handle DELETE requests. Without doctor_id, the doctors whose ids are
+        given by the 'ids' parameter are deleted, e.g. ?ids=1,2,3, and the
+        response gives the number deleted.
+
+        :param doctor_id: id of a doctor, or None
+        :return: JSON response containing a message
+        """
+        if doctor_id is None:
+            deleted = await get_db().delete_doctor_many(
+                get_ids_arg(request.args))
+            return jsonify({'deleted': deleted})
+
+        if not await get_db().delete_doctor_many([doctor_id]):
+            raise RequestError(404, 'doctor not found')
+
+        return jsonify({'message': 'doctor deleted successfully'})
+
+
+class PatientsView(MethodView):
+    """
+    This view handles all the /patients requests.
+    """
+
+    @versioned('patients')
+    async def get(self, patient_id):
+        """
+        Handle GET requests.
+
+        Returns JSON representing a page of the patients if patient_id is
+        None, or a single patient if patient_id exists.
+
+        :param patient_id: id of a patient, or None for all patients
+        :return: JSON response
+        """
+        if patient_id is None:
+            return await page_response(get_db().get_patients_page,
+                                       'patient_id')
+
+        patient = await get_db().get_patient_by_id(patient_id)
+
+        if patient is None:
+            raise RequestError(404, 'patient not found')
+
+        return jsonify(patient)
+
+    async def post(self):
+        """
+        Handles a POST request to insert a new patient.
+
+        Requires the form parameters 'FirstN', 'LastN', 'gender', 'age',
+        'birth'
+
+        :return: JSON response representing the new patient
+        """
+        form = await require_form('FirstN', 'LastN', 'gender', 'age',
+                                  'birth')
+
+        return jsonify(await get_db().insert_patient(
+            form['FirstN'], form['LastN'], form['gender'], form['age'],
+            form['birth']))
+
+    async def delete(self, patient_id):
+        """
+        Handle DELETE requests. Without patient_id, the patients whose ids are
+        given by the 'ids' parameter are deleted, e.g. ?ids=1,2,3, and the
+        response gives the number deleted.
+
+        :param patient_id: id of a patient, or None
+        :return: JSON response containing a message
+        """
+        if patient_id is None:
+            deleted = await get_db().delete_patient_many(
+                get_ids_arg(request.args))
+            return jsonify({'deleted': deleted})
+
+        if not await get_db().delete_patient_many([patient_id]):
+            raise RequestError(404, 'patient not found')
+
+        return jsonify({'message': 'patient deleted successfully'})
+
+
+class SymptomsView(MethodView):
+    """
+    This view handles all the /symptoms requests.
+    """
+
+    @versioned('symptoms')
+    async def get(self, symptom_id):
+        """
+        Handle GET requests.
+
+        Returns JSON representing a page of the symptoms if symptom_id is
+        None, or a single symptom if symptom_id exists.
+
+        :param symptom_id: id of a symptom, or None for all symptoms
+        :return: JSON response
+        """
+        if symptom_id is None:
+            return await page_response(get_db().get_symptoms_page,
+                                       'symptom_id')
+
+        symptom = await get_db().get_symptoms_by_id(symptom_id)
+
+        if symptom is None:
+            raise RequestError(404, 'symptom not found')
+
+        return jsonify(symptom)
+
+    async def post(self):
+        """
+        Handles a POST request to insert a new symptom.
+
+        Requires the form parameter 'symptom'
+
+        :return: JSON response representing the new symptom
+        """
+        form = await require_form('symptom')
+
+        return jsonify(await get_db().insert_symptoms(form['symptom']))
+
+    async def delete(self, symptom_id):
+        """
+        Handle DELETE requests. Without symptom_id, the symptoms whose ids are
+        given by the 'ids' parameter are deleted, e.g. ?ids=1,2,3, and the
+        response gives the number deleted.
+
+        :param symptom_id: id of a symptom, or None
+        :return: JSON response containing a message
+        """
+        if symptom_id is None:
+            deleted = await get_db().delete_symptom_many(
+                get_ids_arg(request.args))
+            return jsonify({'deleted': deleted})
+
+        if not await get_db().delete_symptom_many([symptom_id]):
+            raise RequestError(404, 'symptom not found')
+
+        return jsonify({'message': 'symptom deleted successfully'})
+
+
+# Register AppointmentsView as the handler for all the /apps requests.
+apps_view = AppointmentsView.as_view('app_view')
+app.add_url_rule('/apps', defaults={'app_id': None},
+                 view_func=apps_view, methods=['GET', 'DELETE'])
+app.add_url_rule('/apps', view_func=apps_view, methods=['POST'])
+app.add_url_rule('/apps/<int:app_id>', view_func=apps_view,
+                 methods=['GET', 'DELETE'])
+
+# Register DoctorsView as the handler for all the /doctors requests
+doctors_view = DoctorsView.as_view('doctors_view')
+app.add_url_rule('/doctors', defaults={'doctor_id': None},
+                 view_func=doctors_view, methods=['GET', 'DELETE'])
+app.add_url_rule('/doctors', view_func=doctors_view, methods=['POST'])
+app.add_url_rule('/doctors/<int:doctor_id>', view_func=doctors_view,
+                 methods=['GET', 'DELETE'])
+
+# Register PatientsView as the handler for all the /patients requests
+patients_view = PatientsView.as_view('patients_view')
+app.add_url_rule('/patients', defaults={'patient_id': None},
+                 view_func=patients_view, methods=['GET', 'DELETE'])
+app.add_url_rule('/patients', view_func=patients_view, methods=['POST'])
+app.add_url_rule('/patients/<int:patient_id>', view_func=patients_view,
+                 methods=['GET', 'DELETE'])
+
+# Register SymptomsView as the handler for all the /symptoms requests
+symptoms_view = SymptomsView.as_view('symptoms_view')
+app.add_url_rule('/symptoms', defaults={'symptom_id': None},
+                 view_func=symptoms_view, methods=['GET', 'DELETE'])
+app.add_url_rule('/symptoms', view_func=symptoms_view, methods=['POST'])
+app.add_url_rule('/symptoms/<int:symptom_id>', view_func=symptoms_view,
+                 methods=['GET', 'DELETE'])
+
+if __name__ == '__main__':
+    app.run()
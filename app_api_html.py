@@ -7,15 +7,41 @@ Written by Minhwa (Mina) Lee
 """
 
 
-from flask import Flask, g, jsonify, request, render_template
+from flask import Flask, jsonify, request, render_template
 from flask.views import MethodView
+import functools
 import os
-from app_db import AppointmentDatabase
+from app_db import AppointmentConflict
+from app_responses import RecordJSONProvider, VersionedResponseCache
+import app_resources
 from collections import OrderedDict
 
 app = Flask(__name__)
+app.json = RecordJSONProvider(app)
 
 app.config['DATABASE'] = os.path.join(app.root_path, 'appointments.sqlite')
+app.config['DATABASE_POOL_SIZE'] = 5
+app.config['DATABASE_POOL_IDLE_TIMEOUT'] = 300
+app.config['RESPONSE_CACHE_SIZE'] = 256
+# The file shared by the workers, and kept across restarts, that the
+# responses of the expensive views are also cached in, as in app_api.py
+# (None to turn it off), and the maximum size of the bodies kept there.
+app.config['RESPONSE_CACHE_FILE'] = None
+app.config['RESPONSE_CACHE_BYTES'] = 64 * 1024 * 1024
+app.config['GROUP_PREVIEW_SIZE'] = 10
+# The rotating file that statements slower than SLOW_QUERY_THRESHOLD
+# seconds are logged to, e.g. 'slow_queries.log', or None for no log.
+app.config['SLOW_QUERY_LOG'] = None
+app.config['SLOW_QUERY_THRESHOLD'] = 0.1
+app.config['WRITE_BATCH_SIZE'] = 64
+app.config['WRITE_BATCH_DELAY'] = 0
+# Set by app_server.py in its worker processes: the pools open read-only
+# connections and writes are sent to the writer process at WRITE_SERVER, an
+# (address, authkey) pair.
+app.config['DATABASE_READ_ONLY'] = False
+app.config['WRITE_SERVER'] = None
+
+app_resources.init_app(app)
 
 
 #  Referenced from Professor Sommer's Code
@@ -23,12 +49,21 @@ def get_db():
     """
     Returns a AppointmentDatabase instance for accessing the database.
     If the database file does not yet exist, it creates a new database.
+
+    The instance is checked out of the connection pool once per request and
+    returned to it at the end of the request (see app_resources.py).
     """
 
-    if not hasattr(g, 'app_db'):
-        g.apps_db = AppointmentDatabase(app.config['DATABASE'])
+    return app_resources.get_db(app)
+
 
-    return g.apps_db
+def get_writer():
+    """
+    Returns the WriteQueue that every write of the request handlers goes
+    through (see app_resources.py).
+    """
+
+    return app_resources.get_writer(app)
 
 # Referenced from Professor Sommer's code
 class RequestError(Exception):
@@ -53,6 +88,12 @@ class RequestError(Exception):
         return response
 
 
+# Answers repeat and conditional GET requests from the tables' data versions.
+response_cache = VersionedResponseCache(
+    get_db, maxsize=app.config['RESPONSE_CACHE_SIZE'],
+    get_store=functools.partial(app_resources.get_response_store, app))
+
+
 #  Referenced from Professor Sommer's Code
 @app.errorhandler(RequestError)
 def handle_invalid_usage(error):
@@ -65,75 +106,74 @@ def handle_invalid_usage(error):
     return error.to_response()
 
 
-def get_app_by_doctor():
+def get_app_by_doctor(doctor=None):
     """
      Returns a dictionary containing appointments indexed by doctor.
-     The dictionary keys are doctor names, and the values are lists of
-     appointments.
-     Each appointment is represented by a sqlite row object,
-     which can be used like a dictionary.
+     The dictionary keys are doctor names, and the values are dictionaries
+     with the doctor's number of appointments ('app_count') and a list of
+     appointments ('apps').
+
+     The groups come from the precomputed appointment counts, and each
+     group lists at most GROUP_PREVIEW_SIZE appointments, so the cost does
+     not grow with the number of appointments. If a doctor is given, only
+     that doctor's group is returned, with all of its appointments.
+
+     :param doctor: name of a doctor, or None for all doctors
     """
 
-    cur = get_db().conn.cursor()
+    db = get_db()
 
     # By using an OrderedDict we will preserve alphabetical order of
     # doctors
-
     app_by_doctor = OrderedDict()
 
-    query = '''
-    SELECT doctors.doctor as doctor, patients.FirstN as FirstN,
-    patients.LastN as LastN, patients.gender as gender, patients.age as age,
-    patients.birth as birth, app.month as month, symptoms.symptom as symptom
-    FROM doctors, patients, app, symptoms
-    WHERE app.doctor_id = doctors.doctor_id
-    AND app.patient_id = patients.patient_id
-    AND app.symptom_id = symptoms.symptom_id
-    ORDER BY doctor, FirstN'''
-
-    for row in cur.execute(query):
-        doctor = row['doctor']
+    if doctor is None:
+        limit = app.config['GROUP_PREVIEW_SIZE']
+    else:
+        limit = -1
 
-        if doctor not in app_by_doctor:
-            app_by_doctor[doctor] = []
+    for group in db.get_app_counts_by_doctor():
+        if doctor is not None and group['doctor'] != doctor:
+            continue
 
-        app_by_doctor[doctor].append(row)
+        app_by_doctor[group['doctor']] = {
+            'app_count': group['app_count'],
+            'apps': db.get_apps_by_doctor_id(group['doctor_id'], limit)}
 
     return app_by_doctor
 
 
-def get_app_by_month():
+def get_app_by_month(month=None):
     """
     Returns a dictionary containing appointments indexed by month.
-    The dictionary keys are month names, and the values are lists of
-    appointments.
-    Each appointment is represented by a sqlite row object,
-    which can be used like a dictionary.
+    The dictionary keys are month names, and the values are dictionaries
+    with the month's number of appointments ('app_count') and a list of
+    appointments ('apps').
+
+    As with get_app_by_doctor(), the groups come from the precomputed
+    appointment counts and list at most GROUP_PREVIEW_SIZE appointments,
+    unless a month is given.
+
+    :param month: a month, or None for all months
     """
 
-    cur = get_db().conn.cursor()
+    db = get_db()
 
-    # By using an OrderedDict we will preserve alphabetical order of month
+    # By using an OrderedDict we will preserve the calendar order of month
     app_by_month = OrderedDict()
 
-    query = '''
-    SELECT app.month as month, patients.FirstN as FirstN, patients.LastN as
-    LastN, patients.gender as gender, patients.age as age,
-    patients.birth as birth,
-    doctors.doctor as doctor, symptoms.symptom as symptom
-    FROM doctors, patients, app, symptoms
-    WHERE app.doctor_id = doctors.doctor_id
-    AND app.patient_id = patients.patient_id
-    AND app.symptom_id = symptoms.symptom_id
-    ORDER BY month, FirstN'''
-
-    for row in cur.execute(query):
-        month = row['month']
+    if month is None:
+        limit = app.config['GROUP_PREVIEW_SIZE']
+    else:
+        limit = -1
 
-        if month not in app_by_month:
-            app_by_month[month] = []
+    for group in db.get_app_counts_by_month():
+        if month is not None and group['month'] != month:
+            continue
 
-        app_by_month[month].append(row)
+        app_by_month[group['month']] = {
+            'app_count': group['app_count'],
+            'apps': db.get_apps_by_month(group['month'], limit)}
 
     return app_by_month
 
@@ -155,6 +195,8 @@ class AppsView(MethodView):
     Handles the page for the appointment
     """
 
+    @response_cache.versioned('app', 'patients', 'doctors', 'symptoms',
+                              persist=True)
     def get(self):
         """
         Serves a page which shows all the appointments in the database.
@@ -168,6 +210,7 @@ class DoctorsView(MethodView):
     Handles the page for doctors
     """
 
+    @response_cache.versioned('doctors')
     def get(self):
         """
         Serves a page which shows all doctors in the database.
@@ -181,6 +224,7 @@ class PatientsView(MethodView):
     Handles the page for the patients.
     """
 
+    @response_cache.versioned('patients')
     def get(self):
         """
         Serves the page for showing all patients in the database.
@@ -194,6 +238,7 @@ class SymptomsView(MethodView):
     Handles the page for the symptoms.
     """
 
+    @response_cache.versioned('symptoms')
     def get(self):
         """
         Serves the page for showing all symptoms in the database.
@@ -203,21 +248,29 @@ class SymptomsView(MethodView):
 
 
 @app.route('/app_doctors')
+@response_cache.versioned('app', 'patients', 'doctors', 'symptoms',
+                          persist=True)
 def view_apps_by_doctors():
     """
-    Serves a page which shows the database organized by doctor.
+    Serves a page which shows the database organized by doctor, or all
+    appointments of one doctor if the 'doctor' parameter is given.
     """
     return render_template("app_by_doctors.html",
-                           apps_by_doctor=get_app_by_doctor())
+                           apps_by_doctor=get_app_by_doctor(
+                               request.args.get('doctor')))
 
 
 @app.route('/app_months')
+@response_cache.versioned('app', 'patients', 'doctors', 'symptoms',
+                          persist=True)
 def view_apps_months():
     """
-    Serves a page which shows the database organized by scheduled month.
+    Serves a page which shows the database organized by scheduled month, or
+    all appointments of one month if the 'month' parameter is given.
     """
     return render_template("app_by_months.html",
-                           apps_by_month=get_app_by_month())
+                           apps_by_month=get_app_by_month(
+                               request.args.get('month')))
 
 
 # Additional feature for the project
@@ -251,12 +304,15 @@ def add():
         doctor = request.form['doctor'].strip()
         month = request.form['month'].strip()
         symptom = request.form['symptom'].strip()
+        # The date and time are optional; without them the appointment
+        # only has a month.
+        scheduled_at = request.form.get('scheduled_at', '').strip() or None
 
         max_length = 20
 
         if (first_name == '' or last_name == '' or gender == ''
-                or age == '' or doctor == '' or month == '' or symptom == ''
-                or birth == ''):
+                or age == '' or doctor == '' or symptom == ''
+                or birth == '' or (month == '' and scheduled_at is None)):
             successful_add = False
             notice_text = 'You must enter all of the information!'
         elif (len(first_name) > max_length or len(last_name) > max_length or
@@ -266,10 +322,21 @@ def add():
             successful_add = False
             notice_text = 'All information must be at most 20 characters long!'
         else:
-            successful_add = True
-            notice_text = 'Appointment is successfully made!'
-            get_db().insert_app(first_name, last_name, gender, age, birth,
-                                doctor, month, symptom)
+            try:
+                get_writer().insert_app(first_name, last_name, gender, age,
+                                        birth, doctor, month, symptom,
+                                        scheduled_at)
+            except AppointmentConflict:
+                successful_add = False
+                notice_text = 'The doctor already has an appointment at ' \
+                              'that time!'
+            except ValueError:
+                successful_add = False
+                notice_text = 'The date and time must be like ' \
+                              '2024-04-01T09:30!'
+            else:
+                successful_add = True
+                notice_text = 'Appointment is successfully made!'
 
     return render_template('add.html', display_notice=display_notice,
                            add_status=successful_add,
@@ -0,0 +1,186 @@
+"""
+This module contains the parsing of the query string and form parameters
+shared by app_api.py and app_api_async.py. The functions are given the
+request's args or form, so they work with the requests of both Flask and
+Quart. An invalid parameter raises ArgumentError, which both applications
+answer with 422 Unprocessable Entity.
+
+Written by Minhwa (Mina) Lee
+"""
+
+from app_db import APP_SORT_KEYS, parse_time
+
+
+class ArgumentError(Exception):
+    """
+    Raised when a parameter of a request is missing or invalid. The
+    message is the error returned to the client.
+    """
+
+
+def get_int_arg(args, name, default, minimum, maximum=None):
+    """
+    Returns the integer value of a query string parameter.
+
+    :param args: the request's query string parameters
+    :param name: name of the parameter
+    :param default: value to use if the parameter is missing
+    :param minimum: smallest value allowed
+    :param maximum: largest value allowed, or None for no limit
+    :return: the value of the parameter
+    """
+    if name not in args:
+        return default
+
+    try:
+        value = int(args[name])
+    except ValueError:
+        raise ArgumentError('parameter {} must be an integer'.format(name))
+
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ArgumentError('parameter {} out of range'.format(name))
+
+    return value
+
+
+def get_ids_arg(args, name='ids'):
+    """
+    Returns the primary keys given by a query string parameter, as a
+    comma-separated list, e.g. ids=1,2,3, or repeated, e.g. ids=1&ids=2.
+
+    :param args: the request's query string parameters
+    :param name: name of the parameter
+    :return: list of the primary keys
+    """
+    values = ','.join(args.getlist(name)).split(',')
+
+    try:
+        ids = [int(value) for value in values if value.strip()]
+    except ValueError:
+        raise ArgumentError('parameter {} must be a list of '
+                            'integers'.format(name))
+
+    if not ids:
+        raise ArgumentError('parameter {} is required'.format(name))
+
+    return ids
+
+
+def get_time_arg(args, name, default=None):
+    """
+    Returns the time given by a query string parameter, in seconds since
+    the epoch. The parameter is either seconds since the epoch or an ISO
+    8601 date or date and time, in UTC unless it has a time zone, e.g.
+    from=2024-04-01 or from=2024-04-01T09:00:00%2B09:00.
+
+    :param args: the request's query string parameters
+    :param name: name of the parameter
+    :param default: value to use if the parameter is missing
+    :return: the value of the parameter
+    """
+    if name not in args:
+        return default
+
+    try:
+        return parse_time(args[name])
+    except ValueError:
+        raise ArgumentError('parameter {} must be a time'.format(name))
+
+
+def get_after_arg(args, name='after'):
+    """
+    Returns the position given by a query string parameter that holds the
+    value of the sort key and the primary key of the last item of a page,
+    separated by a comma, e.g. after=Amy,12. An empty value is NULL, e.g.
+    after=,12.
+
+    :param args: the request's query string parameters
+    :param name: name of the parameter
+    :return: (value, primary key) pair, or None if the parameter is missing
+    """
+    if name not in args:
+        return None
+
+    value, _, row_id = args[name].rpartition(',')
+
+    try:
+        return value or None, int(row_id)
+    except ValueError:
+        raise ArgumentError('parameter {} must be a value and an id '
+                            'separated by a comma'.format(name))
+
+
+def format_after(value, row_id):
+    """
+    :return: the value of a parameter read by get_after_arg
+    """
+    return '{},{}'.format('' if value is None else value, row_id)
+
+
+def get_app_query(args):
+    """
+    Returns the order and the filters of an appointment query, from the
+    'sort' parameter (a key of APP_SORT_KEYS, prefixed with '-' for
+    descending order) and the filter parameters, e.g.
+    '/apps?doctor=Amy&age_min=30&sort=-age'.
+
+    :param args: the request's query string parameters
+    :return: (sort, filters) pair for AppointmentDatabase.get_apps_page
+    """
+    sort = args.get('sort', 'app_id')
+    key = sort[1:] if sort.startswith('-') else sort
+
+    if key not in APP_SORT_KEYS:
+        raise ArgumentError('unknown sort key {}'.format(sort))
+
+    return sort, get_app_filters(args)
+
+
+def get_app_filters(args):
+    """
+    Returns the appointment filters given by the 'doctor', 'month',
+    'symptom', 'gender', 'patient_id', 'age_min' and 'age_max' parameters,
+    and the range of times given by 'from' and 'to' (exclusive), as
+    accepted by get_time_arg.
+
+    :param args: the request's query string parameters
+    :return: dict of filters for AppointmentDatabase.get_apps_page
+    """
+    filters = {}
+
+    for name in ('doctor', 'month', 'symptom', 'gender'):
+        if name in args:
+            filters[name] = args[name]
+
+    for name in ('patient_id', 'age_min', 'age_max'):
+        if name in args:
+            filters[name] = get_int_arg(args, name, None, 0)
+
+    for name in ('from', 'to'):
+        if name in args:
+            filters[name] = get_time_arg(args, name)
+
+    return filters
+
+
+def get_schedule(form):
+    """
+    Returns the times of a new appointment, given by the 'scheduled_at' and
+    optional 'ends_at' form parameters as accepted by get_time_arg. Without
+    'scheduled_at', the 'month' parameter is required and the appointment
+    has no times. The month of an appointment with a time is the month of
+    that time, and it ends APP_DURATION later by default.
+
+    :param form: the request's form
+    :return: (scheduled_at, ends_at) pair for AppointmentDatabase.insert_app
+    """
+    scheduled_at = get_time_arg(form, 'scheduled_at')
+    ends_at = get_time_arg(form, 'ends_at')
+
+    if scheduled_at is None and 'month' not in form:
+        raise ArgumentError('parameter month required')
+    if ends_at is not None and (scheduled_at is None or
+                                ends_at <= scheduled_at):
+        raise ArgumentError('parameter ends_at must be after scheduled_at')
+
+    return scheduled_at, ends_at
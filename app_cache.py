@@ -0,0 +1,72 @@
+"""
+This module contains the in-process caches used by AppointmentDatabase and
+the Flask applications.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A thread-safe mapping of bounded size that evicts the least recently
+    used entry when it is full, and counts its hits and misses.
+    """
+
+    def __init__(self, maxsize):
+        """
+        :param maxsize: maximum number of entries kept
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Return the value for key and mark it as recently used, or return
+        default if key is not in the cache.
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Store value for key, evicting the least recently used entry if the
+        cache is full.
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove every entry. The hit and miss counters are kept.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        :return: a dict with the number of hits, misses and entries
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
@@ -35,11 +35,17 @@ def main():
         key = input("Enter the primary key that you want to see: ")
         request_url = '{}/{}/{}'.format(API_BASE_URL, web_page, key)
         response = requests.get(request_url)
+        content = response.json()
     elif ans == 'No':
         request_url = '{}/{}'.format(API_BASE_URL, web_page)
-        response = requests.get(request_url)
-
-    content = response.json()
+        content = []
+
+        # The collections are paginated; follow the Link header to the
+        # next page until there is none.
+        while request_url is not None:
+            response = requests.get(request_url)
+            content.extend(response.json())
+            request_url = response.links.get('next', {}).get('url')
 
     print("\nHere is the information.")
 
@@ -10,27 +10,390 @@ Note that this database is not real data.
 Written by Minhwa (Mina) Lee
 """
 
+import bisect
+import datetime
+import itertools
+import operator
 import os
+import pathlib
+import re
 import sqlite3
+import threading
+import time
 from collections import OrderedDict
+from contextlib import contextmanager
+
+from app_cache import LRUCache
+from app_metrics import InstrumentedConnection
+from app_migrations import MONTHS, get_version, migrate, month_order
+from app_records import Appointment, Doctor, Patient, Symptom
+
+# The fields of an appointment accepted by insert_apps_bulk, in the order of
+# the arguments of insert_app. An appointment may also have scheduled_at and
+# ends_at times.
+APP_FIELDS = ('FirstN', 'LastN', 'gender', 'age', 'birth', 'doctor', 'month',
+              'symptom')
+
+# The range of the times parse_time accepts, from year 1 to year 9999, in
+# seconds since the epoch.
+MIN_TIME = -62135596800
+MAX_TIME = 253402300799
+
+# Length in seconds of the appointments given a scheduled_at time but no
+# ends_at time.
+APP_DURATION = 30 * 60
+
+# Number of keys looked up per statement, which keeps the bound parameters
+# well under SQLite's limit.
+LOOKUP_BATCH = 400
+
+_get_app_fields = operator.itemgetter(*APP_FIELDS)
+_SCALAR_TYPES = {str, int, float}
+
+# Maximum number of name -> primary key entries cached for each table.
+NAME_CACHE_SIZES = {'doctors': 1024, 'symptoms': 1024, 'patients': 65536}
+
+# The filters accepted by get_apps_page and iter_all_apps, and the condition
+# each adds to the query. Doctors and symptoms are given by name and looked
+# up once, so that the app indexes on doctor_id and symptom_id are used.
+# The conditions are on the columns of the app_details view, which are also
+# the columns of app and patients joined by get_app_stats.
+APP_FILTERS = {
+    'doctor': 'doctor_id = (SELECT doctor_id FROM doctors WHERE doctor = ?)',
+    'month': 'month = ?',
+    'symptom': 'symptom_id = '
+               '(SELECT symptom_id FROM symptoms WHERE symptom = ?)',
+    'patient_id': 'patient_id = ?',
+    'age_min': 'age >= ?',
+    'age_max': 'age <= ?',
+    'gender': 'gender = ?',
+    # A range of times is read from idx_app_scheduled; 'to' is exclusive.
+    'from': 'scheduled_at >= ?',
+    'to': 'scheduled_at < ?'}
+
+# The filters on columns of the patients table.
+_PATIENT_FILTERS = frozenset(['age_min', 'age_max', 'gender'])
+
+# The orders accepted by get_apps_page and iter_all_apps, and the column
+# of app_details each sorts by. Appointments with equal values are in order
+# of app_id.
+APP_SORT_KEYS = {'app_id': 'app_id', 'doctor': 'doctor',
+                 'symptom': 'symptom', 'age': 'age', 'FirstN': 'FirstN',
+                 'LastN': 'LastN', 'scheduled_at': 'scheduled_at'}
+
+# The dimensions get_app_stats can group appointments by, the expression
+# each groups by, and the table and column that name the groups of doctors
+# and symptoms. Ages are grouped in buckets, named by the lowest age in the
+# bucket.
+STAT_DIMENSIONS = {'doctor': ('app.doctor_id', 'doctors', 'doctor'),
+                   'month': ('app.month', None, None),
+                   'symptom': ('app.symptom_id', 'symptoms', 'symptom'),
+                   'gender': ('patients.gender', None, None),
+                   'age': ('patients.age / {0:d} * {0:d}', None, None)}
+
+# The appointments, with the columns of Appointment, from the app_details
+# view of app joined with patients, doctors and symptoms.
+_APP_SELECT = 'SELECT {} FROM app_details'.format(
+    ', '.join(Appointment.__slots__))
+
+# The statements of the read methods that run with every request. Each is
+# one constant string, so it is compiled once per connection and then found
+# in the connection's statement cache.
+QUERIES = {
+    'app_by_id': _APP_SELECT + ' WHERE app_id = ?',
+    'all_apps': _APP_SELECT,
+    # Read in the order of idx_app_doctor_month and idx_app_month_patient.
+    'apps_by_doctor_id': _APP_SELECT + ' WHERE doctor_id = ? ORDER BY {}, '
+                                       'month, patient_id LIMIT ?'.format(
+                                           month_order('month')),
+    'apps_by_month': _APP_SELECT + ' WHERE month = ? '
+                                   'ORDER BY patient_id LIMIT ?',
+    # Range scans of idx_app_scheduled and idx_app_doctor_scheduled, whose
+    # entries end with app_id, so the order needs no sorting.
+    'apps_between': _APP_SELECT + ' WHERE scheduled_at >= ? '
+                                  'AND scheduled_at < ? '
+                                  'ORDER BY scheduled_at, app_id LIMIT ?',
+    'doctor_apps_between': _APP_SELECT + ' WHERE doctor_id = ? '
+                                         'AND scheduled_at >= ? '
+                                         'AND scheduled_at < ? '
+                                         'ORDER BY scheduled_at, app_id '
+                                         'LIMIT ?',
+    # The appointments of a doctor that hold a slot, read from
+    # idx_app_doctor_slots. The slots of a doctor don't overlap, so they end
+    # in the same order as they start.
+    'doctor_slot_before': 'SELECT app_id, scheduled_at, ends_at FROM app '
+                          'WHERE doctor_id = ? AND ends_at IS NOT NULL '
+                          'AND scheduled_at < ? '
+                          'ORDER BY scheduled_at DESC LIMIT 1',
+    'doctor_slots_from': 'SELECT scheduled_at, ends_at FROM app '
+                         'WHERE doctor_id = ? AND ends_at IS NOT NULL '
+                         'AND scheduled_at >= ? ORDER BY scheduled_at',
+    'app_counts_by_day': 'SELECT scheduled_at - scheduled_at % 86400 AS day, '
+                         'COUNT(*) AS app_count FROM app '
+                         'WHERE scheduled_at >= ? AND scheduled_at < ? '
+                         'GROUP BY day ORDER BY day',
+    'patient_by_id': 'SELECT patient_id, FirstN, LastN, gender, age, birth '
+                     'FROM patients WHERE patient_id = ?',
+    'patient_by_name': 'SELECT patient_id, FirstN, LastN, gender, age, '
+                       'birth FROM patients WHERE FirstN = ? AND LastN = ?',
+    'doctor_by_id': 'SELECT doctor_id, doctor FROM doctors '
+                    'WHERE doctor_id = ?',
+    'doctor_by_name': 'SELECT doctor_id, doctor FROM doctors '
+                      'WHERE doctor = ?',
+    'symptom_by_id': 'SELECT symptom_id, symptom FROM symptoms '
+                     'WHERE symptom_id = ?',
+    'symptom_by_name': 'SELECT symptom_id, symptom FROM symptoms '
+                       'WHERE symptom = ?'}
+
+# Number of compiled statements each connection keeps, instead of sqlite3's
+# default of 128: the filters and orders of the appointment queries, the
+# search and the statistics make several hundred different statements.
+STATEMENT_CACHE_SIZE = 512
+
+# The records returned by search() for each kind of result, their columns,
+# and the name columns whose lengths break ties between equally ranked
+# matches.
+SEARCH_RECORDS = {'patients': Patient, 'doctors': Doctor,
+                  'symptoms': Symptom}
+SEARCH_COLUMNS = {kind: record.__slots__
+                  for kind, record in SEARCH_RECORDS.items()}
+_SEARCH_NAMES = {'patients': ('FirstN', 'LastN'), 'doctors': ('doctor',),
+                 'symptoms': ('symptom',)}
+
+_name_caches = {}
+_name_caches_lock = threading.Lock()
+
+
+class NameCaches(dict):
+    """
+    The name -> primary key caches of a database file: a dict mapping
+    table names to LRUCache objects, which also remembers the data version
+    of each table that its cached keys are valid for.
+
+    Row ids of deleted rows are reused, so a key cached before another
+    process deleted the row may now belong to a different row. Every write
+    transaction compares the data versions with the remembered ones before
+    it uses the caches, and empties the caches of the tables that changed.
+    """
+
+    def __init__(self):
+        super().__init__((table, LRUCache(size))
+                         for table, size in NAME_CACHE_SIZES.items())
+        self.versions = {}
+        self._lock = threading.Lock()
+
+    def validate(self, versions):
+        """
+        Empty the caches of the tables whose data version is not the
+        remembered one, and remember the given versions.
+
+        :param versions: dict mapping table names to their current data
+        versions, read with the write lock held
+        """
+        with self._lock:
+            for table, version in versions.items():
+                if self.versions.get(table) != version:
+                    self[table].clear()
+                    self.versions[table] = version
+
+    def publish(self, entries, before, after):
+        """
+        Cache the primary keys learned by a transaction that has committed.
+
+        The keys of a table are only cached if no transaction of another
+        process has written to it since, that is, if its remembered version
+        is the one the transaction started or ended with.
+
+        :param entries: list of (table, key, row_id) tuples, in the order
+        they were learned; a key of None marks a delete from the table,
+        after which the keys learned before it are not cached
+        :param before: dict mapping table names to their data versions when
+        the transaction started
+        :param after: dict mapping table names to their data versions when
+        the transaction committed
+        """
+        with self._lock:
+            current = set()
+
+            for table, version in after.items():
+                if self.versions.get(table) in (before[table], version):
+                    self.versions[table] = version
+                    current.add(table)
+
+            deleted = set()
+
+            for table, key, row_id in reversed(entries):
+                if key is None:
+                    deleted.add(table)
+                elif table in current and table not in deleted:
+                    self[table].put(key, row_id)
+
+
+def get_name_caches(sqlite_filename):
+    """
+    Return the name -> primary key caches for a database file. They are
+    shared by every AppointmentDatabase for that file in this process, so
+    that a delete through one of them invalidates the others too.
+
+    :param sqlite_filename: the name of the SQLite database file
+    :return: a NameCaches object
+    """
+    key = os.path.abspath(sqlite_filename)
+
+    with _name_caches_lock:
+        if key not in _name_caches:
+            _name_caches[key] = NameCaches()
+
+        return _name_caches[key]
+
+
+class AppointmentConflict(Exception):
+    """
+    Raised when an appointment would overlap another appointment of the
+    same doctor.
+    """
+
+    def __init__(self, app_id):
+        super().__init__(app_id)
+        self.app_id = app_id
+
+    def __str__(self):
+        return 'the doctor has appointment {} at that time'.format(
+            self.app_id)
+
+
+def is_foreign_key_error(error):
+    """
+    :param error: an sqlite3.IntegrityError
+    :return: True if the error is a foreign key constraint failure
+    """
+    return 'FOREIGN KEY' in str(error)
+
+
+def fts_query(text, prefix=True):
+    """
+    Turn the text typed into a search box into an FTS5 query that matches
+    the rows containing each word of the text, or a word starting with it.
+
+    Only the letters and digits of the text are used, so it can't contain
+    FTS5 syntax.
+
+    :param text: the search text, e.g. 'mi le'
+    :param prefix: True to match the words starting with each word
+    :return: the FTS5 query, e.g. '"mi"* "le"*', or None if the text has
+    no words
+    """
+    words = re.findall(r'\w+', text)
+
+    if not words:
+        return None
+
+    return ' '.join('"{}"{}'.format(word, '*' if prefix else '')
+                    for word in words)
 
 
 # Referenced from Professor Sommer's code
-def row_to_dict_or_none(cur):
+def row_to_record_or_none(cur, record):
     """
     Given a cursor that has just been used to execute a query, try to fetch one
     row. If the there is no row to fetch, return None, otherwise return a
-    dictionary representation of the row.
+    record of the row.
 
     :param cur: a cursor that has just been used to execute a query
-    :return: a dict representation of the next row, or None
+    :param record: the Record class of the row, whose fields are in the
+    order of the columns of the query
+    :return: a record of the next row, or None
     """
     row = cur.fetchone()
 
     if row is None:
         return None
     else:
-        return dict(row)
+        return record(*row)
+
+
+def fetch_records(cur, record, size=None):
+    """
+    Fetch the remaining rows of a cursor, or at most size of them, as
+    records built by record.from_rows. They are fetched as plain tuples,
+    which are faster to build than sqlite3.Row objects.
+
+    :param cur: a cursor that has just been used to execute a query
+    :param record: the Record class of the rows, whose fields are in the
+    order of the columns of the query
+    :param size: maximum number of rows to fetch, or None for all of them
+    :return: a list of records
+    """
+    cur.row_factory = None
+    rows = cur.fetchall() if size is None else cur.fetchmany(size)
+
+    return record.from_rows(rows)
+
+
+def parse_time(value):
+    """
+    Convert a time to seconds since the epoch.
+
+    :param value: seconds since the epoch, as a number or a string of
+    digits, or an ISO 8601 date or date and time, e.g. '2024-04-01' or
+    '2024-04-01T09:30:00+09:00'; a time without a time zone is in UTC
+    :return: the time in whole seconds since the epoch
+    :raises ValueError: if value is not a time between MIN_TIME and MAX_TIME
+    """
+    if isinstance(value, bool):
+        raise ValueError('not a time: {!r}'.format(value))
+
+    try:
+        if isinstance(value, (int, float)):
+            seconds = int(value)
+        elif re.fullmatch(r'\s*[+-]?\d+\s*', str(value)):
+            seconds = int(value)
+        else:
+            moment = datetime.datetime.fromisoformat(str(value).strip())
+
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=datetime.timezone.utc)
+
+            seconds = int(moment.timestamp())
+    except (OverflowError, ValueError):
+        raise ValueError('not a time: {!r}'.format(value))
+
+    if not MIN_TIME <= seconds <= MAX_TIME:
+        raise ValueError('time out of range: {!r}'.format(value))
+
+    return seconds
+
+
+def schedule(month, scheduled_at, ends_at=None):
+    """
+    :param month: the month of an appointment
+    :param scheduled_at: the time of the appointment as accepted by
+    parse_time, or None if only the month is known
+    :param ends_at: the end of the appointment as accepted by parse_time,
+    or None for APP_DURATION after scheduled_at
+    :return: (month, scheduled_at, ends_at) to store for the appointment.
+    The month of a time is the name of its month in UTC. An appointment
+    with only a month has no times, so it is in no range of times and
+    holds no slot.
+    :raises ValueError: if a time is invalid, or ends_at is not after
+    scheduled_at
+    """
+    if scheduled_at is None:
+        if ends_at is not None:
+            raise ValueError('ends_at requires scheduled_at')
+
+        return month, None, None
+
+    scheduled_at = parse_time(scheduled_at)
+    moment = datetime.datetime(1970, 1, 1) + datetime.timedelta(
+        seconds=scheduled_at)
+
+    if ends_at is None:
+        ends_at = scheduled_at + APP_DURATION
+    elif parse_time(ends_at) <= scheduled_at:
+        raise ValueError('ends_at must be after scheduled_at')
+
+    return MONTHS[moment.month - 1], scheduled_at, parse_time(ends_at)
 
 
 class AppointmentDatabase:
@@ -39,29 +402,111 @@ class AppointmentDatabase:
     appointments and other related information into an SQLite database.
     """
 
-    def __init__(self, sqlite_filename):
+    def __init__(self, sqlite_filename, metrics=None, slow_log=None,
+                 read_only=False):
         """
         Creates a connection to the database, and creates tables if the
-        database file did not exist prior to object creation.
+        database file did not exist prior to object creation. The schema is
+        then migrated to the latest version; the migrations that were
+        applied are kept in self.migrations_applied, and the version of the
+        schema (its PRAGMA user_version) in self.schema_version.
+
+        A read-only connection neither creates nor migrates the database,
+        which must already exist and be up to date, and every write through
+        it fails with sqlite3.OperationalError.
 
         :param sqlite_filename: the name of the SQLite database file
+        :param metrics: optional MetricsRegistry that every statement,
+        commit and rollback of the connection is reported to
+        :param slow_log: optional SlowQueryLog that statements slower than
+        its threshold are written to
+        :param read_only: True to open the database read-only
         """
-        if os.path.isfile(sqlite_filename):
+        if os.path.isfile(sqlite_filename) or read_only:
             create_tables = False
         else:
             create_tables = True
 
-        self.conn = sqlite3.connect(sqlite_filename)
+        if read_only:
+            database = pathlib.Path(os.path.abspath(sqlite_filename)).as_uri()
+            database += '?mode=ro'
+        else:
+            database = sqlite_filename
+
+        # The connection may be handed between request threads by
+        # AppointmentDatabasePool, but it is only used by one at a time.
+        if metrics is None and slow_log is None:
+            self.conn = sqlite3.connect(
+                database, check_same_thread=False, uri=read_only,
+                cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            self.conn = sqlite3.connect(
+                database, check_same_thread=False, uri=read_only,
+                cached_statements=STATEMENT_CACHE_SIZE,
+                factory=InstrumentedConnection)
+            self.conn.metrics = metrics
+            self.conn.slow_log = slow_log
+        self.metrics = metrics
+        self.slow_log = slow_log
+        self.read_only = read_only
         self.conn.row_factory = sqlite3.Row
+        self._transaction_depth = 0
+
+        self._name_caches = get_name_caches(sqlite_filename)
+        # Primary keys learned during a transaction are only cached once it
+        # commits, since a rolled back row id can be reused by another row.
+        self._pending_cache = []
+        # Data versions of the cached tables when the current transaction
+        # started.
+        self._name_versions = {}
+        # Tables written in the current transaction, whose data versions
+        # are bumped when it commits.
+        self._dirty_tables = set()
 
         cur = self.conn.cursor()
         cur.execute('PRAGMA foreign_keys = 1')
+
+        if read_only:
+            self.migrations_applied = []
+            self.schema_version = get_version(self.conn)
+            return
+
         cur.execute('PRAGMA journal_mode = WAL')
         cur.execute('PRAGMA synchronous = NORMAL')
 
         if create_tables:
             self.create_tables()
 
+        self.migrations_applied = migrate(self.conn)
+        self.schema_version = get_version(self.conn)
+
+    def close(self):
+        """
+        Close the connection to the database.
+        """
+        self.conn.close()
+
+    def _iter_query(self, query, batch_size, record, parameters=()):
+        """
+        Run a query and yield its result as lists of at most batch_size
+        records, so that the whole result never has to be in memory.
+
+        :param query: the query to run
+        :param batch_size: number of rows to fetch at a time
+        :param record: the Record class of the rows
+        :param parameters: the parameters of the query
+        """
+        cur = self.conn.cursor()
+        cur.execute(query, parameters)
+
+        while True:
+            rows = fetch_records(cur, record, batch_size)
+
+            if not rows:
+                break
+
+            yield rows
+
     def create_tables(self):
         """
         Create the tables for appointment information.
@@ -87,14 +532,227 @@ class AppointmentDatabase:
 
         self.conn.commit()
 
+    @contextmanager
+    def _transaction(self):
+        """
+        Run the body of a with statement in a single write transaction and
+        commit it at the end, or roll it back if an exception is raised.
+
+        Nested uses join the enclosing transaction through a savepoint, so
+        only the outermost one commits.
+
+        :return: a cursor to run the statements with
+        """
+        if self._transaction_depth == 0:
+            if not self.conn.in_transaction:
+                # IMMEDIATE takes the write lock up front, so a read in the
+                # transaction can't later fail to upgrade to a write.
+                self.conn.execute('BEGIN IMMEDIATE')
+
+            self._name_versions = dict(zip(
+                NAME_CACHE_SIZES,
+                (version for version, _ in
+                 self.get_data_versions(NAME_CACHE_SIZES))))
+            self._name_caches.validate(self._name_versions)
+        else:
+            self.conn.execute('SAVEPOINT nested')
+
+        self._transaction_depth += 1
+        pending_mark = len(self._pending_cache)
+
+        try:
+            yield self.conn.cursor()
+        except BaseException:
+            self._transaction_depth -= 1
+            del self._pending_cache[pending_mark:]
+
+            if self._transaction_depth == 0:
+                self._dirty_tables.clear()
+                self.conn.rollback()
+            else:
+                self.conn.execute('ROLLBACK TO nested')
+                self.conn.execute('RELEASE nested')
+            raise
+        else:
+            self._transaction_depth -= 1
+
+            if self._transaction_depth == 0:
+                pending = self._pending_cache[:]
+                del self._pending_cache[:]
+                after = {table: version + (table in self._dirty_tables)
+                         for table, version in self._name_versions.items()}
+
+                try:
+                    self._bump_data_versions()
+                    self.conn.commit()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+                finally:
+                    self._dirty_tables.clear()
+
+                self._name_caches.publish(pending, self._name_versions, after)
+            else:
+                self.conn.execute('RELEASE nested')
+
+    def _touch(self, *tables):
+        """
+        Record that the current transaction writes to the given tables, so
+        that their data versions are bumped when it commits.
+
+        :param tables: names of the tables written
+        """
+        self._dirty_tables.update(tables)
+
+    def _bump_data_versions(self):
+        """
+        Increment the data version of every table written in the current
+        transaction. Called just before the transaction commits.
+        """
+        if not self._dirty_tables:
+            return
+
+        tables = sorted(self._dirty_tables)
+        query = ('UPDATE data_versions SET version = version + 1, '
+                 'modified_at = ? WHERE name IN ({})'.format(
+                     ', '.join('?' * len(tables))))
+        self.conn.execute(query, [time.time()] + tables)
+
+    def get_data_versions(self, tables):
+        """
+        Return the data versions of the given tables. A table's version
+        changes every time a transaction of AppointmentDatabase that writes
+        to it commits, so it can be used to tell whether anything read from
+        the table may have changed.
+
+        :param tables: iterable of table names
+        :return: list of (version, modified_at) pairs, where modified_at is
+        the time of the last change in seconds since the epoch, in the same
+        order as tables
+        """
+        tables = list(tables)
+
+        cur = self.conn.cursor()
+        cur.execute('SELECT name, version, modified_at FROM data_versions '
+                    'WHERE name IN ({})'.format(', '.join('?' * len(tables))),
+                    tables)
+        versions = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+        return [versions[table] for table in tables]
+
+    def cache_stats(self):
+        """
+        Return the hit and miss counters and sizes of the name -> primary
+        key caches used to resolve doctors, symptoms and patients.
+
+        :return: dict mapping table names to dicts of statistics
+        """
+        return {table: cache.stats()
+                for table, cache in self._name_caches.items()}
+
+    def clear_name_caches(self):
+        """
+        Empty the name -> primary key caches.
+        """
+        for cache in self._name_caches.values():
+            cache.clear()
+
+    def _doctor_id(self, cur, doctor):
+        """
+        Return the primary key of the doctor with the given name, inserting
+        the doctor first if necessary. Does not commit.
+        """
+        doctor_id = self._name_caches['doctors'].get((doctor,))
+        if doctor_id is not None:
+            return doctor_id
+
+        cur.execute('SELECT doctor_id FROM doctors WHERE doctor = ?',
+                    (doctor,))
+        row = cur.fetchone()
+
+        if row is None:
+            cur.execute('INSERT INTO doctors(doctor) VALUES(?) '
+                        'RETURNING doctor_id', (doctor,))
+            row = cur.fetchone()
+            self._touch('doctors')
+
+        self._pending_cache.append(('doctors', (doctor,), row[0]))
+        return row[0]
+
+    def _symptom_id(self, cur, symptom):
+        """
+        Return the primary key of the symptom with the given name, inserting
+        the symptom first if necessary. Does not commit.
+        """
+        symptom_id = self._name_caches['symptoms'].get((symptom,))
+        if symptom_id is not None:
+            return symptom_id
+
+        cur.execute('SELECT symptom_id FROM symptoms WHERE symptom = ?',
+                    (symptom,))
+        row = cur.fetchone()
+
+        if row is None:
+            cur.execute('INSERT INTO symptoms(symptom) VALUES(?) '
+                        'RETURNING symptom_id', (symptom,))
+            row = cur.fetchone()
+            self._touch('symptoms')
+
+        self._pending_cache.append(('symptoms', (symptom,), row[0]))
+        return row[0]
+
+    def _patient_id(self, cur, patient_first, patient_last, gender, age,
+                    birth):
+        """
+        Return the primary key of the patient with the given first and last
+        name, inserting the patient first if necessary. Does not commit.
+
+        Raises sqlite3.IntegrityError if the patient can't be inserted
+        because another patient already has the same first or last name.
+        """
+        key = (patient_first, patient_last)
+
+        patient_id = self._name_caches['patients'].get(key)
+        if patient_id is not None:
+            return patient_id
+
+        cur.execute('SELECT patient_id FROM patients '
+                    'WHERE FirstN = ? and LastN = ?',
+                    (patient_first, patient_last))
+        row = cur.fetchone()
+
+        if row is None:
+            cur.execute('INSERT OR IGNORE INTO patients(FirstN, LastN, '
+                        'gender, age, birth) VALUES(?, ?, ?, ?, ?) '
+                        'RETURNING patient_id',
+                        (patient_first, patient_last, gender, age, birth))
+            row = cur.fetchone()
+            self._touch('patients')
+
+        if row is None:
+            raise sqlite3.IntegrityError(
+                'patient {} {} conflicts with an existing patient'.format(
+                    patient_first, patient_last))
+
+        self._pending_cache.append(('patients', key, row[0]))
+        return row[0]
+
     def insert_app(self, patient_first, patient_last, gender, age, birth,
-                   doctor, month, symptom):
+                   doctor, month, symptom, scheduled_at=None, ends_at=None):
         """
         Inserts an appointment into the database.
         If any foreign key elements are not already in the database,
         then inserts those information.
 
-        Returns a dictionary representation of the appointment.
+        With scheduled_at, the month is that of scheduled_at, and the
+        appointment holds the doctor's slot until ends_at; an appointment
+        that would overlap another slot of the doctor is not inserted.
+        Without it, the appointment only has a month, with no times, and
+        holds no slot.
+
+        Everything is written in one transaction with a single commit.
+
+        Returns a record of the appointment.
 
         :param patient_first: first name of the patient of that appointment
         :param patient_last: last name of the patient of that appointment
@@ -104,85 +762,776 @@ class AppointmentDatabase:
         :param doctor: the first name of doctor assigned to the appointment
         :param month: month of the appointment
         :param symptom: the name of symptom that the patient suffers from
-        :return: a dictionary representation of the appointment.
+        :param scheduled_at: time of the appointment as accepted by
+        parse_time, or None
+        :param ends_at: end of the appointment as accepted by parse_time,
+        or None for APP_DURATION after scheduled_at
+        :return: an Appointment record of the appointment.
+        :raises AppointmentConflict: if the doctor is booked at that time
+        :raises ValueError: if a time is invalid
+        """
+        when = schedule(month, scheduled_at, ends_at)
+
+        try:
+            return self._insert_app(patient_first, patient_last, gender, age,
+                                    birth, doctor, symptom, when)
+        except sqlite3.IntegrityError as error:
+            if not is_foreign_key_error(error):
+                raise
+
+            # A cached primary key may belong to a row deleted by another
+            # process; look everything up again.
+            self.clear_name_caches()
+            return self._insert_app(patient_first, patient_last, gender, age,
+                                    birth, doctor, symptom, when)
+
+    def _insert_app(self, patient_first, patient_last, gender, age, birth,
+                    doctor, symptom, when):
+        """
+        Implements insert_app. when is the (month, scheduled_at, ends_at)
+        of the appointment.
         """
+        with self._transaction() as cur:
+            doctor_id = self._doctor_id(cur, doctor)
+            symptom_id = self._symptom_id(cur, symptom)
+            patient_id = self._patient_id(cur, patient_first, patient_last,
+                                          gender, age, birth)
 
-        cur = self.conn.cursor()
+            month, scheduled_at, ends_at = when
 
-        self.insert_doctor(doctor)
-        self.insert_symptoms(symptom)
-        self.insert_patient(patient_first, patient_last, gender, age, birth)
+            if ends_at is not None:
+                conflict = self._find_conflict(cur, doctor_id, scheduled_at,
+                                               ends_at)
+                if conflict is not None:
+                    raise AppointmentConflict(conflict)
 
-        doctor_dict = self.get_doctor_by_name(doctor)
-        doctor_id = doctor_dict['doctor_id']
+            query = ('INSERT INTO app(patient_id, doctor_id, month, '
+                     'symptom_id, scheduled_at, ends_at) '
+                     'VALUES(?, ?, ?, ?, ?, ?)')
 
-        symp_dict = self.get_symptoms_by_name(symptom)
-        symptom_id = symp_dict['symptom_id']
+            cur.execute(query, (patient_id, doctor_id, month, symptom_id,
+                                scheduled_at, ends_at))
+            self._touch('app')
 
-        patient_dict = self.get_patient_by_name(patient_first, patient_last)
-        patient_id = patient_dict['patient_id']
+            return self.get_app_by_id(cur.lastrowid)
 
-        query = ('INSERT INTO app(patient_id, doctor_id, month, symptom_id)'
-                 'VALUES(?, ?, ?, ?)')
+    def _find_conflict(self, cur, doctor_id, start, end):
+        """
+        Find an appointment of a doctor that overlaps the time from start
+        up to end. As the doctor's slots don't overlap, only the last one
+        to start before end can, so this is a single lookup in
+        idx_app_doctor_slots.
 
-        cur.execute(query, (patient_id, doctor_id, month, symptom_id))
-        self.conn.commit()
+        :return: the app_id of the appointment, or None if there is none
+        """
+        cur.execute(QUERIES['doctor_slot_before'], (doctor_id, end))
+        row = cur.fetchone()
+
+        if row is not None and row[2] > start:
+            return row[0]
+
+        return None
+
+    def _lookup_ids(self, cur, table, id_column, columns, keys):
+        """
+        Look up the primary keys of many rows at once.
+
+        :param cur: the cursor to use
+        :param table: name of the table
+        :param id_column: name of the table's primary key
+        :param columns: tuple of the columns that identify a row
+        :param keys: iterable of tuples of values for those columns
+        :return: dict mapping each key tuple found to its primary key
+        """
+        cache = self._name_caches[table]
+        found = {}
+        missing = []
+
+        for key in keys:
+            row_id = cache.get(key)
+
+            if row_id is None:
+                missing.append(key)
+            else:
+                found[key] = row_id
 
-        return self.get_app_by_id(cur.lastrowid)
+        keys = missing
+
+        match = ' AND '.join('{0}.{1} = wanted.{1}'.format(table, column)
+                             for column in columns)
+        selected = ', '.join('{}.{}'.format(table, column)
+                             for column in columns)
+
+        for start in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[start:start + LOOKUP_BATCH]
+            values = ', '.join(['({})'.format(
+                ', '.join('?' * len(columns)))] * len(batch))
+
+            query = ('WITH wanted({}) AS (VALUES {}) '
+                     'SELECT {}.{}, {} FROM wanted JOIN {} ON {}').format(
+                ', '.join(columns), values, table, id_column, selected,
+                table, match)
+
+            cur.execute(query, list(itertools.chain.from_iterable(batch)))
+
+            for row in cur.fetchall():
+                key = tuple(row[1:])
+                found[key] = row[0]
+                self._pending_cache.append((table, key, row[0]))
+
+        return found
+
+    def _insert_apps_chunk(self, chunk):
+        """
+        Insert one chunk of (index, appointment) pairs in a single
+        transaction, and return the per-row results.
+        """
+        results = []
+        valid = []
+
+        for index, app in chunk:
+            try:
+                values = _get_app_fields(app)
+            except (KeyError, TypeError):
+                if not isinstance(app, dict):
+                    error = 'appointment must be an object'
+                else:
+                    missing = [field for field in APP_FIELDS
+                               if field not in app]
+                    error = 'parameter {} required'.format(missing[0])
+
+                results.append({'index': index, 'error': error})
+                continue
+
+            if not _SCALAR_TYPES.issuperset(map(type, values)):
+                invalid = [field for field, value in zip(APP_FIELDS, values)
+                           if type(value) not in _SCALAR_TYPES]
+                results.append({'index': index,
+                                'error': 'parameter {} must be a string or '
+                                         'a number'.format(invalid[0])})
+                continue
+
+            first, last, gender, age, birth, doctor, month, symptom = values
+
+            try:
+                when = schedule(month, app.get('scheduled_at'),
+                                app.get('ends_at'))
+            except ValueError as error:
+                results.append({'index': index, 'error': str(error)})
+                continue
+
+            # The name columns have TEXT affinity, so names are matched as
+            # strings.
+            valid.append((index, (str(first), str(last)), (gender, age, birth),
+                          (str(doctor),), when, (str(symptom),)))
+
+        if not valid:
+            return results
+
+        with self._transaction() as cur:
+            doctors = {doctor for _, _, _, doctor, _, _ in valid}
+            doctor_ids = self._lookup_ids(cur, 'doctors', 'doctor_id',
+                                          ('doctor',), doctors)
+            new_doctors = doctors - doctor_ids.keys()
+            if new_doctors:
+                cur.executemany('INSERT INTO doctors(doctor) VALUES(?)',
+                                new_doctors)
+                self._touch('doctors')
+                doctor_ids.update(self._lookup_ids(
+                    cur, 'doctors', 'doctor_id', ('doctor',), new_doctors))
+
+            symptoms = {symptom for _, _, _, _, _, symptom in valid}
+            symptom_ids = self._lookup_ids(cur, 'symptoms', 'symptom_id',
+                                           ('symptom',), symptoms)
+            new_symptoms = symptoms - symptom_ids.keys()
+            if new_symptoms:
+                cur.executemany('INSERT INTO symptoms(symptom) VALUES(?)',
+                                new_symptoms)
+                self._touch('symptoms')
+                symptom_ids.update(self._lookup_ids(
+                    cur, 'symptoms', 'symptom_id', ('symptom',),
+                    new_symptoms))
+
+            patients = {patient for _, patient, _, _, _, _ in valid}
+            patient_ids = self._lookup_ids(cur, 'patients', 'patient_id',
+                                           ('FirstN', 'LastN'), patients)
+            new_patients = patients - patient_ids.keys()
+            if new_patients:
+                # The first appointment of a new patient supplies the
+                # patient's details, as it would with insert_app.
+                details = OrderedDict()
+                for _, patient, patient_details, _, _, _ in valid:
+                    if patient in new_patients and patient not in details:
+                        details[patient] = patient_details
+
+                cur.executemany('INSERT OR IGNORE INTO patients(FirstN, '
+                                'LastN, gender, age, birth) '
+                                'VALUES(?, ?, ?, ?, ?)',
+                                [patient + patient_details for
+                                 patient, patient_details in details.items()])
+                self._touch('patients')
+                patient_ids.update(self._lookup_ids(
+                    cur, 'patients', 'patient_id', ('FirstN', 'LastN'),
+                    new_patients))
+
+            rows = []
+            # The input index of each row.
+            inserted = []
+            # The slots taken by this chunk so far, for each doctor, as
+            # sorted lists of (scheduled_at, ends_at, position in rows).
+            slots = {}
+            # The (index, position in rows) of the appointments that
+            # overlap an earlier one of the chunk, whose app_id isn't known
+            # until it is inserted.
+            overlaps = []
+
+            for index, patient, _, doctor, when, symptom in valid:
+                patient_id = patient_ids.get(patient)
+
+                if patient_id is None:
+                    results.append({'index': index,
+                                    'error': 'patient conflicts with an '
+                                             'existing patient'})
+                    continue
+
+                doctor_id = doctor_ids[doctor]
+                _, start, end = when
+
+                if end is not None:
+                    taken = slots.setdefault(doctor_id, [])
+                    position = bisect.bisect_left(taken, (end,))
+                    conflict = self._find_conflict(cur, doctor_id, start, end)
+
+                    if conflict is not None:
+                        results.append({'index': index, 'error': str(
+                            AppointmentConflict(conflict))})
+                        continue
+
+                    if position and taken[position - 1][1] > start:
+                        overlaps.append((index, taken[position - 1][2]))
+                        continue
+
+                    taken.insert(position, (start, end, len(rows)))
+
+                rows.append((patient_id, doctor_id) + when +
+                            (symptom_ids[symptom],))
+                inserted.append(index)
+
+            if rows:
+                # The counts of the chunk are added below, in one upsert
+                # per doctor and month.
+                cur.execute('INSERT INTO app_counts_deferred VALUES(1)')
+                cur.executemany('INSERT INTO app(patient_id, doctor_id, '
+                                'month, scheduled_at, ends_at, symptom_id) '
+                                'VALUES(?, ?, ?, ?, ?, ?)', rows)
+                cur.execute('DELETE FROM app_counts_deferred')
+                self._touch('app')
+
+                # SQLite gives each new row the largest app_id plus one,
+                # and the transaction holds the write lock, so the rows got
+                # consecutive app_ids ending with the last one inserted.
+                cur.execute('SELECT last_insert_rowid()')
+                first_id = cur.fetchone()[0] - len(rows) + 1
+
+                doctor_counts = {}
+                month_counts = {}
+                for _, doctor_id, month, _, _, _ in rows:
+                    doctor_counts[doctor_id] = \
+                        doctor_counts.get(doctor_id, 0) + 1
+                    month_counts[month] = month_counts.get(month, 0) + 1
+
+                cur.executemany('INSERT INTO app_doctor_counts(doctor_id, '
+                                'app_count) VALUES(?, ?) '
+                                'ON CONFLICT(doctor_id) DO UPDATE '
+                                'SET app_count = app_count + '
+                                'excluded.app_count', doctor_counts.items())
+                cur.executemany('INSERT INTO app_month_counts(month, '
+                                'app_count) VALUES(?, ?) '
+                                'ON CONFLICT(month) DO UPDATE '
+                                'SET app_count = app_count + '
+                                'excluded.app_count', month_counts.items())
+
+                results.extend({'index': index, 'app_id': first_id + position}
+                               for position, index in enumerate(inserted))
+                results.extend({'index': index, 'error': str(
+                    AppointmentConflict(first_id + position))}
+                    for index, position in overlaps)
+
+        results.sort(key=lambda result: result['index'])
+        return results
+
+    def insert_apps_bulk(self, apps, chunk_size=5000):
+        """
+        Insert many appointments. Doctors, symptoms and patients are
+        resolved with batched lookups, and the appointments are written with
+        executemany, one transaction per chunk of chunk_size appointments.
+
+        Each appointment is a dict with the keys in APP_FIELDS, and
+        optionally 'scheduled_at' and 'ends_at' as for insert_app.
+        Appointments that are invalid or overlap another slot of their
+        doctor, in the database or earlier in apps, are skipped and
+        reported, without affecting the others.
+
+        Returns one result per appointment, in order: a dict with the
+        appointment's 'index' in the input and either its new 'app_id' or
+        an 'error' message.
+
+        :param apps: iterable of dicts representing appointments
+        :param chunk_size: number of appointments per transaction
+        :return: list of dicts, the result for each appointment
+        """
+        results = []
+        numbered = enumerate(apps)
+
+        while True:
+            chunk = list(itertools.islice(numbered, chunk_size))
+            if not chunk:
+                break
+
+            try:
+                results.extend(self._insert_apps_chunk(chunk))
+            except sqlite3.IntegrityError as error:
+                if not is_foreign_key_error(error):
+                    raise
+
+                # See insert_app.
+                self.clear_name_caches()
+                results.extend(self._insert_apps_chunk(chunk))
+
+        return results
 
     def get_app_by_id(self, app_id):
         """
-        Provided an appointment's primary key, return a dictionary
-        representation of the appointment, or None if there's no appointment
+        Provided an appointment's primary key, return a record
+        of the appointment, or None if there's no appointment
         with that primary key in the database.
 
         :param app_id: the primary key of the appointment
-        :return: a dictionary of the patient
+        :return: an Appointment record
         """
 
         cur = self.conn.cursor()
-
-        query = ('SELECT patients.FirstN as FirstN, patients.LastN as LastN,  '
-                 'patients.gender as gender, patients.age as age, '
-                 'patients.birth as birth, doctors.doctor as doctor, '
-                 'app.month as month, app.app_id as app_id, '
-                 'symptoms.symptom as symptom '
-                 'FROM app, patients, doctors, symptoms '
-                 'WHERE app.patient_id = patients.patient_id '
-                 'AND app.doctor_id = doctors.doctor_id '
-                 'AND app.symptom_id = symptoms.symptom_id '
-                 'AND app.app_id = ?')
-
-        cur.execute(query, (app_id,))
-        return row_to_dict_or_none(cur)
+        cur.execute(QUERIES['app_by_id'], (app_id,))
+        return row_to_record_or_none(cur, Appointment)
 
     def get_all_apps(self):
         """
-        Return a list dictionaries representing all of the appointments in
+        Return a list of Appointment records of all of the appointments in
         the database.
 
-        :return: a list of dict objects representing appointments
+        :return: a list of Appointment records
         """
 
         cur = self.conn.cursor()
+        cur.execute(QUERIES['all_apps'])
+
+        return fetch_records(cur, Appointment)
 
-        query = ('SELECT patients.FirstN as FirstN, patients.LastN as LastN, '
-                 'patients.gender as gender, patients.age as age, '
-                 'patients.birth as birth, doctors.doctor as doctor, '
-                 'app.month as month, app.app_id as app_id, '
-                 'symptoms.symptom as symptom '
-                 'FROM app, patients, doctors, symptoms '
-                 'WHERE app.patient_id = patients.patient_id '
-                 'AND app.doctor_id = doctors.doctor_id '
-                 'AND app.symptom_id = symptoms.symptom_id ')
-
-        lst_apps = []
+    def _select_apps(self, filters=None, sort='app_id', after_id=0,
+                     after=None):
+        """
+        Build the query for the appointments that match every filter, in
+        the given order. Every condition is a bound parameter, never part
+        of the SQL text.
+
+        With after_id, the result starts after that appointment in the
+        given order, so the app_id of the last appointment of one page
+        continues to the next page whatever the order. For an order other
+        than app_id, its value of the sort key is looked up, so the
+        appointment must still exist; with after, the (value, app_id) pair
+        of the last appointment, it doesn't have to. The value may be None,
+        e.g. the scheduled_at of an appointment with only a month.
+
+        :param filters: dict mapping names of APP_FILTERS to their values
+        :param sort: a name of APP_SORT_KEYS, prefixed with '-' for
+        descending order
+        :param after_id: primary key of the appointment to start after, or
+        0 to start at the beginning
+        :param after: (value, app_id) pair of the sort key's value and the
+        primary key of the appointment to start after, or None
+        :return: (query, parameters) pair, without a LIMIT clause
+        """
+        descending = sort.startswith('-')
+        key = sort[1:] if descending else sort
+
+        if key not in APP_SORT_KEYS:
+            raise ValueError('unknown sort key {}'.format(key))
+
+        conditions = []
+        parameters = []
+
+        for name, value in (filters or {}).items():
+            if name not in APP_FILTERS:
+                raise ValueError('unknown filter {}'.format(name))
+
+            conditions.append(APP_FILTERS[name])
+            parameters.append(value)
+
+        column = APP_SORT_KEYS[key]
+        direction = 'DESC' if descending else 'ASC'
+
+        if key == 'app_id' and after is not None:
+            after_id = after[1]
+
+        if after_id and key == 'app_id':
+            conditions.append('app_id {} ?'.format(
+                '<' if descending else '>'))
+            parameters.append(after_id)
+        elif after_id or after is not None:
+            if after is None:
+                cur = self.conn.cursor()
+                cur.execute('SELECT {} FROM app_details '
+                            'WHERE app_id = ?'.format(column), (after_id,))
+                row = cur.fetchone()
+
+                if row is None:
+                    raise ValueError('no appointment {}'.format(after_id))
+
+                after = (row[0], after_id)
+
+            value, after_id = after
+
+            # NULL sorts first in ascending order and last in descending
+            # order, and compares to nothing.
+            if value is None and descending:
+                conditions.append('({} IS NULL AND app_id < ?)'.format(
+                    column))
+                parameters.append(after_id)
+            elif value is None:
+                conditions.append('({0} IS NOT NULL OR app_id > ?)'.format(
+                    column))
+                parameters.append(after_id)
+            elif descending:
+                conditions.append(
+                    '(({0}, app_id) < (?, ?) OR {0} IS NULL)'.format(column))
+                parameters.extend(after)
+            else:
+                conditions.append('({}, app_id) > (?, ?)'.format(column))
+                parameters.extend(after)
+
+        query = _APP_SELECT
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        query += ' ORDER BY {} {}'.format(column, direction)
+        if key != 'app_id':
+            query += ', app_id {}'.format(direction)
+
+        return query, parameters
+
+    def get_apps_page(self, limit, after_id=0, sort='app_id', filters=None,
+                      after=None):
+        """
+        Return a list of at most limit Appointment records of the
+        appointments that match filters, in the order given by sort,
+        starting after the appointment after_id. Pass the app_id of the
+        last appointment of one page as after_id to get the next page, or,
+        so that the next page doesn't depend on that appointment still
+        existing, its value of the sort key and its app_id as after.
+
+        :param limit: maximum number of appointments to return
+        :param after_id: primary key to start after
+        :param sort: a name of APP_SORT_KEYS, prefixed with '-' for
+        descending order
+        :param filters: dict mapping names of APP_FILTERS to their values,
+        e.g. {'doctor': 'Amy', 'age_min': 30}
+        :param after: (value, app_id) pair to start after instead of
+        after_id, e.g. ('Amy', 12) when sorted by doctor
+        :return: a list of Appointment records
+        :raises ValueError: if the appointment after_id doesn't exist and
+        is needed to find where to start
+        """
+
+        query, parameters = self._select_apps(filters, sort, after_id, after)
+
+        cur = self.conn.cursor()
+        cur.execute(query + ' LIMIT ?', parameters + [limit])
+
+        return fetch_records(cur, Appointment)
+
+    def iter_all_apps(self, batch_size=1000, sort='app_id', filters=None):
+        """
+        Yield all of the appointments in the database that match filters
+        as lists of at most batch_size records, in the order given by
+        sort.
+
+        :param batch_size: number of appointments to fetch at a time
+        :param sort: a name of APP_SORT_KEYS, prefixed with '-' for
+        descending order
+        :param filters: dict mapping names of APP_FILTERS to their values
+        :return: a generator of lists of Appointment records
+        """
+
+        query, parameters = self._select_apps(filters, sort)
+        return self._iter_query(query, batch_size, Appointment,
+                                parameters)
+
+    def get_app_counts_by_doctor(self):
+        """
+        Return a list of dictionaries with the number of appointments of
+        each doctor that has any, in alphabetical order of doctor. The
+        counts are read from the app_doctor_counts summary table.
+
+        :return: list of dicts with keys doctor_id, doctor and app_count
+        """
+        cur = self.conn.cursor()
+
+        query = ('SELECT doctors.doctor_id as doctor_id, '
+                 'doctors.doctor as doctor, '
+                 'app_doctor_counts.app_count as app_count '
+                 'FROM app_doctor_counts, doctors '
+                 'WHERE app_doctor_counts.doctor_id = doctors.doctor_id '
+                 'ORDER BY doctors.doctor')
         cur.execute(query)
 
-        for row in cur.fetchall():
-            lst_apps.append(dict(row))
+        return [dict(row) for row in cur.fetchall()]
+
+    def get_app_counts_by_month(self):
+        """
+        Return a list of dictionaries with the number of appointments in
+        each month that has any, in calendar order of month. The counts are
+        read from the app_month_counts summary table.
+
+        :return: list of dicts with keys month and app_count
+        """
+        cur = self.conn.cursor()
+
+        query = ('SELECT month, app_count FROM app_month_counts '
+                 'ORDER BY {}, month'.format(month_order('month')))
+        cur.execute(query)
+
+        return [dict(row) for row in cur.fetchall()]
+
+    def get_app_stats(self, by, filters=None, age_bucket=10):
+        """
+        Count the appointments that match filters, grouped by one
+        dimension of STAT_DIMENSIONS, or cross-tabulated by two.
+
+        The patients table is only joined to app if the dimensions or the
+        filters need it. Counts by doctor or by month alone, without
+        filters, are read from the summary tables.
+
+        :param by: list of one or two names of STAT_DIMENSIONS
+        :param filters: dict mapping names of APP_FILTERS to their values
+        :param age_bucket: the width in years of the age buckets
+        :return: list of dicts with a key for each dimension and app_count,
+        in order of the dimensions, months in calendar order
+        """
+        by = list(by)
+
+        if not 1 <= len(by) <= 2 or len(set(by)) != len(by):
+            raise ValueError('one or two different dimensions required')
+
+        for name in by:
+            if name not in STAT_DIMENSIONS:
+                raise ValueError('unknown dimension {}'.format(name))
+
+        if not filters and by == ['doctor']:
+            return [{'doctor': row['doctor'], 'app_count': row['app_count']}
+                    for row in self.get_app_counts_by_doctor()]
+
+        if not filters and by == ['month']:
+            return self.get_app_counts_by_month()
+
+        conditions = []
+        parameters = []
+
+        for name, value in (filters or {}).items():
+            if name not in APP_FILTERS:
+                raise ValueError('unknown filter {}'.format(name))
+
+            conditions.append(APP_FILTERS[name])
+            parameters.append(value)
+
+        columns = [STAT_DIMENSIONS[name][0].format(int(age_bucket))
+                   for name in by]
+
+        tables = 'app'
+        if 'patients.' in ' '.join(columns) or \
+                _PATIENT_FILTERS.intersection(filters or {}):
+            tables = 'app JOIN patients USING (patient_id)'
+
+        # The appointments are counted per doctor_id and symptom_id, and
+        # the names of the groups are only looked up afterwards, once per
+        # group, which also keeps the planner from driving the count from
+        # the doctors or symptoms table.
+        query = 'SELECT {}, COUNT(*) AS app_count FROM {}'.format(
+            ', '.join('{} AS {}'.format(column, name)
+                      for column, name in zip(columns, by)), tables)
+
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        positions = ', '.join(str(i) for i in range(1, len(by) + 1))
+        query += ' GROUP BY {}'.format(positions)
+
+        labels = []
+        tables = ['({}) g'.format(query)]
+        joins = []
+
+        for name in by:
+            _, table, column = STAT_DIMENSIONS[name]
+
+            if table is None:
+                labels.append('g.{0} AS {0}'.format(name))
+            else:
+                labels.append('{}.{} AS {}'.format(table, column, name))
+                tables.append(table)
+                joins.append('g.{} = {}.{}_id'.format(name, table, column))
+
+        query = 'SELECT {}, g.app_count AS app_count FROM {}'.format(
+            ', '.join(labels), ', '.join(tables))
+
+        if joins:
+            query += ' WHERE ' + ' AND '.join(joins)
+
+        # Months are in calendar order.
+        order = ['{}, {}'.format(month_order('g.month'), position)
+                 if name == 'month' else str(position)
+                 for position, name in enumerate(by, 1)]
+        query += ' ORDER BY {}'.format(', '.join(order))
+
+        cur = self.conn.cursor()
+        cur.execute(query, parameters)
+
+        return [dict(row) for row in cur.fetchall()]
+
+    def get_apps_by_doctor_id(self, doctor_id, limit=-1):
+        """
+        Return a list of Appointment records of the appointments of one
+        doctor, in calendar order of month. The appointments are read in the
+        order of the idx_app_doctor_month index, so only the rows returned
+        are read.
+
+        :param doctor_id: primary key of the doctor
+        :param limit: maximum number of appointments, or -1 for all
+        :return: a list of Appointment records
+        """
+        cur = self.conn.cursor()
+        cur.execute(QUERIES['apps_by_doctor_id'], (doctor_id, limit))
+
+        return fetch_records(cur, Appointment)
+
+    def get_apps_by_month(self, month, limit=-1):
+        """
+        Return a list of Appointment records of the appointments in one
+        month, ordered by patient. The appointments are read in the order of
+        the idx_app_month_patient index, so only the rows returned are read.
+
+        :param month: the month
+        :param limit: maximum number of appointments, or -1 for all
+        :return: a list of Appointment records
+        """
+        cur = self.conn.cursor()
+        cur.execute(QUERIES['apps_by_month'], (month, limit))
+
+        return fetch_records(cur, Appointment)
+
+    def get_apps_between(self, start, end, doctor_id=None, limit=-1):
+        """
+        Return a list of Appointment records of the appointments scheduled
+        from start up to but not including end, e.g. the next seven days,
+        in order of time. Only the index entries in the range are read, from
+        idx_app_scheduled, or idx_app_doctor_scheduled for one doctor.
+
+        :param start: time in seconds since the epoch
+        :param end: time in seconds since the epoch
+        :param doctor_id: primary key of a doctor, or None for all doctors
+        :param limit: maximum number of appointments, or -1 for all
+        :return: a list of Appointment records
+        """
+        cur = self.conn.cursor()
+
+        if doctor_id is None:
+            cur.execute(QUERIES['apps_between'], (start, end, limit))
+        else:
+            cur.execute(QUERIES['doctor_apps_between'],
+                        (doctor_id, start, end, limit))
+
+        return fetch_records(cur, Appointment)
+
+    def find_free_slot(self, doctor_id, start, duration=APP_DURATION,
+                       end=None):
+        """
+        Find the first time from start on when a doctor is free for
+        duration seconds. The doctor's slots are read in order from
+        idx_app_doctor_slots, starting at the one in progress at start, and
+        only until a gap long enough is found.
+
+        :param doctor_id: primary key of the doctor
+        :param start: time in seconds since the epoch to search from
+        :param duration: length of the slot in seconds
+        :param end: time by which the slot must end, or None for no limit
+        :return: the start of the free slot in seconds since the epoch, or
+        None if there is none before end
+        """
+        cur = self.conn.cursor()
+        cur.row_factory = None
+
+        cur.execute(QUERIES['doctor_slot_before'], (doctor_id, start))
+        row = cur.fetchone()
+        if row is not None:
+            start = max(start, row[2])
+
+        cur.execute(QUERIES['doctor_slots_from'], (doctor_id, start))
+        for scheduled_at, ends_at in cur:
+            if scheduled_at - start >= duration or \
+                    (end is not None and start + duration > end):
+                break
+
+            start = max(start, ends_at)
+
+        if end is not None and start + duration > end:
+            return None
+
+        return start
+
+    def get_app_counts_by_day(self, start, end):
+        """
+        Return the number of appointments of each day, in UTC, from start
+        up to but not including end, for a calendar. The counts are read
+        from the range of idx_app_scheduled alone.
+
+        :param start: time in seconds since the epoch
+        :param end: time in seconds since the epoch
+        :return: list of dicts with keys day (the start of the day in
+        seconds since the epoch) and app_count, for the days that have any
+        """
+        cur = self.conn.cursor()
+        cur.execute(QUERIES['app_counts_by_day'], (start, end))
+
+        return [dict(row) for row in cur.fetchall()]
+
+    def _delete_many(self, table, id_column, ids):
+        """
+        Delete the rows of a table whose primary key is in ids, in one
+        transaction. Deleting a patient, doctor or symptom deletes its
+        appointments too, by the ON DELETE CASCADE foreign keys of app.
+
+        :param table: the table to delete from
+        :param id_column: the primary key of the table
+        :param ids: iterable of primary keys
+        :return: number of rows deleted from table
+        """
+        ids = list(ids)
+        deleted = 0
+
+        with self._transaction() as cur:
+            for start in range(0, len(ids), LOOKUP_BATCH):
+                batch = ids[start:start + LOOKUP_BATCH]
+                cur.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+                    table, id_column, ', '.join('?' * len(batch))), batch)
+                deleted += cur.rowcount
 
-        return lst_apps
+            if deleted:
+                self._touch(*{'app', table})
+
+                if table in self._name_caches:
+                    # Keys learned earlier in the transaction may be of
+                    # deleted rows, whose ids can be reused.
+                    self._pending_cache.append((table, None, None))
+
+        return deleted
 
     def delete_app(self, app_id):
         """
@@ -190,13 +1539,17 @@ class AppointmentDatabase:
 
         :param app_id: primary key of the appointment
         """
+        self.delete_app_many([app_id])
 
-        cur = self.conn.cursor()
-
-        query = 'DELETE FROM app WHERE app_id = ?'
-        cur.execute(query, (app_id,))
+    def delete_app_many(self, app_ids):
+        """
+        Delete the appointments with the given primary keys, in one
+        transaction.
 
-        self.conn.commit()
+        :param app_ids: iterable of primary keys of appointments
+        :return: number of appointments deleted
+        """
+        return self._delete_many('app', 'app_id', app_ids)
 
     def insert_patient(self, patient_firstN, patient_lastN, gender, age,
                        birth):
@@ -210,237 +1563,378 @@ class AppointmentDatabase:
         :param gender: gender of the patient
         :param age: age of the patient
         :param birth: birth of the patient
-        :return: dict representing the patient
+        :return: a record of the patient
         """
 
-        cur = self.conn.cursor()
-        query = 'INSERT OR IGNORE INTO patients(FirstN, LastN, gender, age, ' \
-                'birth) VALUES(?, ?, ?, ?, ?)'
-        cur.execute(query, (patient_firstN, patient_lastN, gender, age, birth))
-        self.conn.commit()
+        with self._transaction() as cur:
+            query = 'INSERT OR IGNORE INTO patients(FirstN, LastN, gender, ' \
+                    'age, birth) VALUES(?, ?, ?, ?, ?)'
+            cur.execute(query, (patient_firstN, patient_lastN, gender, age,
+                                birth))
+            self._touch('patients')
+
         return self.get_patient_by_name(patient_firstN, patient_lastN)
 
     def get_all_patients(self):
         """
-        Get a list of dictionary representations of all the patients in the
+        Get a list of records of all the patients in the
         database.
 
-        :return: list of dicts representing all patients
+        :return: list of records of all patients
         """
         cur = self.conn.cursor()
 
-        query = 'SELECT * FROM patients'
+        query = 'SELECT patient_id, FirstN, LastN, gender, age, birth ' \
+                'FROM patients'
 
-        lst_patients = []
         cur.execute(query)
 
-        for row in cur.fetchall():
-            lst_patients.append(dict(row))
+        return fetch_records(cur, Patient)
+
+    def get_patients_page(self, limit, after_id=0):
+        """
+        Get a list of at most limit records of the
+        patients whose primary key is greater than after_id, in order of
+        primary key.
 
-        return lst_patients
+        :param limit: maximum number of patients to return
+        :param after_id: primary key to start after
+        :return: list of records of patients
+        """
+        cur = self.conn.cursor()
+
+        query = 'SELECT patient_id, FirstN, LastN, gender, age, birth ' \
+                'FROM patients WHERE patient_id > ? ' \
+                'ORDER BY patient_id LIMIT ?'
+        cur.execute(query, (after_id, limit))
+
+        return fetch_records(cur, Patient)
+
+    def iter_all_patients(self, batch_size=1000):
+        """
+        Yield all of the patients in the database as lists of at most
+        batch_size records, in order of primary key.
+
+        :param batch_size: number of patients to fetch at a time
+        :return: a generator of lists of records of patients
+        """
+        query = 'SELECT patient_id, FirstN, LastN, gender, age, birth ' \
+                'FROM patients ORDER BY patient_id'
+        return self._iter_query(query, batch_size, Patient)
 
     def get_patient_by_id(self, patient_id):
         """
-        Get a dictionary representation of the patient with the given primary
+        Get a record of the patient with the given primary
         key. Return None if the patient does not exist.
 
         :param patient_id: primary key of the patient
-        :return: a dictionary of the patient, or None
+        :return: a record of the patient, or None
         """
         cur = self.conn.cursor()
-        query = 'SELECT patient_id, FirstN, LastN, gender, age, birth ' \
-                'FROM patients WHERE patient_id = ?'
-        cur.execute(query, (patient_id,))
-        return row_to_dict_or_none(cur)
+        cur.execute(QUERIES['patient_by_id'], (patient_id,))
+        return row_to_record_or_none(cur, Patient)
 
     def get_patient_by_name(self, patient_firstN, patient_lastN):
         """
-        Get a dictionary representation of the patient with the given first
+        Get a record of the patient with the given first
         name and last name. Return None if the patient does not exist.
 
         :param patient_firstN: first name of the patient
         :param patient_lastN: first name of the patient
-        :return: a dictionary of the patient, or None
+        :return: a record of the patient, or None
         """
         cur = self.conn.cursor()
-        query = 'SELECT patient_id, FirstN, LastN, gender, age, birth ' \
-                'FROM patients WHERE FirstN = ? and LastN = ?'
-        cur.execute(query, (patient_firstN, patient_lastN,))
-        return row_to_dict_or_none(cur)
+        cur.execute(QUERIES['patient_by_name'],
+                    (patient_firstN, patient_lastN))
+        return row_to_record_or_none(cur, Patient)
 
     def delete_patient(self, patient_id):
         """
-        Delete the patient with the given primary id key.
+        Delete the patient with the given primary id key and their
+        appointments, and invalidate the cached patient primary keys.
 
         :param patient_id: primary key (id) of the patient
-
         """
+        self.delete_patient_many([patient_id])
 
-        cur = self.conn.cursor()
-
-        query1 = 'DELETE FROM app WHERE patient_id = ?'
-        query2 = 'DELETE FROM patients WHERE patient_id = ?'
+    def delete_patient_many(self, patient_ids):
+        """
+        Delete the patients with the given primary keys and their
+        appointments, in one transaction, and invalidate the cached patient
+        primary keys.
 
-        cur.execute(query1, (patient_id,))
-        cur.execute(query2, (patient_id,))
+        :param patient_ids: iterable of primary keys of patients
+        :return: number of patients deleted
+        """
+        deleted = self._delete_many('patients', 'patient_id', patient_ids)
+        self._name_caches['patients'].clear()
 
-        self.conn.commit()
+        return deleted
 
     def insert_doctor(self, doctor):
         """
         Insert a doctor into the database if it does not exist. Do nothing if
         there is already a doctor with the given name in the database.
 
-        Return a dict representation of the doctor.
+        Return a record of the doctor.
 
         :param  doctor: name of the doctor
-        :return: dict representing the doctor
+        :return: a record of the doctor
         """
-        cur = self.conn.cursor()
-        query = 'INSERT OR IGNORE INTO doctors(doctor) VALUES(?)'
-        cur.execute(query, (doctor,))
-        self.conn.commit()
+        with self._transaction() as cur:
+            query = 'INSERT OR IGNORE INTO doctors(doctor) VALUES(?)'
+            cur.execute(query, (doctor,))
+            self._touch('doctors')
+
         return self.get_doctor_by_name(doctor)
 
     def get_all_doctors(self):
         """
-        Get a list of dictionary representations of all the doctors in the
+        Get a list of records of all the doctors in the
         database.
 
-        :return: list of dicts representing all doctors
+        :return: list of records of all doctors
         """
         cur = self.conn.cursor()
 
-        query = 'SELECT * FROM doctors'
+        query = 'SELECT doctor_id, doctor FROM doctors'
 
-        lst_doctor = []
         cur.execute(query)
 
-        for row in cur.fetchall():
-            lst_doctor.append(dict(row))
+        return fetch_records(cur, Doctor)
+
+    def get_doctors_page(self, limit, after_id=0):
+        """
+        Get a list of at most limit records of the
+        doctors whose primary key is greater than after_id, in order of
+        primary key.
+
+        :param limit: maximum number of doctors to return
+        :param after_id: primary key to start after
+        :return: list of records of doctors
+        """
+        cur = self.conn.cursor()
+
+        query = 'SELECT doctor_id, doctor FROM doctors WHERE doctor_id > ? ' \
+                'ORDER BY doctor_id LIMIT ?'
+        cur.execute(query, (after_id, limit))
 
-        return lst_doctor
+        return fetch_records(cur, Doctor)
+
+    def iter_all_doctors(self, batch_size=1000):
+        """
+        Yield all of the doctors in the database as lists of at most
+        batch_size records, in order of primary key.
+
+        :param batch_size: number of doctors to fetch at a time
+        :return: a generator of lists of records of doctors
+        """
+        query = 'SELECT doctor_id, doctor FROM doctors ORDER BY doctor_id'
+        return self._iter_query(query, batch_size, Doctor)
 
     def get_doctor_by_id(self, doctor_id):
         """
-        Get a dictionary representation of the doctor with the given primary
+        Get a record of the doctor with the given primary
         key. Return None if the doctor does not exist.
 
         :param doctor_id: primary key of the doctor
-        :return: a dictionary of the doctor, or None
+        :return: a record of the doctor, or None
         """
         cur = self.conn.cursor()
-        query = 'SELECT doctor_id, doctor FROM doctors WHERE doctor_id = ?'
-        cur.execute(query, (doctor_id,))
-        return row_to_dict_or_none(cur)
+        cur.execute(QUERIES['doctor_by_id'], (doctor_id,))
+        return row_to_record_or_none(cur, Doctor)
 
     def get_doctor_by_name(self, doctor):
         """
-        Get a dictionary of the doctor with the given name.
+        Get a record of the doctor with the given name.
         Return None when there is no such doctor in the database.
 
         :param doctor: name of the doctor
-        :return: a dictionary representing the doctor, or None
+        :return: a record of the doctor, or None
         """
         cur = self.conn.cursor()
-        query = 'SELECT doctor_id, doctor FROM doctors WHERE doctor = ?'
-        cur.execute(query, (doctor,))
-        return row_to_dict_or_none(cur)
+        cur.execute(QUERIES['doctor_by_name'], (doctor,))
+        return row_to_record_or_none(cur, Doctor)
 
     def delete_doctor(self, doctor_id):
         """
-        Delete the doctor with the given primary id key.
+        Delete the doctor with the given primary id key and their
+        appointments, and invalidate the cached doctor primary keys.
 
         :param doctor_id: primary key (id) of the doctor
-
         """
+        self.delete_doctor_many([doctor_id])
 
-        cur = self.conn.cursor()
+    def delete_doctor_many(self, doctor_ids):
+        """
+        Delete the doctors with the given primary keys and their
+        appointments, in one transaction, and invalidate the cached doctor
+        primary keys.
 
-        query1 = 'DELETE FROM app WHERE doctor_id = ?'
-        query2 = 'DELETE FROM doctors WHERE doctor_id = ?'
+        :param doctor_ids: iterable of primary keys of doctors
+        :return: number of doctors deleted
+        """
+        deleted = self._delete_many('doctors', 'doctor_id', doctor_ids)
+        self._name_caches['doctors'].clear()
 
-        cur.execute(query1, (doctor_id,))
-        cur.execute(query2, (doctor_id,))
-
-        self.conn.commit()
+        return deleted
 
     def insert_symptoms(self, symptom):
         """
         Insert a symptom case into the database only if it doesn't exist.
-        Return a dictionary representation of the symptom.
+        Return a record of the symptom.
 
         :param symptom: name of the symptom
-        :return: dictionary representing the symptom
+        :return: a record of the symptom
         """
 
-        cur = self.conn.cursor()
-        query = 'INSERT OR IGNORE INTO symptoms(symptom) VALUES(?)'
-        cur.execute(query, (symptom,))
-        self.conn.commit()
+        with self._transaction() as cur:
+            query = 'INSERT OR IGNORE INTO symptoms(symptom) VALUES(?)'
+            cur.execute(query, (symptom,))
+            self._touch('symptoms')
+
         return self.get_symptoms_by_name(symptom)
 
     def get_all_symptoms(self):
         """
-        Get a list of dictionary representation of all the symptoms in the
+        Get a list of records of all the symptoms in the
         database.
-        :return: list of dictionaries representing all symptoms.
+        :return: list of records of all symptoms.
         """
         cur = self.conn.cursor()
-        query = 'SELECT * FROM symptoms'
+        query = 'SELECT symptom_id, symptom FROM symptoms'
 
-        lst_symptoms = []
         cur.execute(query)
 
-        for row in cur.fetchall():
-            lst_symptoms.append(dict(row))
+        return fetch_records(cur, Symptom)
 
-        return lst_symptoms
+    def get_symptoms_page(self, limit, after_id=0):
+        """
+        Get a list of at most limit records of the
+        symptoms whose primary key is greater than after_id, in order of
+        primary key.
+
+        :param limit: maximum number of symptoms to return
+        :param after_id: primary key to start after
+        :return: list of records of symptoms
+        """
+        cur = self.conn.cursor()
+
+        query = 'SELECT symptom_id, symptom FROM symptoms ' \
+                'WHERE symptom_id > ? ORDER BY symptom_id LIMIT ?'
+        cur.execute(query, (after_id, limit))
+
+        return fetch_records(cur, Symptom)
+
+    def iter_all_symptoms(self, batch_size=1000):
+        """
+        Yield all of the symptoms in the database as lists of at most
+        batch_size records, in order of primary key.
+
+        :param batch_size: number of symptoms to fetch at a time
+        :return: a generator of lists of records of symptoms
+        """
+        query = 'SELECT symptom_id, symptom FROM symptoms ORDER BY symptom_id'
+        return self._iter_query(query, batch_size, Symptom)
 
     def get_symptoms_by_id(self, symptom_id):
         """
-        Get a dictionary representation of the symptom provided with the given
+        Get a record of the symptom provided with the given
         key. Return nothing if the symptom is not in the database.
 
         :param symptom_id: primary key of the symptom
-        :return: a dictionary of that symptom, or None.
+        :return: a record of that symptom, or None.
         """
 
         cur = self.conn.cursor()
-        query = 'SELECT symptom_id, symptom FROM symptoms WHERE symptom_id = ?'
-        cur.execute(query, (symptom_id,))
-        return row_to_dict_or_none(cur)
+        cur.execute(QUERIES['symptom_by_id'], (symptom_id,))
+        return row_to_record_or_none(cur, Symptom)
 
     def get_symptoms_by_name(self, symptom):
         """
-        Get a dictionary representation of the symptom with the provided name,
+        Get a record of the symptom with the provided name,
         or it returns none if there's no such symptom in the database.
 
         :param symptom: name of the symptom
-        :return: a dictionary of that symptom, or None.
+        :return: a record of that symptom, or None.
         """
 
         cur = self.conn.cursor()
-        query = 'SELECT symptom_id, symptom FROM symptoms WHERE symptom = ?'
-        cur.execute(query, (symptom,))
-        return row_to_dict_or_none(cur)
+        cur.execute(QUERIES['symptom_by_name'], (symptom,))
+        return row_to_record_or_none(cur, Symptom)
 
     def delete_symptom(self, symptom_id):
         """
-        Delete the symptom with the given primary key.
+        Delete the symptom with the given primary key and its appointments,
+        and invalidate the cached symptom primary keys.
 
         :param symptom_id: primary key of the symptom
         """
+        self.delete_symptom_many([symptom_id])
 
-        cur = self.conn.cursor()
+    def delete_symptom_many(self, symptom_ids):
+        """
+        Delete the symptoms with the given primary keys and their
+        appointments, in one transaction, and invalidate the cached symptom
+        primary keys.
+
+        :param symptom_ids: iterable of primary keys of symptoms
+        :return: number of symptoms deleted
+        """
+        deleted = self._delete_many('symptoms', 'symptom_id', symptom_ids)
+        self._name_caches['symptoms'].clear()
 
-        query1 = 'DELETE FROM app WHERE symptom_id = ?'
-        query2 = 'DELETE FROM symptoms WHERE symptom_id = ?'
+        return deleted
 
-        cur.execute(query1, (symptom_id,))
-        cur.execute(query2, (symptom_id,))
+    def search(self, text, limit=20, kinds=tuple(SEARCH_COLUMNS)):
+        """
+        Find the patients, doctors and symptoms whose names contain a word
+        starting with each word of text, e.g. 'mi le' finds Mina Lee.
+
+        The matches of each kind are ranked: names containing every word
+        of text as a whole word come first, then names that only contain
+        words starting with them, and within each of these the shortest
+        names first, i.e. the closest matches. Every match is ranked, in
+        SQL, which keeps only the best limit of them while sorting.
+
+        :param text: the search text
+        :param limit: maximum number of matches of each kind
+        :param kinds: the kinds to search, from 'patients', 'doctors' and
+        'symptoms'
+        :return: dict mapping each kind to a list of records of its
+        matches, best first
+        """
+        queries = (fts_query(text, prefix=False), fts_query(text))
+        results = {}
 
-        self.conn.commit()
+        for kind in kinds:
+            key = SEARCH_COLUMNS[kind][0]
+            query = ('SELECT {0} FROM {1}_fts m '
+                     'JOIN {1} t ON t.{2} = m.rowid '
+                     'WHERE {1}_fts MATCH ? '
+                     'ORDER BY {3}, t.{2} LIMIT ?'.format(
+                         ', '.join('t.' + column
+                                   for column in SEARCH_COLUMNS[kind]),
+                         kind, key,
+                         ' + '.join('length(t.{})'.format(column)
+                                    for column in _SEARCH_NAMES[kind])))
+
+            record = SEARCH_RECORDS[kind]
+            matches = OrderedDict()
+            cur = self.conn.cursor()
+
+            for match_query in queries:
+                if match_query is None or len(matches) >= limit:
+                    break
+
+                cur.execute(query, (match_query, limit))
+
+                for row in cur.fetchall():
+                    matches.setdefault(row[key], record(*row))
+
+            results[kind] = list(matches.values())[:limit]
+
+        return results
 
 
 if __name__ == '__main__':
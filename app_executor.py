@@ -0,0 +1,127 @@
+"""
+This module contains DatabaseExecutor, which lets asyncio code call the
+methods of AppointmentDatabase without blocking its event loop. Reads run
+on a pool of reader threads, each with its own connection, and writes are
+group committed by the single writer thread of a WriteQueue.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app_db import AppointmentDatabase
+from app_writer import WRITE_PREFIXES, WriteQueue
+
+
+class DatabaseExecutor:
+    """
+    Runs AppointmentDatabase methods on background threads for asyncio code.
+
+    Every public method of AppointmentDatabase is available as a coroutine
+    function of the same name, e.g. 'await executor.get_app_by_id(1)'.
+    The iter_* methods are not, since their generators would have to be
+    consumed on the thread that created them; use the get_*_page methods.
+
+    All writes go through one thread, so they never wait on each other for
+    SQLite's write lock, while readers run concurrently thanks to WAL mode.
+    """
+
+    def __init__(self, sqlite_filename, readers=4, batch_size=64,
+                 batch_delay=0.0, metrics=None, slow_log=None):
+        """
+        Opens the writer's connection, which creates and migrates the
+        database if needed. Reader connections are opened lazily, one per
+        reader thread.
+
+        :param sqlite_filename: the name of the SQLite database file
+        :param readers: number of reader threads
+        :param batch_size: maximum number of writes committed together
+        :param batch_delay: seconds to wait for more writes to join a batch
+        :param metrics: optional MetricsRegistry passed to every
+        AppointmentDatabase
+        :param slow_log: optional SlowQueryLog passed to every
+        AppointmentDatabase
+        """
+        self.sqlite_filename = sqlite_filename
+        self.metrics = metrics
+        self.slow_log = slow_log
+
+        self._local = threading.local()
+        self._databases = []
+        self._databases_lock = threading.Lock()
+
+        self._writer = WriteQueue(sqlite_filename, batch_size, batch_delay,
+                                  metrics, slow_log)
+        self._writer.start()
+        # The writer migrated the database, so this is the latest version.
+        self.schema_version = self._writer.schema_version
+
+        self._readers = ThreadPoolExecutor(readers,
+                                           thread_name_prefix='db-reader')
+
+    def _database(self):
+        """
+        :return: the AppointmentDatabase of the current thread
+        """
+        db = getattr(self._local, 'db', None)
+
+        if db is None:
+            db = AppointmentDatabase(self.sqlite_filename, self.metrics,
+                                     self.slow_log)
+            self._local.db = db
+
+            with self._databases_lock:
+                self._databases.append(db)
+
+        return db
+
+    def _call(self, name, args, kwargs):
+        return getattr(self._database(), name)(*args, **kwargs)
+
+    async def read(self, name, *args, **kwargs):
+        """
+        Call an AppointmentDatabase method on a reader thread.
+
+        :param name: name of the method
+        :return: the method's return value
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._readers, functools.partial(self._call, name, args, kwargs))
+
+    async def write(self, name, *args, **kwargs):
+        """
+        Queue a call of an AppointmentDatabase write method on the
+        WriteQueue and wait until its batch has committed.
+
+        :param name: name of the method
+        :return: the method's return value
+        """
+        return await asyncio.wrap_future(
+            self._writer.submit(name, *args, **kwargs))
+
+    def __getattr__(self, name):
+        if (name.startswith(('_', 'iter_'))
+                or not callable(getattr(AppointmentDatabase, name, None))):
+            raise AttributeError(name)
+
+        if name.startswith(WRITE_PREFIXES):
+            return functools.partial(self.write, name)
+
+        return functools.partial(self.read, name)
+
+    def close(self):
+        """
+        Wait for the queued calls to finish, then stop the threads and close
+        every connection.
+        """
+        self._readers.shutdown(wait=True)
+        self._writer.close()
+
+        with self._databases_lock:
+            for db in self._databases:
+                db.close()
+            del self._databases[:]
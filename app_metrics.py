@@ -0,0 +1,388 @@
+"""
+This module contains the instrumentation of AppointmentDatabase and the
+Flask applications: MetricsRegistry collects query and request timings and
+renders them in the Prometheus text format, and InstrumentedConnection is an
+sqlite3 connection whose cursors report every statement they run to it and
+to the slow query log of app_slowlog.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import bisect
+import functools
+import re
+import sqlite3
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAMETER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_REPEATED_LISTS = re.compile(r'\(\?\)(?:\s*,\s*\(\?\))+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """
+    Reduce a statement to its shape, so that statements which differ only
+    in their literals or in the length of their parameter lists are counted
+    together.
+
+    :param sql: an SQL statement
+    :return: the statement with literals and parameter lists replaced by '?'
+    """
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _PARAMETER_LIST.sub('(?)', sql)
+    sql = _REPEATED_LISTS.sub('(?), ...', sql)
+
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class Histogram:
+    """
+    A cumulative histogram of observed values with fixed bucket bounds, as
+    exposed by Prometheus.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: sorted upper bounds of the buckets
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        """
+        :param name: metric name
+        :param labels: label string without braces, such as 'a="b"'
+        :return: list of Prometheus text lines for the histogram
+        """
+        prefix = labels + ',' if labels else ''
+        lines = []
+        total = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+                name, prefix, bound, total))
+
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(
+            name, prefix, self.count))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, self.count))
+
+        return lines
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class QueryStats:
+    """
+    The statistics kept for one statement fingerprint.
+    """
+
+    __slots__ = ('latency', 'rows', 'fetch_seconds')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.fetch_seconds = 0.0
+
+
+class MetricsRegistry:
+    """
+    Collects the timings of SQL statements, commits and HTTP requests of one
+    process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything recorded so far.
+        """
+        with self._lock:
+            self.queries = {}
+            self.requests = {}
+            self.request_counts = {}
+            self.commits = 0
+            self.rollbacks = 0
+
+    def observe_query(self, sql, seconds, rows=0):
+        """
+        Record that a statement was executed.
+
+        :param sql: the statement
+        :param seconds: time taken by execute(); for a query that is the time
+        to its first row, for other statements all of their work
+        :param rows: number of rows written by the statement
+        :return: the QueryStats of the statement, to pass to observe_fetch
+        """
+        key = fingerprint(sql)
+
+        with self._lock:
+            stats = self.queries.get(key)
+            if stats is None:
+                stats = self.queries[key] = QueryStats()
+
+            stats.latency.observe(seconds)
+            stats.rows += rows
+
+        return stats
+
+    def observe_fetch(self, stats, seconds, rows):
+        """
+        Record rows fetched from the result of a statement.
+
+        :param stats: the QueryStats returned by observe_query
+        """
+        with self._lock:
+            stats.rows += rows
+            stats.fetch_seconds += seconds
+
+    def observe_commit(self):
+        with self._lock:
+            self.commits += 1
+
+    def observe_rollback(self):
+        with self._lock:
+            self.rollbacks += 1
+
+    def observe_request(self, method, route, status, seconds):
+        """
+        Record a handled HTTP request.
+
+        :param method: the HTTP method
+        :param route: the URL rule that matched, such as '/apps/<int:app_id>'
+        :param status: the response status code
+        :param seconds: time taken to build the response
+        """
+        with self._lock:
+            histogram = self.requests.get((method, route))
+            if histogram is None:
+                histogram = self.requests[(method, route)] = Histogram()
+
+            histogram.observe(seconds)
+
+            key = (method, route, status)
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        with self._lock:
+            lines = [
+                '# HELP sqlite_query_duration_seconds Time taken by execute() '
+                'per statement fingerprint.',
+                '# TYPE sqlite_query_duration_seconds histogram']
+
+            for sql, stats in sorted(self.queries.items()):
+                lines.extend(stats.latency.render(
+                    'sqlite_query_duration_seconds',
+                    'statement="{}"'.format(_escape(sql))))
+
+            lines.extend([
+                '# HELP sqlite_query_rows_total Rows returned or written per '
+                'statement fingerprint.',
+                '# TYPE sqlite_query_rows_total counter'])
+            lines.extend('sqlite_query_rows_total{{statement="{}"}} {}'.format(
+                _escape(sql), stats.rows)
+                for sql, stats in sorted(self.queries.items()))
+
+            lines.extend([
+                '# HELP sqlite_query_fetch_seconds_total Time spent fetching '
+                'rows per statement fingerprint.',
+                '# TYPE sqlite_query_fetch_seconds_total counter'])
+            lines.extend(
+                'sqlite_query_fetch_seconds_total{{statement="{}"}} {}'.format(
+                    _escape(sql), stats.fetch_seconds)
+                for sql, stats in sorted(self.queries.items()))
+
+            lines.extend([
+                '# HELP sqlite_commits_total Transactions committed.',
+                '# TYPE sqlite_commits_total counter',
+                'sqlite_commits_total {}'.format(self.commits),
+                '# HELP sqlite_rollbacks_total Transactions rolled back.',
+                '# TYPE sqlite_rollbacks_total counter',
+                'sqlite_rollbacks_total {}'.format(self.rollbacks),
+                '# HELP http_request_duration_seconds Time taken to build '
+                'the response per route.',
+                '# TYPE http_request_duration_seconds histogram'])
+
+            for (method, route), histogram in sorted(self.requests.items()):
+                lines.extend(histogram.render(
+                    'http_request_duration_seconds',
+                    'method="{}",route="{}"'.format(method, _escape(route))))
+
+            lines.extend([
+                '# HELP http_requests_total Requests handled per route and '
+                'status.',
+                '# TYPE http_requests_total counter'])
+            lines.extend(
+                'http_requests_total{{method="{}",route="{}",status="{}"}} '
+                '{}'.format(method, _escape(route), status, count)
+                for (method, route, status), count
+                in sorted(self.request_counts.items()))
+
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    A cursor that reports the statements it runs and the rows it fetches to
+    the MetricsRegistry of its connection, and statements that take longer
+    than its SlowQueryLog's threshold to that log.
+    """
+
+    _stats = None
+    _sql = None
+    _parameters = None
+    _executions = 1
+    _elapsed = 0.0
+    _logged = False
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._executed(sql, parameters, 1, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Only the first set of parameters is kept for the slow query log,
+        # and only if they can be read without consuming an iterator.
+        if isinstance(seq_of_parameters, (list, tuple)):
+            executions = len(seq_of_parameters)
+            parameters = seq_of_parameters[0] if executions else ()
+        else:
+            executions = None
+            parameters = None
+
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._executed(sql, parameters, executions,
+                           time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            self._executed(sql_script, None, None,
+                           time.perf_counter() - start)
+
+    def _executed(self, sql, parameters, executions, seconds):
+        """
+        Report a statement that has just been executed.
+        """
+        connection = self.connection
+
+        self._sql = sql
+        self._parameters = parameters
+        self._executions = executions
+        self._elapsed = seconds
+        self._logged = False
+
+        if connection.metrics is not None:
+            self._stats = connection.metrics.observe_query(
+                sql, seconds, max(self.rowcount, 0))
+
+        if (connection.slow_log is not None
+                and seconds > connection.slow_log.threshold):
+            self._log_slow()
+
+    def _fetched(self, seconds, rows):
+        """
+        Report rows fetched from the result of the last statement.
+        """
+        connection = self.connection
+        self._elapsed += seconds
+
+        if self._stats is not None:
+            connection.metrics.observe_fetch(self._stats, seconds, rows)
+
+        if (connection.slow_log is not None and not self._logged
+                and self._elapsed > connection.slow_log.threshold):
+            self._log_slow()
+
+    def _log_slow(self):
+        self._logged = True
+        self.connection.slow_log.record(self.connection, self._sql,
+                                        self._parameters, self._elapsed,
+                                        self._executions)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        if self._sql is not None:
+            self._fetched(time.perf_counter() - start, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self._sql is not None:
+            self._fetched(time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        if self._sql is not None:
+            self._fetched(time.perf_counter() - start, len(rows))
+        return rows
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    An sqlite3 connection whose cursors are InstrumentedCursors and whose
+    commits and rollbacks are counted. Create it with
+    sqlite3.connect(..., factory=InstrumentedConnection) and then set its
+    'metrics' attribute to a MetricsRegistry, its 'slow_log' attribute to a
+    SlowQueryLog, or both.
+    """
+
+    metrics = None
+    slow_log = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute doesn't go through cursor(), so these are needed
+    # for the statements run directly on the connection.
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        if self.metrics is not None and self.in_transaction:
+            self.metrics.observe_commit()
+        super().commit()
+
+    def rollback(self):
+        if self.metrics is not None and self.in_transaction:
+            self.metrics.observe_rollback()
+        super().rollback()
@@ -0,0 +1,505 @@
+"""
+This module contains the schema migrations for the appointments database.
+
+The schema version of a database file is stored in SQLite's 'user_version'
+pragma. AppointmentDatabase calls migrate() every time it opens a database,
+which applies any migration newer than the stored version, in order, inside
+a single transaction. A database created by AppointmentDatabase.create_tables
+starts at version 0.
+
+Run this module directly to upgrade an existing database file in place:
+
+    python app_migrations.py appointments.sqlite
+
+Written by Minhwa (Mina) Lee
+"""
+
+import calendar
+import os
+import sqlite3
+import sys
+import time
+
+MIGRATIONS = []
+
+MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December')
+
+
+def migration(version):
+    """
+    Register the decorated function as the migration to the given schema
+    version. The function receives a cursor and runs inside the migration
+    transaction, with foreign key enforcement turned off. The first line of
+    its docstring describes the change.
+
+    :param version: the schema version the migration upgrades to
+    """
+    def register(function):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] == version - 1
+        description = function.__doc__.strip().splitlines()[0]
+        MIGRATIONS.append((version, description, function))
+        return function
+
+    return register
+
+
+def latest_version():
+    """
+    :return: the schema version produced by applying every migration
+    """
+    if MIGRATIONS:
+        return MIGRATIONS[-1][0]
+    return 0
+
+
+def get_version(conn):
+    """
+    :param conn: an SQLite connection
+    :return: the schema version of the database
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Bring the database up to the latest schema version.
+
+    Foreign key enforcement is switched off while the migrations run (so
+    that tables can be rebuilt) and the foreign keys are checked before
+    committing, and the data version of every table is bumped. Returns a
+    list of (version, description) pairs for the migrations that were
+    applied, which is empty if the database was already up to date.
+
+    :param conn: an SQLite connection
+    :return: list of applied (version, description) pairs
+    """
+    if get_version(conn) >= latest_version():
+        return []
+
+    # PRAGMA foreign_keys is a no-op inside a transaction, so it has to be
+    # changed before BEGIN.
+    conn.commit()
+    conn.execute('PRAGMA foreign_keys = 0')
+
+    applied = []
+
+    try:
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+
+        # Another connection may have migrated the file while we waited
+        # for the write lock.
+        version = get_version(conn)
+
+        for target, description, function in MIGRATIONS:
+            if target > version:
+                function(cur)
+                applied.append((target, description))
+
+        cur.execute('PRAGMA user_version = {:d}'.format(latest_version()))
+
+        # A migration can change what is read from any table, so responses
+        # cached from the old schema must not match the new versions.
+        cur.execute('UPDATE data_versions SET version = version + 1, '
+                    'modified_at = ?', (time.time(),))
+
+        violation = cur.execute('PRAGMA foreign_key_check').fetchone()
+        if violation is not None:
+            raise sqlite3.IntegrityError(
+                'foreign key violation in table {}'.format(violation[0]))
+
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute('PRAGMA foreign_keys = 1')
+
+    return applied
+
+
+@migration(1)
+def add_app_indexes(cur):
+    """
+    Add indexes on the foreign keys and month of the app table.
+
+    idx_app_doctor_month and idx_app_month_patient carry every column the
+    appointment joins need, so the grouped views can be read from the index
+    alone.
+    """
+    create_app_indexes(cur)
+
+
+def create_app_indexes(cur):
+    """
+    Create the indexes of the app table. Dropping the app table drops them
+    too, so a migration that rebuilds app must call this again.
+    """
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_app_patient '
+                'ON app(patient_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_app_symptom '
+                'ON app(symptom_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_app_doctor_month '
+                'ON app(doctor_id, {}, month, patient_id, '
+                'symptom_id)'.format(month_order('month')))
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_app_month_patient '
+                'ON app(month, patient_id, doctor_id, symptom_id)')
+
+
+@migration(2)
+def add_app_count_tables(cur):
+    """
+    Add app_doctor_counts and app_month_counts, kept up to date by triggers.
+
+    They hold the number of appointments of each doctor and of each month,
+    so the grouped views don't have to aggregate the app table.
+    """
+    cur.execute('CREATE TABLE app_doctor_counts('
+                'doctor_id INTEGER PRIMARY KEY, app_count INTEGER NOT NULL)')
+    cur.execute('CREATE TABLE app_month_counts('
+                'month TEXT PRIMARY KEY, app_count INTEGER NOT NULL)')
+
+    cur.execute('INSERT INTO app_doctor_counts(doctor_id, app_count) '
+                'SELECT doctor_id, COUNT(*) FROM app GROUP BY doctor_id')
+    cur.execute('INSERT INTO app_month_counts(month, app_count) '
+                'SELECT month, COUNT(*) FROM app GROUP BY month')
+
+    create_app_count_triggers(cur)
+
+
+def create_app_count_triggers(cur):
+    """
+    Create the triggers that maintain app_doctor_counts and
+    app_month_counts. Dropping the app table drops them too, so a migration
+    that rebuilds app must call this again.
+
+    The insert trigger does nothing while app_counts_deferred has a row
+    (see defer_bulk_app_counts), which is created here if missing.
+    """
+    increment = """
+        INSERT INTO app_doctor_counts(doctor_id, app_count)
+        VALUES(NEW.doctor_id, 1)
+        ON CONFLICT(doctor_id) DO UPDATE SET app_count = app_count + 1;
+        INSERT INTO app_month_counts(month, app_count) VALUES(NEW.month, 1)
+        ON CONFLICT(month) DO UPDATE SET app_count = app_count + 1;
+    """
+    decrement = """
+        UPDATE app_doctor_counts SET app_count = app_count - 1
+        WHERE doctor_id = OLD.doctor_id;
+        DELETE FROM app_doctor_counts
+        WHERE doctor_id = OLD.doctor_id AND app_count = 0;
+        UPDATE app_month_counts SET app_count = app_count - 1
+        WHERE month = OLD.month;
+        DELETE FROM app_month_counts
+        WHERE month = OLD.month AND app_count = 0;
+    """
+
+    cur.execute('CREATE TABLE IF NOT EXISTS app_counts_deferred('
+                'deferred INTEGER)')
+
+    cur.execute('CREATE TRIGGER app_counts_insert AFTER INSERT ON app '
+                'WHEN NOT EXISTS (SELECT 1 FROM app_counts_deferred) '
+                'BEGIN {} END'.format(increment))
+    cur.execute('CREATE TRIGGER app_counts_delete AFTER DELETE ON app '
+                'BEGIN {} END'.format(decrement))
+    cur.execute('CREATE TRIGGER app_counts_update '
+                'AFTER UPDATE OF doctor_id, month ON app '
+                'BEGIN {} {} END'.format(decrement, increment))
+
+
+@migration(3)
+def add_data_versions(cur):
+    """
+    Add the data_versions table, which holds a version number per table.
+
+    AppointmentDatabase increments a table's version in every transaction
+    that writes to it. Versions start at the creation time in microseconds,
+    so a re-created database does not repeat the versions of an old one.
+    """
+    cur.execute('CREATE TABLE data_versions(name TEXT PRIMARY KEY, '
+                'version INTEGER NOT NULL, modified_at REAL NOT NULL)')
+
+    now = time.time()
+    cur.executemany('INSERT INTO data_versions(name, version, modified_at) '
+                    'VALUES(?, ?, ?)',
+                    [(table, int(now * 1e6), now) for table in
+                     ('app', 'patients', 'doctors', 'symptoms')])
+
+
+# The tables indexed for full-text search, with their primary key and the
+# columns indexed. Each gets an external content FTS5 table named
+# <table>_fts, whose rowid is the primary key of the row it indexes.
+SEARCH_TABLES = (('patients', 'patient_id', ('FirstN', 'LastN')),
+                 ('doctors', 'doctor_id', ('doctor',)),
+                 ('symptoms', 'symptom_id', ('symptom',)))
+
+
+@migration(4)
+def add_search_indexes(cur):
+    """
+    Add FTS5 indexes of the patient, doctor and symptom names.
+
+    The indexes store no copy of the names, only the tokens, and keep
+    prefix indexes of the first one to three characters of every token,
+    so that the prefix queries of search-as-you-type don't have to scan
+    the whole token list.
+    """
+    for table, key, columns in SEARCH_TABLES:
+        cur.execute("CREATE VIRTUAL TABLE {0}_fts USING fts5({1}, "
+                    "content='{0}', content_rowid='{2}', "
+                    "tokenize='unicode61 remove_diacritics 2', "
+                    "prefix='1 2 3')".format(table, ', '.join(columns), key))
+        cur.execute("INSERT INTO {0}_fts({0}_fts) VALUES('rebuild')".format(
+            table))
+
+    create_search_triggers(cur)
+
+
+def create_search_triggers(cur):
+    """
+    Create the triggers that keep the <table>_fts indexes in step with the
+    tables of SEARCH_TABLES. Dropping a table drops its triggers too, so a
+    migration that rebuilds one of them must call this again.
+    """
+    for table, key, columns in SEARCH_TABLES:
+        names = ', '.join(columns)
+        new = ', '.join('NEW.' + column for column in columns)
+        old = ', '.join('OLD.' + column for column in columns)
+
+        insert = ('INSERT INTO {0}_fts(rowid, {1}) VALUES(NEW.{2}, {3});'
+                  .format(table, names, key, new))
+        delete = ("INSERT INTO {0}_fts({0}_fts, rowid, {1}) "
+                  "VALUES('delete', OLD.{2}, {3});".format(table, names, key,
+                                                           old))
+
+        cur.execute('CREATE TRIGGER {0}_fts_insert '
+                    'AFTER INSERT ON {0} BEGIN {1} END'.format(table, insert))
+        cur.execute('CREATE TRIGGER {0}_fts_delete '
+                    'AFTER DELETE ON {0} BEGIN {1} END'.format(table, delete))
+        cur.execute('CREATE TRIGGER {0}_fts_update '
+                    'AFTER UPDATE ON {0} BEGIN {1} {2} END'.format(
+                        table, delete, insert))
+
+
+@migration(5)
+def add_patient_age_index(cur):
+    """
+    Add an index on the age and gender of the patients.
+
+    It serves the age_min, age_max and gender filters of the appointment
+    queries. Gender alone matches about half of the patients, which reads
+    faster from the table than through an index, so it comes second.
+    """
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_patients_age_gender '
+                'ON patients(age, gender)')
+
+
+@migration(6)
+def add_app_details_view(cur):
+    """
+    Add the app_details view of the appointments with their names.
+
+    It joins app with the patients, doctors and symptoms tables. The
+    appointment queries of AppointmentDatabase select from it, so the
+    join is written once. SQLite flattens the view into every query that
+    uses it, and the app indexes serve them as before.
+    """
+    create_app_details_view(cur)
+
+
+def create_app_details_view(cur):
+    """
+    Create the app_details view. It has every column of app, including
+    the ones added after it was created. SQLite refuses to rename a table
+    to the name of one the view reads from, so a migration that rebuilds
+    app, patients, doctors or symptoms must drop the view first and call
+    this again.
+    """
+    cur.execute('CREATE VIEW app_details AS '
+                'SELECT patients.FirstN AS FirstN, patients.LastN AS LastN, '
+                'patients.gender AS gender, patients.age AS age, '
+                'patients.birth AS birth, doctors.doctor AS doctor, '
+                'symptoms.symptom AS symptom, app.* '
+                'FROM app JOIN patients USING (patient_id) '
+                'JOIN doctors USING (doctor_id) '
+                'JOIN symptoms USING (symptom_id)')
+
+
+@migration(7)
+def add_app_delete_cascade(cur):
+    """
+    Make the foreign keys of the app table ON DELETE CASCADE.
+
+    Deleting a patient, doctor or symptom then deletes its appointments in
+    the same statement. SQLite can't alter a foreign key, so the table is
+    rebuilt with the same rows, and its indexes, triggers and the
+    app_details view are created again.
+    """
+    cur.execute('DROP VIEW app_details')
+    cur.execute('CREATE TABLE app_new(app_id INTEGER PRIMARY KEY, '
+                'patient_id INTEGER REFERENCES patients(patient_id) '
+                'ON DELETE CASCADE, '
+                'doctor_id INTEGER REFERENCES doctors(doctor_id) '
+                'ON DELETE CASCADE, '
+                'month TEXT, '
+                'symptom_id INTEGER REFERENCES symptoms(symptom_id) '
+                'ON DELETE CASCADE)')
+    cur.execute('INSERT INTO app_new(app_id, patient_id, doctor_id, month, '
+                'symptom_id) SELECT app_id, patient_id, doctor_id, month, '
+                'symptom_id FROM app')
+    cur.execute('DROP TABLE app')
+    cur.execute('ALTER TABLE app_new RENAME TO app')
+
+    create_app_indexes(cur)
+    create_app_count_triggers(cur)
+    create_app_details_view(cur)
+
+    # Dropping app dropped the statistics of its indexes.
+    if cur.execute("SELECT 1 FROM sqlite_master "
+                   "WHERE name = 'sqlite_stat1'").fetchone() is not None:
+        cur.execute('ANALYZE app')
+
+
+def month_number(month):
+    """
+    :param month: the name of a month, or its first three letters, in any
+    case
+    :return: the number of the month, from 1 for January to 12, or None if
+    month is not a month name
+    """
+    prefix = str(month).strip()[:3].capitalize()
+
+    for number, name in enumerate(MONTHS, 1):
+        if len(prefix) == 3 and name.startswith(prefix):
+            return number
+
+    return None
+
+
+def month_order(column):
+    """
+    :param column: an SQL expression of a month name
+    :return: an SQL expression of the number of that month as given by
+    month_number, or 13 if it is not a month name, to sort months in
+    calendar order
+    """
+    return 'CASE upper(substr(trim({}), 1, 3)) {} ELSE 13 END'.format(
+        column, ' '.join("WHEN '{}' THEN {}".format(name[:3].upper(), number)
+                         for number, name in enumerate(MONTHS, 1)))
+
+
+def month_start(month, year=None):
+    """
+    :param month: the name of a month, or its first three letters, in any
+    case
+    :param year: the year, by default the current one
+    :return: the time of midnight UTC on the first day of the month, in
+    seconds since the epoch, or None if month is not a month name
+    """
+    number = month_number(month)
+
+    if number is None:
+        return None
+    if year is None:
+        year = time.gmtime().tm_year
+
+    return calendar.timegm((year, number, 1, 0, 0, 0))
+
+
+@migration(8)
+def add_app_scheduled_at(cur):
+    """
+    Add the scheduled_at time of the appointments, with indexes.
+
+    It is the time of the appointment in seconds since the epoch. The
+    appointments that existed before only have a month, so their
+    scheduled_at is NULL. idx_app_scheduled serves queries by time range
+    and idx_app_doctor_scheduled the same for one doctor.
+    """
+    cur.execute('DROP VIEW app_details')
+    cur.execute('ALTER TABLE app ADD COLUMN scheduled_at INTEGER')
+    create_app_details_view(cur)
+
+    cur.execute('CREATE INDEX idx_app_scheduled ON app(scheduled_at)')
+    cur.execute('CREATE INDEX idx_app_doctor_scheduled '
+                'ON app(doctor_id, scheduled_at)')
+
+    # Without statistics of the new indexes, the planner would prefer the
+    # analyzed ones to them.
+    if cur.execute("SELECT 1 FROM sqlite_master "
+                   "WHERE name = 'sqlite_stat1'").fetchone() is not None:
+        cur.execute('ANALYZE app')
+
+
+@migration(9)
+def add_app_ends_at(cur):
+    """
+    Add the ends_at time of the appointments, with an index of the slots.
+
+    An appointment with an ends_at time holds its doctor from scheduled_at
+    until ends_at, and AppointmentDatabase keeps the slots of each doctor
+    from overlapping. The appointments that existed before have no ends_at
+    and hold no slot, as they only have a month. idx_app_doctor_slots holds
+    just the appointments with a slot, in order of time for each doctor.
+    """
+    cur.execute('ALTER TABLE app ADD COLUMN ends_at INTEGER')
+    cur.execute('CREATE INDEX idx_app_doctor_slots '
+                'ON app(doctor_id, scheduled_at, ends_at) '
+                'WHERE ends_at IS NOT NULL')
+
+    if cur.execute("SELECT 1 FROM sqlite_master "
+                   "WHERE name = 'sqlite_stat1'").fetchone() is not None:
+        cur.execute('ANALYZE app')
+
+
+@migration(10)
+def order_doctor_months(cur):
+    """
+    Order idx_app_doctor_month by calendar month instead of month name.
+
+    The appointments of a doctor are listed in calendar order, which the
+    index now gives without sorting, by the month_order expression.
+    """
+    cur.execute('DROP INDEX idx_app_doctor_month')
+    create_app_indexes(cur)
+
+    if cur.execute("SELECT 1 FROM sqlite_master "
+                   "WHERE name = 'sqlite_stat1'").fetchone() is not None:
+        cur.execute('ANALYZE app')
+
+
+@migration(11)
+def defer_bulk_app_counts(cur):
+    """
+    Let insert_apps_bulk update the appointment counts once per chunk.
+
+    While app_counts_deferred has a row, app_counts_insert leaves
+    app_doctor_counts and app_month_counts alone. insert_apps_bulk adds
+    the row in its own transaction, so no other connection ever sees it,
+    and adds the counts of all the appointments it inserted at the end,
+    instead of two upserts per appointment.
+    """
+    for trigger in ('insert', 'delete', 'update'):
+        cur.execute('DROP TRIGGER app_counts_{}'.format(trigger))
+
+    create_app_count_triggers(cur)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: python app_migrations.py DATABASE')
+        sys.exit(1)
+
+    if not os.path.isfile(sys.argv[1]):
+        print('No such database file: ', sys.argv[1])
+        sys.exit(1)
+
+    connection = sqlite3.connect(sys.argv[1])
+    print('Schema version before: ', get_version(connection))
+
+    for applied_version, applied_description in migrate(connection):
+        print('Applied migration {}: {}'.format(applied_version,
+                                                applied_description))
+
+    print('Schema version after: ', get_version(connection))
@@ -0,0 +1,148 @@
+"""
+This module contains the class AppointmentDatabasePool, which keeps a bounded
+set of AppointmentDatabase objects open so that the Flask applications can
+check one out per request instead of opening a new SQLite connection (and
+re-running its PRAGMA setup) on every call.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+from app_db import AppointmentDatabase
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no database connection became available in time.
+    """
+
+
+class AppointmentDatabasePool:
+    """
+    A per-process pool of AppointmentDatabase objects for one database file.
+
+    At most 'size' connections are open at once. Connections returned to the
+    pool are reused most-recently-used first, and connections that sit idle
+    for longer than 'idle_timeout' seconds are closed.
+    """
+
+    def __init__(self, sqlite_filename, size=5, idle_timeout=300.0,
+                 acquire_timeout=30.0, metrics=None, slow_log=None,
+                 read_only=False):
+        """
+        Creates an empty pool. Connections are opened lazily.
+
+        :param sqlite_filename: the name of the SQLite database file
+        :param size: maximum number of open connections
+        :param idle_timeout: seconds an unused connection is kept open
+        :param acquire_timeout: seconds acquire() waits for a free connection
+        :param metrics: optional MetricsRegistry passed to every
+        AppointmentDatabase
+        :param slow_log: optional SlowQueryLog passed to every
+        AppointmentDatabase
+        :param read_only: True to open every connection read-only
+        """
+        if size < 1:
+            raise ValueError('pool size must be at least 1')
+
+        self.sqlite_filename = sqlite_filename
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.metrics = metrics
+        self.slow_log = slow_log
+        self.read_only = read_only
+
+        self._lock = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        """
+        Forget every connection. Used at creation and after a fork, since an
+        SQLite connection must not be shared with a child process.
+        """
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._open = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _close_expired(self, now):
+        """
+        Close idle connections that have not been used for idle_timeout
+        seconds. The oldest connections are at the left of the deque.
+        """
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            db, _ = self._idle.popleft()
+            self._open -= 1
+            db.close()
+
+    def acquire(self):
+        """
+        Check out an AppointmentDatabase from the pool, opening a new
+        connection if none is idle and the pool is not full.
+
+        :return: an AppointmentDatabase
+        """
+        deadline = time.monotonic() + self.acquire_timeout
+
+        with self._lock:
+            self._check_pid()
+
+            while True:
+                self._close_expired(time.monotonic())
+
+                if self._idle:
+                    db, _ = self._idle.pop()
+                    return db
+
+                if self._open < self.size:
+                    self._open += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout('no database connection available')
+                self._lock.wait(remaining)
+
+        try:
+            return AppointmentDatabase(self.sqlite_filename, self.metrics,
+                                       self.slow_log, self.read_only)
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, db):
+        """
+        Return an AppointmentDatabase to the pool. Any transaction left open
+        by the caller is rolled back.
+
+        :param db: an AppointmentDatabase obtained from acquire()
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+
+            if db.conn.in_transaction:
+                db.conn.rollback()
+
+            self._idle.append((db, time.monotonic()))
+            self._lock.notify()
+
+    def close(self):
+        """
+        Close every idle connection in the pool.
+        """
+        with self._lock:
+            while self._idle:
+                db, _ = self._idle.pop()
+                self._open -= 1
+                db.close()
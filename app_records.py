@@ -0,0 +1,178 @@
+"""
+This module contains the record classes AppointmentDatabase returns rows
+as: Appointment, Patient, Doctor and Symptom.
+
+A record keeps its values in __slots__ instead of a per-row dict, and the
+records built together by from_rows() share one copy of the values that
+repeat from row to row, such as the names of doctors and months. A list of a
+million appointments so takes less than half the memory of a list of dicts,
+and is faster to build than dict(sqlite3.Row).
+
+A record is also a read-only mapping from column names to values, so
+record['FirstN'], dict(record) and record == {...} behave like they do for
+the dicts rows used to be, and RecordJSONProvider in app_responses.py
+encodes it as the same JSON object.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import itertools
+import operator
+from collections.abc import Mapping
+
+
+class Record(Mapping):
+    """
+    Base class of the records. A subclass lists its fields in __slots__,
+    in the order of the columns of the rows it is built from, and defines
+    an __init__ taking one argument per field, in the same order, that
+    assigns each of them.
+    """
+
+    __slots__ = ()
+
+    # The fields whose values repeat across many rows. The records built
+    # by one call of from_rows() share a single object for each value of
+    # these, instead of the new string SQLite returns for every row.
+    shared_fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        fields = cls.__slots__
+        code = getattr(cls.__init__, '__code__', None)
+        if code is None or code.co_varnames[1:code.co_argcount] != fields:
+            raise TypeError('{}.__init__ must take the fields {}'.format(
+                cls.__name__, ', '.join(fields)))
+
+        cls._fields = fields
+        cls._values = operator.attrgetter(*fields)
+        cls._shared = tuple(position for position, name in enumerate(fields)
+                            if name in cls.shared_fields)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        :param rows: tuples of the values of the fields, in their order
+        :return: a list of records of the rows, sharing one object for
+        each value of the shared_fields
+        """
+        if not cls._shared:
+            return list(itertools.starmap(cls, rows))
+
+        share = {}.setdefault
+        shared = cls._shared
+        records = []
+
+        for row in rows:
+            values = list(row)
+            for position in shared:
+                value = values[position]
+                values[position] = share(value, value)
+
+            records.append(cls(*values))
+
+        return records
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return getattr(self, key)
+
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self._values(self) == other._values(other)
+
+        if isinstance(other, Mapping):
+            return self.to_dict() == dict(other)
+
+        return NotImplemented
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return type(self), self._values(self)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, value)
+            for name, value in zip(self._fields, self._values(self))))
+
+    def to_dict(self):
+        """
+        :return: a dict of the fields of the record
+        """
+        return dict(zip(self._fields, self._values(self)))
+
+
+class Appointment(Record):
+    """
+    An appointment, with the names of its patient, doctor and symptom.
+    """
+
+    __slots__ = ('FirstN', 'LastN', 'gender', 'age', 'birth', 'doctor',
+                 'month', 'app_id', 'symptom', 'scheduled_at',
+                 'ends_at')
+    shared_fields = ('gender', 'doctor', 'month', 'symptom')
+
+    def __init__(self, FirstN, LastN, gender, age, birth, doctor, month,
+                 app_id, symptom, scheduled_at, ends_at):
+        self.FirstN = FirstN
+        self.LastN = LastN
+        self.gender = gender
+        self.age = age
+        self.birth = birth
+        self.doctor = doctor
+        self.month = month
+        self.app_id = app_id
+        self.symptom = symptom
+        self.scheduled_at = scheduled_at
+        self.ends_at = ends_at
+
+
+class Patient(Record):
+    """
+    A row of the patients table.
+    """
+
+    __slots__ = ('patient_id', 'FirstN', 'LastN', 'gender', 'age', 'birth')
+    shared_fields = ('gender',)
+
+    def __init__(self, patient_id, FirstN, LastN, gender, age, birth):
+        self.patient_id = patient_id
+        self.FirstN = FirstN
+        self.LastN = LastN
+        self.gender = gender
+        self.age = age
+        self.birth = birth
+
+
+class Doctor(Record):
+    """
+    A row of the doctors table.
+    """
+
+    __slots__ = ('doctor_id', 'doctor')
+
+    def __init__(self, doctor_id, doctor):
+        self.doctor_id = doctor_id
+        self.doctor = doctor
+
+
+class Symptom(Record):
+    """
+    A row of the symptoms table.
+    """
+
+    __slots__ = ('symptom_id', 'symptom')
+
+    def __init__(self, symptom_id, symptom):
+        self.symptom_id = symptom_id
+        self.symptom = symptom
@@ -0,0 +1,209 @@
+"""
+This module contains the per-process resources shared by the requests of
+the Flask applications app_api.py and app_api_html.py: the connection pool,
+the write queue, the slow query log, the response store and the columnar
+copy for /stats. Each function is given the application, creates the
+resource from its config on first use, keeps it in app.extensions, and
+replaces it when the config it was made from changes.
+
+An application calls init_app() once, so that the database a request
+checked out of the pool with get_db() is returned at its end.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import threading
+
+from flask import g
+
+from app_pool import AppointmentDatabasePool
+from app_responses import ResponseStore
+from app_slowlog import SlowQueryLog
+from app_writer import RemoteWriteQueue, WriteQueue
+
+_lock = threading.Lock()
+
+
+def init_app(app):
+    """
+    Return the database of each request of app to the connection pool when
+    the request ends.
+
+    :param app: the Flask application
+    """
+    @app.teardown_appcontext
+    def release_db(exception):
+        db = g.pop('app_db', None)
+
+        if db is not None:
+            get_pool(app).release(db)
+
+
+def get_metrics(app):
+    """
+    Returns the MetricsRegistry of the application, kept in
+    app.extensions['metrics'], or None if it has none or METRICS_ENABLED
+    is False.
+    """
+
+    if not app.config.get('METRICS_ENABLED', True):
+        return None
+
+    return app.extensions.get('metrics')
+
+
+def get_slow_query_log(app):
+    """
+    Returns the SlowQueryLog configured by SLOW_QUERY_LOG and
+    SLOW_QUERY_THRESHOLD, or None if SLOW_QUERY_LOG is None. Called with
+    _lock held.
+    """
+
+    path = app.config['SLOW_QUERY_LOG']
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+
+    if path is None:
+        return None
+
+    slow_log = app.extensions.get('slow_query_log')
+
+    if (slow_log is None or slow_log.path != path
+            or slow_log.threshold != threshold):
+        slow_log = SlowQueryLog(path, threshold)
+        app.extensions['slow_query_log'] = slow_log
+
+    return slow_log
+
+
+def get_pool(app):
+    """
+    Returns the AppointmentDatabasePool for the application's database file,
+    creating it on first use.
+    """
+
+    with _lock:
+        pool = app.extensions.get('appointment_pool')
+        pool_metrics = get_metrics(app)
+        slow_log = get_slow_query_log(app)
+
+        if (pool is None or pool.sqlite_filename != app.config['DATABASE']
+                or pool.metrics is not pool_metrics
+                or pool.slow_log is not slow_log
+                or pool.read_only != app.config['DATABASE_READ_ONLY']):
+            if pool is not None:
+                pool.close()
+
+            pool = AppointmentDatabasePool(
+                app.config['DATABASE'],
+                size=app.config['DATABASE_POOL_SIZE'],
+                idle_timeout=app.config['DATABASE_POOL_IDLE_TIMEOUT'],
+                metrics=pool_metrics, slow_log=slow_log,
+                read_only=app.config['DATABASE_READ_ONLY'])
+            app.extensions['appointment_pool'] = pool
+
+    return pool
+
+
+def get_db(app):
+    """
+    Returns the AppointmentDatabase of the current request, checked out of
+    the connection pool on first use and returned to it by the teardown
+    hook of init_app().
+    """
+
+    if 'app_db' not in g:
+        g.app_db = get_pool(app).acquire()
+
+    return g.app_db
+
+
+def get_writer(app):
+    """
+    Returns the WriteQueue for the application's database file, creating it
+    on first use. Every write of the request handlers goes through it, so
+    concurrent writes are committed together by one writer thread.
+
+    If WRITE_SERVER is set, returns a RemoteWriteQueue that sends the
+    writes to the writer process instead.
+    """
+
+    with _lock:
+        writer = app.extensions.get('appointment_writer')
+
+        if app.config['WRITE_SERVER'] is not None:
+            if not isinstance(writer, RemoteWriteQueue):
+                if writer is not None:
+                    writer.close()
+
+                address, authkey = app.config['WRITE_SERVER']
+                writer = RemoteWriteQueue(address, authkey,
+                                          app.config['DATABASE'])
+                app.extensions['appointment_writer'] = writer
+
+            return writer
+
+        writer_metrics = get_metrics(app)
+        slow_log = get_slow_query_log(app)
+
+        if (writer is None or writer.sqlite_filename != app.config['DATABASE']
+                or writer.metrics is not writer_metrics
+                or writer.slow_log is not slow_log):
+            if writer is not None:
+                writer.close()
+
+            writer = WriteQueue(
+                app.config['DATABASE'],
+                batch_size=app.config['WRITE_BATCH_SIZE'],
+                batch_delay=app.config['WRITE_BATCH_DELAY'],
+                metrics=writer_metrics,
+                slow_log=slow_log)
+            app.extensions['appointment_writer'] = writer
+
+    return writer
+
+
+def get_response_store(app):
+    """
+    Returns the ResponseStore configured by RESPONSE_CACHE_FILE and
+    RESPONSE_CACHE_BYTES, opening it on first use, or None if
+    RESPONSE_CACHE_FILE is None.
+    """
+
+    path = app.config['RESPONSE_CACHE_FILE']
+
+    if path is None:
+        return None
+
+    with _lock:
+        store = app.extensions.get('response_store')
+
+        if (store is None or store.path != path
+                or store.max_bytes != app.config['RESPONSE_CACHE_BYTES']):
+            if store is not None:
+                store.close()
+
+            store = ResponseStore(path, app.config['RESPONSE_CACHE_BYTES'])
+            app.extensions['response_store'] = store
+
+    return store
+
+
+def get_analytics(app):
+    """
+    Returns the AppointmentColumns copy of the application's database,
+    loading it on first use and bringing it up to date with the rows
+    written since the last call.
+    """
+    from app_analytics import AppointmentColumns
+
+    with _lock:
+        database, columns = app.extensions.get('appointment_columns',
+                                               (None, None))
+
+        if columns is None or database != app.config['DATABASE']:
+            columns = AppointmentColumns()
+            app.extensions['appointment_columns'] = (app.config['DATABASE'],
+                                                     columns)
+
+    columns.refresh(get_db(app))
+    return columns
@@ -0,0 +1,500 @@
+"""
+This module contains VersionedResponseCache, which lets the Flask
+applications answer conditional GET requests and repeat requests from the
+data versions kept by AppointmentDatabase, without running the view;
+ResponseBodies, the bodies it keeps, which app_api_async.py uses directly;
+ResponseStore, the file its expensive responses are also kept in, which
+outlives the process and is shared by every worker; and RecordJSONProvider,
+which lets them encode the records of app_records.py.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from email.utils import formatdate
+
+from flask import Response, current_app, request
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import quote_etag
+
+from app_cache import LRUCache
+from app_records import Record
+
+# Version of the bodies and headers of the cached responses, which is part
+# of their keys. Bump it when the output of a view changes, so that
+# responses stored in a ResponseStore by older code aren't served.
+RESPONSE_FORMAT = 1
+
+# Headers of a response that are not cached with its body, as they are set
+# again for every response.
+UNCACHED_HEADERS = {'content-type', 'content-length', 'etag',
+                    'last-modified', 'vary'}
+
+
+class RecordJSONProvider(DefaultJSONProvider):
+    """
+    Flask's default JSON provider, which also encodes a Record as the JSON
+    object of its fields, exactly like the dict of the row it replaces.
+    Set it with app.json = RecordJSONProvider(app).
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Record):
+            return o.to_dict()
+
+        return DefaultJSONProvider.default(o)
+
+
+class ResponseStore:
+    """
+    A cache of response bodies in an SQLite file, shared by every process
+    that opens the file and kept across restarts.
+
+    It holds at most one body per request, with the ETag of the data
+    versions it was built from; storing a body for newer versions replaces
+    the old one. When the bodies take more than max_bytes, the least
+    recently used are deleted. The time an entry was last used is only
+    written again after TOUCH_INTERVAL seconds, so that hits rarely write
+    to the file.
+
+    The cache is best effort: if the file can't be read or written, for
+    example because another process holds the write lock for longer than
+    timeout, get() misses and put() does nothing.
+    """
+
+    # Seconds between updates of the last use of an entry.
+    TOUCH_INTERVAL = 10
+
+    # Version of the tables in the file, kept in its user_version. A file
+    # of another version is emptied and its tables created again.
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, timeout=1.0):
+        """
+        :param path: path of the SQLite file, created if it doesn't exist
+        :param max_bytes: maximum total size of the bodies kept
+        :param timeout: seconds to wait for another process's write lock
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Return the connection to the file, opening it, and creating the
+        tables, on first use in this process. Called with _lock held.
+        """
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        # A connection inherited through fork must not be used.
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode = WAL')
+        # A cache can lose its last writes in a power failure, so commits
+        # don't wait for the disk.
+        conn.execute('PRAGMA synchronous = NORMAL')
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS responses')
+                conn.execute('DROP TABLE IF EXISTS response_bytes')
+                conn.execute('PRAGMA user_version = {:d}'.format(
+                    self.SCHEMA_VERSION))
+
+            conn.execute('CREATE TABLE IF NOT EXISTS responses('
+                         'request TEXT PRIMARY KEY, etag TEXT NOT NULL, '
+                         'body BLOB NOT NULL, mimetype TEXT NOT NULL, '
+                         'headers TEXT NOT NULL, size INTEGER NOT NULL, '
+                         'used_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_used_at '
+                         'ON responses(used_at)')
+            # The total size of the bodies, kept by triggers.
+            conn.execute('CREATE TABLE IF NOT EXISTS response_bytes('
+                         'id INTEGER PRIMARY KEY CHECK (id = 0), '
+                         'bytes INTEGER NOT NULL)')
+            conn.execute('INSERT OR IGNORE INTO response_bytes VALUES(0, 0)')
+            conn.execute('CREATE TRIGGER IF NOT EXISTS responses_insert '
+                         'AFTER INSERT ON responses BEGIN '
+                         'UPDATE response_bytes SET bytes = bytes + NEW.size; '
+                         'END')
+            conn.execute('CREATE TRIGGER IF NOT EXISTS responses_delete '
+                         'AFTER DELETE ON responses BEGIN '
+                         'UPDATE response_bytes SET bytes = bytes - OLD.size; '
+                         'END')
+            conn.execute('CREATE TRIGGER IF NOT EXISTS responses_update '
+                         'AFTER UPDATE OF size ON responses BEGIN '
+                         'UPDATE response_bytes '
+                         'SET bytes = bytes + NEW.size - OLD.size; END')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            conn.close()
+            raise
+
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def get(self, request_key, etag):
+        """
+        :param request_key: string identifying the request
+        :param etag: the ETag of the current data versions
+        :return: (body, mimetype, headers) stored for the request and etag,
+        where headers is a list of (name, value) pairs, or None
+        """
+        now = time.time()
+
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute('SELECT body, mimetype, headers, used_at '
+                                   'FROM responses '
+                                   'WHERE request = ? AND etag = ?',
+                                   (request_key, etag)).fetchone()
+
+                if row is not None and now - row[3] > self.TOUCH_INTERVAL:
+                    conn.execute('UPDATE responses SET used_at = ? '
+                                 'WHERE request = ?', (now, request_key))
+            except sqlite3.Error:
+                self.errors += 1
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return row[0], row[1], [tuple(header)
+                                    for header in json.loads(row[2])]
+
+    def put(self, request_key, etag, body, mimetype, headers=()):
+        """
+        Store the body of a request's response, replacing any body stored
+        for older data versions, and delete the least recently used bodies
+        if the total is over max_bytes. Bodies larger than an eighth of
+        max_bytes are not stored.
+
+        :param request_key: string identifying the request
+        :param etag: the ETag of the data versions the body was built from
+        :param body: the body, as bytes
+        :param mimetype: the mimetype of the body
+        :param headers: iterable of (name, value) pairs of the other
+        headers of the response
+        """
+        if len(body) > self.max_bytes // 8:
+            return
+
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute('BEGIN IMMEDIATE')
+
+                try:
+                    conn.execute('INSERT INTO responses(request, etag, body, '
+                                 'mimetype, headers, size, used_at) '
+                                 'VALUES(?, ?, ?, ?, ?, ?, ?) '
+                                 'ON CONFLICT(request) DO UPDATE SET '
+                                 'etag = excluded.etag, '
+                                 'body = excluded.body, '
+                                 'mimetype = excluded.mimetype, '
+                                 'headers = excluded.headers, '
+                                 'size = excluded.size, '
+                                 'used_at = excluded.used_at',
+                                 (request_key, etag, body, mimetype,
+                                  json.dumps(list(headers)), len(body),
+                                  time.time()))
+
+                    total = conn.execute('SELECT bytes FROM response_bytes'
+                                         ).fetchone()[0]
+                    if total > self.max_bytes:
+                        self._evict(conn, self.max_bytes * 9 // 10)
+
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error:
+                self.errors += 1
+
+    @staticmethod
+    def _evict(conn, target):
+        """
+        Delete the least recently used bodies until the rest take at most
+        target bytes. Evicting below max_bytes leaves room for the next
+        puts, so that eviction runs once in a while rather than on every put.
+        """
+        conn.execute('DELETE FROM responses WHERE used_at <= ('
+                     'SELECT used_at FROM ('
+                     'SELECT used_at, SUM(size) OVER ('
+                     'ORDER BY used_at DESC, rowid DESC) AS total '
+                     'FROM responses) '
+                     'WHERE total > ? ORDER BY used_at DESC LIMIT 1)',
+                     (target,))
+
+    def clear(self):
+        """
+        Delete every body. The hit and miss counters are kept.
+        """
+        with self._lock:
+            self._connect().execute('DELETE FROM responses')
+
+    def stats(self):
+        """
+        :return: a dict with the number of hits, misses and errors, the
+        number of bodies stored and their total size
+        """
+        with self._lock:
+            conn = self._connect()
+            size = conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            total = conn.execute('SELECT bytes FROM response_bytes'
+                                 ).fetchone()[0]
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'errors': self.errors, 'size': size, 'bytes': total,
+                'max_bytes': self.max_bytes}
+
+    def close(self):
+        """
+        Close the connection of this process to the file.
+        """
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+
+            self._conn = None
+
+
+class ResponseBodies:
+    """
+    The cached bodies of GET responses, with the headers their view set,
+    keyed by the request and the ETag of the data versions they were built
+    from. They are kept in an LRU cache and, for the views marked
+    persist=True, also in the ResponseStore returned by get_store, if any,
+    so that a restarted process or another worker finds them there.
+
+    It reads no data versions itself, so app_api_async.py uses it with the
+    versions it got from its DatabaseExecutor.
+    """
+
+    def __init__(self, maxsize=256, get_store=None):
+        """
+        :param maxsize: maximum number of response bodies kept in memory
+        :param get_store: function returning the application's
+        ResponseStore or None, or None for no store
+        """
+        self.get_store = get_store
+        self.lru = LRUCache(maxsize)
+
+    def lookup(self, key, etag, persist=False):
+        """
+        Return the cached response to a request. Looking in the
+        ResponseStore blocks, so an asynchronous view runs this in a thread
+        when persist is True.
+
+        :param key: the key of the request, from store_key
+        :param etag: the ETag of the current data versions
+        :param persist: True to also look in the ResponseStore
+        :return: (body, mimetype, headers) of the response, or None
+        """
+        cached = self.lru.get((key, etag))
+        store = self.get_store() if persist and self.get_store else None
+
+        if cached is None and store is not None:
+            cached = store.get(key, etag)
+
+            if cached is not None:
+                self.lru.put((key, etag), cached)
+
+        return cached
+
+    def save(self, key, etag, body, response, persist=False):
+        """
+        Cache a successful response to a request, with the headers the view
+        set. Like lookup, this blocks when persist is True.
+
+        :param key: the key of the request, from store_key
+        :param etag: the ETag of the data versions it was built from
+        :param body: the body of the response, as bytes
+        :param response: the response, of Flask or Quart
+        :param persist: True to also keep it in the ResponseStore
+        """
+        extra = [(name, value) for name, value in response.headers.items()
+                 if name.lower() not in UNCACHED_HEADERS]
+        self.lru.put((key, etag), (body, response.mimetype, extra))
+
+        store = self.get_store() if persist and self.get_store else None
+        if store is not None:
+            store.put(key, etag, body, response.mimetype, extra)
+
+    def clear(self):
+        """
+        Forget the bodies kept in memory. The ResponseStore is left alone.
+        """
+        self.lru.clear()
+
+
+class VersionedResponseCache:
+    """
+    Caches the bodies of GET responses keyed by the request and the data
+    versions of the tables the response was built from.
+
+    Each response gets an ETag made of those versions and of the Accept
+    header, as a view may return another representation for another
+    Accept, and a Last-Modified header from the time of the latest change.
+    Requests whose If-None-Match or If-Modified-Since show that the client
+    is up to date are answered with 304 Not Modified. The other headers
+    the view sets are cached with the body, in its ResponseBodies.
+    """
+
+    def __init__(self, get_db, maxsize=256, get_store=None):
+        """
+        :param get_db: function returning the request's AppointmentDatabase
+        :param maxsize: maximum number of response bodies kept
+        :param get_store: function returning the application's
+        ResponseStore or None, or None for no store
+        """
+        self.get_db = get_db
+        self.bodies = ResponseBodies(maxsize, get_store)
+
+    def versioned(self, *tables, persist=False):
+        """
+        Decorator for a view whose response depends only on the request and
+        on the contents of the given tables.
+
+        :param tables: names of the tables the view reads
+        :param persist: True to also keep the bodies in the ResponseStore,
+        for views that are expensive to run
+        """
+        def decorate(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                return self.respond(tables, view, *args, persist=persist,
+                                    **kwargs)
+
+            return wrapper
+
+        return decorate
+
+    def respond(self, tables, view, *args, persist=False, **kwargs):
+        """
+        Return the response for the current request, from the cache if the
+        data has not changed since it was built, or else by calling the view.
+
+        :param tables: names of the tables the view reads
+        :param view: the view function
+        :param persist: True to also look in and store to the ResponseStore
+        :return: the response
+        """
+        db = self.get_db()
+        versions = db.get_data_versions(tables)
+        etag, headers, not_modified = conditional_headers(request, versions)
+
+        if not_modified:
+            return Response(status=304, headers=headers)
+
+        key = store_key(current_app, request, db.schema_version)
+        cached = self.bodies.lookup(key, etag, persist)
+
+        if cached is not None:
+            return cached_response(Response, cached, headers)
+
+        response = view(*args, **kwargs)
+        if not isinstance(response, Response):
+            response = Response(response)
+
+        response.headers.update(headers)
+
+        # Streamed exports are not kept in memory.
+        if response.status_code == 200 and not response.is_streamed:
+            self.bodies.save(key, etag, response.get_data(), response,
+                             persist)
+
+        return response
+
+
+def conditional_headers(req, versions):
+    """
+    Work out the validators of a response built from tables with the given
+    data versions.
+
+    The ETag is made of the versions and of a checksum of the Accept
+    header, since a view may return another representation for another
+    Accept.
+
+    :param req: the request, of Flask or Quart
+    :param versions: list of (version, modified_at) pairs of the tables
+    :return: (etag, headers, not_modified): the ETag, the ETag,
+    Last-Modified and Vary headers of the response, and True if the
+    client's copy is up to date
+    """
+    etag = '-'.join(str(version) for version, _ in versions)
+    last_modified = max(modified_at for _, modified_at in versions)
+
+    accept = req.headers.get('Accept')
+    if accept:
+        etag += '.{:08x}'.format(zlib.crc32(accept.encode()))
+
+    if req.if_none_match:
+        not_modified = req.if_none_match.contains(etag)
+    elif req.if_modified_since:
+        # The header has whole seconds, and a change in the same second as
+        # that time may be newer than the client's copy, so only an older
+        # second is up to date.
+        not_modified = (last_modified <=
+                        req.if_modified_since.timestamp() - 1)
+    else:
+        not_modified = False
+
+    headers = {'ETag': quote_etag(etag),
+               'Last-Modified': formatdate(last_modified, usegmt=True),
+               'Vary': 'Accept'}
+
+    return etag, headers, not_modified
+
+
+def cached_response(response_class, cached, headers):
+    """
+    :param response_class: the Response class of Flask or Quart
+    :param cached: (body, mimetype, headers) returned by
+    ResponseBodies.lookup
+    :param headers: the headers of conditional_headers
+    :return: a response with the cached body and headers
+    """
+    body, mimetype, extra = cached
+
+    response = response_class(body, mimetype=mimetype, headers=extra)
+    response.headers.update(headers)
+    return response
+
+
+def store_key(app, req, schema_version):
+    """
+    :param app: the application, of Flask or Quart
+    :param req: the request
+    :param schema_version: the schema version of the database
+    :return: the key of the request in ResponseBodies and a
+    ResponseStore: the name of the application, its database file (the
+    data versions of two files could be equal), the schema version and
+    RESPONSE_FORMAT (a response built from another schema or by other
+    code could differ), the path and query string, and the Accept header
+    """
+    return '\n'.join((app.name, os.path.abspath(app.config['DATABASE']),
+                      str(schema_version), str(RESPONSE_FORMAT),
+                      req.full_path, req.headers.get('Accept', '')))
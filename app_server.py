@@ -0,0 +1,235 @@
+"""
+A production launcher for the Flask applications, instead of the
+single-process debug server of app.run().
+
+It prepares the database, then forks one writer process and N worker
+processes that share a listening socket. Each worker serves requests with
+a threaded Werkzeug server and a pool of read-only connections, which WAL
+mode lets read concurrently with the writer. Every write of every worker
+is sent to the writer process, whose WriteQueue commits them in groups, so
+the workers never compete for SQLite's write lock. Workers that die are
+restarted, and SIGINT or SIGTERM stops everything, once the workers have
+finished the requests in progress.
+
+Usage:
+
+    python app_server.py [--app api|html] [--host HOST] [--port PORT]
+                         [--workers N] [--database FILE]
+                         [--response-cache FILE] [--quiet]
+
+This uses os.fork, so it runs on POSIX systems only.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import argparse
+import importlib
+import os
+import secrets
+import signal
+import socket
+import sys
+import threading
+from multiprocessing.connection import Listener
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app_db import AppointmentDatabase
+from app_writer import WriteQueue, serve_write_queue
+
+APPS = {'api': 'app_api', 'html': 'app_api_html'}
+
+
+class ServerStop(Exception):
+    """
+    Raised in the main process by SIGINT and SIGTERM.
+    """
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """
+    A request handler that doesn't log every request.
+    """
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def fork(target, *args):
+    """
+    Run target(*args) in a child process, which exits when it returns.
+
+    :return: the pid of the child
+    """
+    pid = os.fork()
+
+    if pid == 0:
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            target(*args)
+        except BaseException:
+            status = 1
+            sys.excepthook(*sys.exc_info())
+        finally:
+            os._exit(status)
+
+    return pid
+
+
+def run_writer(database, listener, batch_size, batch_delay):
+    """
+    The writer process: commit the writes sent by the workers.
+    """
+    write_queue = WriteQueue(database, batch_size, batch_delay)
+
+    def stop(signum, frame):
+        listener.close()
+
+    # The writer is stopped by serve() after the workers, so it ignores a
+    # Ctrl-C sent to the whole process group.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        serve_write_queue(write_queue, listener)
+    finally:
+        write_queue.close()
+
+
+def run_worker(app, sock, host, port, database, write_server, quiet):
+    """
+    A worker process: serve requests from the shared socket.
+    """
+    app.config['DATABASE'] = database
+    app.config['DATABASE_READ_ONLY'] = True
+    app.config['WRITE_SERVER'] = write_server
+
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno(),
+                         request_handler=QuietRequestHandler if quiet
+                         else None)
+    # Wait for the requests in progress when the server stops.
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, which it can't
+        # while this handler runs on its thread.
+        threading.Thread(target=server.shutdown).start()
+
+    # Like the writer, a worker is stopped by serve() with SIGTERM, which
+    # lets it finish its requests.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def serve(app, host, port, workers, database, quiet=False):
+    """
+    Start the writer and the workers and restart them when they die, until
+    SIGINT or SIGTERM.
+
+    :param app: the Flask application
+    :param host: the host name or address to listen on
+    :param port: the port to listen on
+    :param workers: the number of worker processes
+    :param database: the name of the SQLite database file
+    :param quiet: True to not log every request
+    """
+    database = os.path.abspath(database)
+
+    # Create or migrate the database once, before any worker opens it
+    # read-only.
+    AppointmentDatabase(database).close()
+
+    authkey = secrets.token_bytes(32)
+    listener = Listener(family='AF_UNIX', authkey=authkey)
+    write_server = (listener.address, authkey)
+
+    sock = socket.create_server((host, port), backlog=1024)
+    sock.set_inheritable(True)
+
+    def start_writer():
+        return fork(run_writer, database, listener,
+                    app.config['WRITE_BATCH_SIZE'],
+                    app.config['WRITE_BATCH_DELAY'])
+
+    def start_worker():
+        return fork(run_worker, app, sock, host, port, database,
+                    write_server, quiet)
+
+    writer = start_writer()
+    children = {start_worker(): start_worker for _ in range(workers)}
+    children[writer] = start_writer
+
+    def stop(signum, frame):
+        raise ServerStop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print('serving on http://{}:{} with {} workers'.format(
+        host, port, workers))
+
+    try:
+        while True:
+            pid, _ = os.wait()
+
+            start = children.pop(pid, None)
+            if start is not None:
+                children[start()] = start
+    except (ServerStop, ChildProcessError):
+        pass
+
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Stop the workers first, so that the writer can finish their writes.
+    for kind in (start_worker, start_writer):
+        for pid, start in children.items():
+            if start is kind:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except (ProcessLookupError, ChildProcessError):
+                    pass
+
+    sock.close()
+    listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve app_api or '
+                                     'app_api_html with several processes.')
+    parser.add_argument('--app', choices=sorted(APPS), default='api')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--database',
+                        help="the database file (default: the app's "
+                             "DATABASE config value)")
+    parser.add_argument('--response-cache', metavar='FILE',
+                        help='the file that the workers share the '
+                             'responses of expensive views through '
+                             '(default: none)')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't log every request")
+    args = parser.parse_args()
+
+    app = importlib.import_module(APPS[args.app]).app
+
+    if args.response_cache:
+        app.config['RESPONSE_CACHE_FILE'] = os.path.abspath(
+            args.response_cache)
+
+    serve(app, args.host, args.port, args.workers,
+          args.database or app.config['DATABASE'], args.quiet)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+This module contains SlowQueryLog, which records every statement run by an
+instrumented AppointmentDatabase that takes longer than a threshold, with
+its parameters and query plan, to a rotating log file.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Statements that EXPLAIN QUERY PLAN can describe.
+_EXPLAINABLE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b',
+                          re.IGNORECASE)
+
+# Names the app table is given in a statement, such as 'a' in 'FROM app a'.
+_APP_ALIAS = re.compile(r'\bapp\s+(?:AS\s+)?([A-Za-z_]\w*)', re.IGNORECASE)
+_NOT_ALIASES = {'WHERE', 'JOIN', 'INNER', 'LEFT', 'CROSS', 'NATURAL', 'ON',
+                'USING', 'ORDER', 'GROUP', 'LIMIT', 'SET', 'VALUES',
+                'INDEXED', 'NOT', 'WINDOW', 'UNION', 'EXCEPT', 'INTERSECT'}
+
+_SCAN = re.compile(r'^SCAN (\w+)')
+
+# One file handler per log file in this process, shared by every
+# SlowQueryLog writing to it so that rotation isn't done twice.
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+def _get_handler(path, max_bytes, backup_count):
+    key = os.path.abspath(path)
+
+    with _handlers_lock:
+        if key not in _handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                key, maxBytes=max_bytes, backupCount=backup_count,
+                delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            _handlers[key] = handler
+
+        return _handlers[key]
+
+
+def app_table_names(sql):
+    """
+    :param sql: an SQL statement
+    :return: the set of names under which the statement refers to the app
+    table
+    """
+    names = {'app'}
+
+    for alias in _APP_ALIAS.findall(sql):
+        if alias.upper() not in _NOT_ALIASES:
+            names.add(alias)
+
+    return names
+
+
+def explain(conn, sql, parameters):
+    """
+    Return the query plan of a statement, one line per step.
+
+    :param conn: the connection the statement was run on
+    :param sql: the statement
+    :param parameters: the parameters it was run with
+    :return: list of plan lines, or None if the statement has no plan
+    """
+    if parameters is None or not _EXPLAINABLE.match(sql):
+        return None
+
+    # A plain cursor, so that the EXPLAIN itself isn't instrumented.
+    cur = conn.cursor(sqlite3.Cursor)
+
+    try:
+        cur.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+        return [row[3] for row in cur.fetchall()]
+    except sqlite3.Error as error:
+        return ['plan unavailable: {}'.format(error)]
+    finally:
+        cur.close()
+
+
+class SlowQueryLog:
+    """
+    Writes one JSON line per slow statement to a size-rotated log file. Each
+    line holds the statement, its parameters, how long it took, its query
+    plan, and whether the plan scans the whole app table.
+    """
+
+    def __init__(self, path, threshold=0.1, max_bytes=10 * 1024 * 1024,
+                 backup_count=5):
+        """
+        :param path: path of the log file
+        :param threshold: seconds a statement may take before it is logged
+        :param max_bytes: size at which the log file is rotated
+        :param backup_count: number of rotated files kept
+        """
+        self.path = path
+        self.threshold = threshold
+
+        self.logger = logging.Logger('slow_queries')
+        self.logger.addHandler(_get_handler(path, max_bytes, backup_count))
+
+    def record(self, conn, sql, parameters, seconds, executions=1):
+        """
+        Log a slow statement.
+
+        :param conn: the connection the statement was run on
+        :param sql: the statement
+        :param parameters: the parameters it was run with, or None if they
+        are unknown
+        :param seconds: time the statement took so far, including fetching
+        its rows
+        :param executions: number of parameter sets it was run with by
+        executemany, or None if unknown
+        """
+        plan = explain(conn, sql, parameters)
+
+        full_scan = False
+        if plan:
+            names = app_table_names(sql)
+            for line in plan:
+                match = _SCAN.match(line)
+                if match and match.group(1) in names:
+                    full_scan = True
+
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'duration_ms': round(seconds * 1000, 3),
+                 'statement': ' '.join(sql.split()),
+                 'parameters': parameters,
+                 'executions': executions,
+                 'plan': plan,
+                 'full_scan_of_app': full_scan}
+
+        self.logger.warning(json.dumps(entry, default=repr))
@@ -0,0 +1,327 @@
+"""
+This module contains WriteQueue, which funnels the writes of every request
+handler of a process through one writer thread that commits them in groups,
+so that concurrent writers neither wait on SQLite's write lock nor pay for
+a commit each. serve_write_queue and RemoteWriteQueue extend that to
+several processes, which send their writes to one writer process.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import os
+import pickle
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import Client
+
+from app_db import AppointmentDatabase
+
+# Methods whose names start with these can be queued.
+WRITE_PREFIXES = ('insert_', 'delete_')
+
+
+class WriteQueue:
+    """
+    Runs AppointmentDatabase write methods on a single writer thread.
+
+    Calls are queued and the writer takes them in batches of up to
+    'batch_size' calls, each run in one transaction. A batch holds the
+    calls that queued up while the previous one was committing; once a
+    call arrives, the writer also waits at most 'batch_delay' seconds for
+    more. Each call runs in its own savepoint, so a call that fails is
+    rolled back on its own and its caller gets the exception, while the
+    others commit.
+    Callers get their results only once the batch has committed.
+
+    Every insert_* and delete_* method of AppointmentDatabase is available
+    as a method of the same name that blocks until its batch has committed,
+    e.g. 'queue.insert_doctor("Amy")'. Use submit() to get a Future instead.
+    """
+
+    def __init__(self, sqlite_filename, batch_size=64, batch_delay=0.0,
+                 metrics=None, slow_log=None):
+        """
+        The writer's connection is opened and its thread started on first
+        use, and again after a fork.
+
+        :param sqlite_filename: the name of the SQLite database file
+        :param batch_size: maximum number of calls committed together
+        :param batch_delay: seconds to wait for more calls to join a batch
+        :param metrics: optional MetricsRegistry for the writer's connection
+        :param slow_log: optional SlowQueryLog for the writer's connection
+        """
+        self.sqlite_filename = sqlite_filename
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.metrics = metrics
+        self.slow_log = slow_log
+
+        self.batches = 0
+        self.operations = 0
+        # The schema version of the database, once the writer has opened it.
+        self.schema_version = None
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+    def start(self):
+        """
+        Open the writer's connection and start its thread, unless it is
+        already running in this process.
+        """
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self._closed:
+            raise RuntimeError('the write queue is closed')
+
+        # A thread doesn't survive a fork, so a child starts its own.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+
+        db = AppointmentDatabase(self.sqlite_filename, self.metrics,
+                                 self.slow_log)
+        self.schema_version = db.schema_version
+
+        self._pid = os.getpid()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(db, self._queue),
+                                        name='db-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, name, *args, **kwargs):
+        """
+        Queue a call of an AppointmentDatabase write method.
+
+        :param name: name of the method
+        :return: a concurrent.futures.Future for the method's return value
+        """
+        if not name.startswith(WRITE_PREFIXES):
+            raise ValueError('{} is not a write method'.format(name))
+
+        future = Future()
+
+        with self._lock:
+            self._start()
+            self._queue.put((future, name, args, kwargs))
+
+        return future
+
+    def __getattr__(self, name):
+        if (not name.startswith(WRITE_PREFIXES)
+                or not callable(getattr(AppointmentDatabase, name, None))):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self.submit(name, *args, **kwargs).result()
+
+        return call
+
+    def _run(self, db, calls):
+        """
+        The writer thread: take batches of calls from the queue and commit
+        them until close() queues None.
+        """
+        stopping = False
+
+        try:
+            while not stopping:
+                item = calls.get()
+                if item is None:
+                    break
+
+                batch = [item]
+                deadline = time.monotonic() + self.batch_delay
+
+                while len(batch) < self.batch_size:
+                    try:
+                        item = calls.get(
+                            timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+
+                    if item is None:
+                        stopping = True
+                        break
+
+                    batch.append(item)
+
+                self._commit(db, batch)
+        finally:
+            db.close()
+
+    def _commit(self, db, batch):
+        """
+        Run a batch of calls in one transaction and hand out their results.
+        """
+        outcomes = []
+
+        try:
+            with db._transaction():
+                for future, name, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+
+                    try:
+                        with db._transaction():
+                            result = getattr(db, name)(*args, **kwargs)
+                    except Exception as error:
+                        outcomes.append((future, None, error))
+                    else:
+                        outcomes.append((future, result, None))
+        except Exception as error:
+            # Nothing in the batch was committed.
+            for future, _, _, _ in batch:
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.operations += len(outcomes)
+
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        """
+        Commit the calls already queued, then stop the writer thread and
+        close its connection. Later calls raise RuntimeError.
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread if self._pid == os.getpid() else None
+
+            if thread is not None:
+                self._queue.put(None)
+
+        if thread is not None:
+            thread.join()
+
+
+def serve_write_queue(write_queue, listener):
+    """
+    Run the calls sent by RemoteWriteQueues through a WriteQueue, until the
+    listener is closed. Each connection is served by its own thread, so the
+    calls of concurrent clients are committed together.
+
+    :param write_queue: the WriteQueue to run the calls with
+    :param listener: a multiprocessing.connection.Listener
+    """
+    def serve(connection):
+        with connection:
+            while True:
+                try:
+                    name, args, kwargs = connection.recv()
+                except EOFError:
+                    return
+
+                try:
+                    future = write_queue.submit(name, *args, **kwargs)
+                    reply = ('result', future.result())
+                except Exception as error:
+                    reply = ('error', error)
+
+                try:
+                    connection.send(reply)
+                except pickle.PicklingError:
+                    connection.send(('error', RuntimeError(repr(reply[1]))))
+
+    while True:
+        try:
+            connection = listener.accept()
+        except OSError:
+            return
+
+        threading.Thread(target=serve, args=(connection,),
+                         daemon=True).start()
+
+
+class RemoteWriteQueue:
+    """
+    Sends AppointmentDatabase write calls to a WriteQueue served by
+    serve_write_queue in another process.
+
+    Like WriteQueue, every insert_* and delete_* method of
+    AppointmentDatabase is available as a method of the same name that
+    blocks until the call has committed, and raises the exception of the
+    call if it failed.
+    """
+
+    def __init__(self, address, authkey, sqlite_filename=None):
+        """
+        :param address: address of the listener of serve_write_queue
+        :param authkey: its authentication key
+        :param sqlite_filename: the name of the database file written by
+        the server, for reference
+        """
+        self.address = address
+        self.authkey = authkey
+        self.sqlite_filename = sqlite_filename
+
+        # Idle connections to the server, reused by later calls.
+        self._connections = deque()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def call(self, name, *args, **kwargs):
+        """
+        Run a write method in the writer process.
+
+        :param name: name of the method
+        :return: the method's return value
+        """
+        with self._lock:
+            # Connections can't be shared with a forked child.
+            if self._pid != os.getpid():
+                self._connections = deque()
+                self._pid = os.getpid()
+
+            connection = None
+            if self._connections:
+                connection = self._connections.pop()
+
+        if connection is None:
+            connection = Client(self.address, authkey=self.authkey)
+
+        try:
+            connection.send((name, args, kwargs))
+            kind, value = connection.recv()
+        except BaseException:
+            connection.close()
+            raise
+
+        with self._lock:
+            self._connections.append(connection)
+
+        if kind == 'error':
+            raise value
+
+        return value
+
+    def __getattr__(self, name):
+        if (not name.startswith(WRITE_PREFIXES)
+                or not callable(getattr(AppointmentDatabase, name, None))):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        return call
+
+    def close(self):
+        """
+        Close the idle connections to the server.
+        """
+        with self._lock:
+            while self._connections:
+                self._connections.pop().close()
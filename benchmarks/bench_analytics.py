@@ -0,0 +1,69 @@
+"""
+Benchmark the /stats questions answered by SQL and by AppointmentColumns.
+
+For each grouping, the median time of AppointmentDatabase.get_app_stats
+and of AppointmentColumns.get_app_stats is printed, after the time taken
+to load the columnar copy. The databases are seeded by suite.py and kept in
+benchmarks/data.
+
+Usage: python benchmarks/bench_analytics.py [SIZE]
+
+Written by Minhwa (Mina) Lee
+"""
+
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app_analytics import AppointmentColumns  # noqa: E402
+from app_db import AppointmentDatabase  # noqa: E402
+from suite import open_database, parse_size  # noqa: E402
+
+QUESTIONS = [(['doctor'], None), (['symptom'], None), (['age'], None),
+             (['gender'], None), (['doctor', 'month'], None),
+             (['month', 'gender'], None),
+             (['symptom', 'age'], {'gender': 'Female'}),
+             (['doctor', 'symptom'], {'month': 'May'}),
+             (['age'], {'doctor': 'Doctor3', 'age_min': 30})]
+
+
+def median_time(function, repeat):
+    """
+    :return: the median time of repeat calls of function in milliseconds
+    """
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings) * 1000
+
+
+def main():
+    size = parse_size(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data')
+
+    db = AppointmentDatabase(open_database(data_dir, size))
+    columns = AppointmentColumns()
+
+    start = time.perf_counter()
+    columns.refresh(db)
+    print('loaded {} appointments in {:.1f}s'.format(
+        len(columns), time.perf_counter() - start))
+
+    for by, filters in QUESTIONS:
+        sql = median_time(lambda: db.get_app_stats(by, filters), 3)
+        numpy = median_time(lambda: columns.get_app_stats(by, filters), 20)
+
+        print('{:40s} sql {:9.1f} ms   numpy {:7.1f} ms'.format(
+            '{} {}'.format(','.join(by), filters or ''), sql, numpy))
+
+
+if __name__ == '__main__':
+    main()
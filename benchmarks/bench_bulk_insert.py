@@ -0,0 +1,53 @@
+"""
+Benchmark the throughput of AppointmentDatabase.insert_apps_bulk.
+
+Usage: python benchmarks/bench_bulk_insert.py [COUNT] [CHUNK_SIZE] [TARGET]
+
+Exits with status 1 if fewer than TARGET appointments per second (default
+40000) were inserted. Most of the time goes to the seven indexes of the app
+table and to calling app_counts_insert for every row, which SQLite does even
+while the counts are deferred; the 50k/s first aimed for is only reached
+without that trigger.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app_db import APP_FIELDS, AppointmentDatabase  # noqa: E402
+from bench_insert_app import sample_app  # noqa: E402
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    target = int(sys.argv[3]) if len(sys.argv) > 3 else 40000
+
+    # Patients repeat, as they do in real appointment histories.
+    apps = [dict(zip(APP_FIELDS, sample_app(i % 10000)))
+            for i in range(count)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = AppointmentDatabase(os.path.join(directory, 'bench.sqlite'))
+
+        start = time.perf_counter()
+        db.insert_apps_bulk(apps, chunk_size=chunk_size)
+        elapsed = time.perf_counter() - start
+
+        db.close()
+
+    print('inserted {} appointments in {:.2f}s: {:.0f} appointments/s'.format(
+        count, elapsed, count / elapsed))
+
+    if count / elapsed < target:
+        print('below the target of {} appointments/s'.format(target))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
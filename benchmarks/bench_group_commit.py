@@ -0,0 +1,93 @@
+"""
+Benchmark concurrent appointment inserts with and without WriteQueue.
+
+'direct' gives every thread its own AppointmentDatabase, as the connection
+pool does, so the threads compete for SQLite's write lock and commit one
+appointment each. 'queue' sends every insert through one WriteQueue, which
+commits them in groups. For each number of threads, the throughput and the
+number of failed inserts (e.g. 'database is locked') are printed.
+
+Usage: python benchmarks/bench_group_commit.py [INSERTS_PER_THREAD]
+                                                [BATCH_DELAY]
+
+Written by Minhwa (Mina) Lee
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app_db import AppointmentDatabase  # noqa: E402
+from app_writer import WriteQueue  # noqa: E402
+from bench_insert_app import sample_app  # noqa: E402
+
+THREAD_COUNTS = (1, 4, 16, 64)
+
+
+def run(mode, threads, count, batch_delay=0.0):
+    """
+    Insert threads * count appointments from the given number of threads.
+    batch_delay is passed to the WriteQueue.
+
+    :return: (seconds taken, number of failed inserts)
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.sqlite')
+        AppointmentDatabase(path).close()
+
+        writer = None
+        if mode == 'queue':
+            writer = WriteQueue(path, batch_delay=batch_delay)
+        failures = []
+
+        def work(thread):
+            if writer is None:
+                db = AppointmentDatabase(path)
+                insert = db.insert_app
+            else:
+                insert = writer.insert_app
+
+            for i in range(count):
+                try:
+                    insert(*sample_app(thread * count + i))
+                except sqlite3.OperationalError:
+                    failures.append(1)
+
+            if writer is None:
+                db.close()
+
+        workers = [threading.Thread(target=work, args=(thread,))
+                   for thread in range(threads)]
+
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+
+        if writer is not None:
+            writer.close()
+
+    return seconds, len(failures)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    batch_delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+
+    for threads in THREAD_COUNTS:
+        for mode in ('direct', 'queue'):
+            seconds, failures = run(mode, threads, count, batch_delay)
+            print('{:6s} threads={:3d} inserts={:6d} {:8.0f}/s '
+                  'failed={}'.format(mode, threads, threads * count,
+                                     threads * count / seconds, failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark the per-appointment latency of AppointmentDatabase.insert_app.
+
+'before' replays the original implementation, which called insert_doctor,
+insert_symptoms and insert_patient (one commit each), looked every row up
+again by name, inserted the appointment, committed and re-read it.
+'after' is the current single-transaction insert_app.
+
+Usage: python benchmarks/bench_insert_app.py [COUNT]
+
+Written by Minhwa (Mina) Lee
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app_db import AppointmentDatabase  # noqa: E402
+
+DOCTORS = ['Amy', 'Robert', 'Nathan', 'Claire', 'Mary']
+SYMPTOMS = ['Headache', 'Knee sprain', 'Stomachache', 'Mental clinic',
+            'Waist pain']
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June']
+
+
+def legacy_insert_app(db, patient_first, patient_last, gender, age, birth,
+                      doctor, month, symptom):
+    """
+    The insert_app implementation before it was made transactional.
+    """
+    cur = db.conn.cursor()
+
+    db.insert_doctor(doctor)
+    db.insert_symptoms(symptom)
+    db.insert_patient(patient_first, patient_last, gender, age, birth)
+
+    doctor_id = db.get_doctor_by_name(doctor)['doctor_id']
+    symptom_id = db.get_symptoms_by_name(symptom)['symptom_id']
+    patient_id = db.get_patient_by_name(patient_first,
+                                        patient_last)['patient_id']
+
+    cur.execute('INSERT INTO app(patient_id, doctor_id, month, symptom_id)'
+                'VALUES(?, ?, ?, ?)', (patient_id, doctor_id, month,
+                                       symptom_id))
+    db.conn.commit()
+
+    return db.get_app_by_id(cur.lastrowid)
+
+
+def sample_app(i):
+    """
+    :return: the arguments of insert_app for the i-th synthetic appointment
+    """
+    return ('First{}'.format(i), 'Last{}'.format(i),
+            'Female' if i % 2 else 'Male', 20 + i % 60, '1990-01-01',
+            DOCTORS[i % len(DOCTORS)], MONTHS[i % len(MONTHS)],
+            SYMPTOMS[i % len(SYMPTOMS)])
+
+
+def run(insert, count):
+    """
+    Insert count appointments into a fresh database with the given insert
+    function and return the latency of each call in microseconds.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        db = AppointmentDatabase(os.path.join(directory, 'bench.sqlite'))
+        timings = []
+
+        for i in range(count):
+            args = sample_app(i)
+            start = time.perf_counter()
+            insert(db, *args)
+            timings.append((time.perf_counter() - start) * 1e6)
+
+        db.close()
+
+    return timings
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    results = {
+        'before': run(legacy_insert_app, count),
+        'after': run(AppointmentDatabase.insert_app, count),
+    }
+
+    for name, timings in results.items():
+        timings.sort()
+        print('{:6s} n={} median={:.1f}us p95={:.1f}us mean={:.1f}us'.format(
+            name, count, statistics.median(timings),
+            timings[int(len(timings) * 0.95)], statistics.mean(timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark the read queries of AppointmentDatabase with and without the
+statement cache of the connection.
+
+Each case is timed on a connection that compiles every statement again
+(no statement cache), on one with sqlite3's default cache of 128
+statements, and on one with STATEMENT_CACHE_SIZE. The 'filters' case cycles
+through every combination of filters and orders of get_apps_page, which
+makes more different statements than the default cache holds. The
+databases are seeded by suite.py and kept in benchmarks/data.
+
+Usage: python benchmarks/bench_queries.py [SIZE]
+
+Written by Minhwa (Mina) Lee
+"""
+
+import itertools
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_db  # noqa: E402
+from app_db import APP_SORT_KEYS, AppointmentDatabase  # noqa: E402
+from suite import (DOCTOR_COUNT, MONTHS, open_database,  # noqa: E402
+                   parse_size)
+
+CACHE_SIZES = (0, 128, app_db.STATEMENT_CACHE_SIZE)
+
+# Number of calls of each case per cache size.
+CALLS = 2000
+
+# Values of the filters cycled through by the 'filters' case. Every
+# combination also filters on one patient, so that the statements are quick
+# to run and the time to compile them shows.
+FILTER_VALUES = {'doctor': 'Doctor0', 'month': MONTHS[0], 'age_min': 30,
+                 'gender': 'Female'}
+
+
+def filter_combinations():
+    """
+    :return: list of (filters, sort) pairs, one for every combination of
+    the filters of FILTER_VALUES and every order
+    """
+    filter_sets = [dict(combination, patient_id=1)
+                   for size in range(len(FILTER_VALUES) + 1)
+                   for combination in itertools.combinations(
+                       FILTER_VALUES.items(), size)]
+    sorts = [prefix + key for key in APP_SORT_KEYS for prefix in ('', '-')]
+
+    return list(itertools.product(filter_sets, sorts))
+
+
+def cases(size, rng):
+    """
+    :return: list of (name, function) pairs, where function runs the case
+    once on a database
+    """
+    combinations = filter_combinations()
+    counter = itertools.count()
+
+    def filters(db):
+        page_filters, sort = combinations[next(counter) % len(combinations)]
+        db.get_apps_page(10, sort=sort, filters=page_filters)
+
+    return [
+        ('get_app_by_id', lambda db: db.get_app_by_id(
+            rng.randint(1, size))),
+        ('get_apps_by_doctor_id', lambda db: db.get_apps_by_doctor_id(
+            rng.randint(1, DOCTOR_COUNT), 10)),
+        ('get_apps_by_month', lambda db: db.get_apps_by_month(
+            rng.choice(MONTHS), 10)),
+        ('get_doctor_by_name', lambda db: db.get_doctor_by_name(
+            'Doctor{}'.format(rng.randrange(DOCTOR_COUNT)))),
+        ('get_patient_by_id', lambda db: db.get_patient_by_id(
+            rng.randint(1, size))),
+        ('filters ({} statements)'.format(len(combinations)), filters)]
+
+
+def main():
+    size = parse_size(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data')
+
+    # Seed and migrate the database once.
+    path = open_database(data_dir, size)
+    AppointmentDatabase(path).close()
+
+    print('{:32s}'.format('median us per call') + ''.join(
+        '{:>12s}'.format('cache {}'.format(cache_size))
+        for cache_size in CACHE_SIZES))
+
+    for name, _ in cases(size, random.Random(0)):
+        medians = []
+
+        for cache_size in CACHE_SIZES:
+            app_db.STATEMENT_CACHE_SIZE = cache_size
+            db = AppointmentDatabase(path)
+            function = dict(cases(size, random.Random(0)))[name]
+
+            timings = []
+            for _ in range(CALLS):
+                start = time.perf_counter()
+                function(db)
+                timings.append(time.perf_counter() - start)
+
+            db.close()
+            medians.append(statistics.median(timings) * 1e6)
+
+        print('{:32s}'.format(name) + ''.join(
+            '{:12.1f}'.format(median) for median in medians))
+
+
+if __name__ == '__main__':
+    main()
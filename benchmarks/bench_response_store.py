@@ -0,0 +1,94 @@
+"""
+Benchmark the first request of a cold worker to the expensive views of
+app_api, with and without the ResponseStore.
+
+Without the store, a worker that has just started, or that hasn't served a
+request yet, runs the view. With it, the body built by another worker (or
+before a restart) is read from the file. Each request is timed with the
+in-memory response cache emptied first. The databases are seeded by
+suite.py and kept in benchmarks/data.
+
+Usage: python benchmarks/bench_response_store.py [SIZE]
+
+Written by Minhwa (Mina) Lee
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_api  # noqa: E402
+import app_resources  # noqa: E402
+from app_db import AppointmentDatabase  # noqa: E402
+from app_migrations import month_start  # noqa: E402
+from suite import open_database, parse_size  # noqa: E402
+
+# Number of timed requests per route and setting.
+REPEAT = 5
+
+
+def routes():
+    """
+    :return: list of the URLs timed
+    """
+    april = month_start('April')
+
+    return ['/stats', '/stats?by=doctor,month', '/app_doctors',
+            '/app_months', '/apps?doctor=Doctor1&month=May&sort=-age',
+            '/app_days?from={}&to={}'.format(april, april + 28 * 86400)]
+
+
+def cold_request(client, url):
+    """
+    :return: the time in milliseconds of a request to url with an empty
+    in-memory response cache
+    """
+    app_api.response_cache.bodies.clear()
+
+    start = time.perf_counter()
+    response = client.get(url)
+    elapsed = time.perf_counter() - start
+
+    assert response.status_code == 200, url
+    return elapsed * 1000
+
+
+def main():
+    size = parse_size(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data')
+
+    path = open_database(data_dir, size)
+    AppointmentDatabase(path).close()
+
+    app_api.app.config['DATABASE'] = path
+    app_api.app.config['METRICS_ENABLED'] = False
+    app_api.app.config['SLOW_QUERY_LOG'] = None
+    client = app_api.app.test_client()
+
+    print('{:48s}{:>14s}{:>14s}'.format('median ms of a cold request',
+                                        'no store', 'store hit'))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for url in routes():
+            app_api.app.config['RESPONSE_CACHE_FILE'] = None
+            without = [cold_request(client, url) for _ in range(REPEAT)]
+
+            app_api.app.config['RESPONSE_CACHE_FILE'] = os.path.join(
+                directory, 'responses.sqlite')
+            # Another worker builds and stores the body.
+            cold_request(client, url)
+            hits = [cold_request(client, url) for _ in range(REPEAT)]
+
+            print('{:48s}{:14.2f}{:14.2f}'.format(
+                url, statistics.median(without), statistics.median(hits)))
+
+        app_resources.get_response_store(app_api.app).close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,704 @@
+"""
+Benchmark suite for AppointmentDatabase and the REST endpoints.
+
+Seeds synthetic databases of the requested sizes (number of appointments),
+times every AppointmentDatabase method and the Flask routes (through the
+test client) against them, and writes p50/p95/p99 latency and throughput
+for each case as JSON, so that runs can be compared.
+
+Usage:
+
+    python benchmarks/suite.py run [--sizes 10k,1m,10m] [--output FILE]
+                                   [--data-dir DIR] [--iterations N]
+    python benchmarks/suite.py compare OLD.json NEW.json [--threshold PCT]
+    python benchmarks/suite.py scale [--workers 1,2,4] [--size 10k]
+                                     [--clients N] [--duration SECONDS]
+
+Seeded databases are kept in --data-dir (benchmarks/data by default) and
+reused by later runs, since seeding 10 million appointments takes minutes.
+'compare' lists the cases whose p50 latency grew by more than the threshold
+and exits with status 1 if there are any. 'scale' measures the read
+throughput of app_server.py over HTTP for each number of worker processes.
+
+Written by Minhwa (Mina) Lee
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import http.client
+import multiprocessing
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import app_api  # noqa: E402
+import app_api_html  # noqa: E402
+from app_db import APP_FIELDS, AppointmentDatabase  # noqa: E402
+from app_migrations import month_start  # noqa: E402
+
+DOCTOR_COUNT = 50
+SYMPTOM_COUNT = 100
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December']
+
+DAY = 86400
+
+# Cases that read a whole table are run this many times at most.
+HEAVY_ITERATIONS = 3
+
+# Above this many appointments, cases that read the whole app table are
+# skipped.
+HEAVY_SIZE_LIMIT = 1000000
+
+
+def parse_size(text):
+    """
+    :param text: a size such as 10000, 10k or 1m
+    :return: the size as an integer
+    """
+    text = text.strip().lower()
+    multiplier = {'k': 1000, 'm': 1000000}.get(text[-1:], 1)
+
+    if multiplier != 1:
+        text = text[:-1]
+
+    return int(float(text) * multiplier)
+
+
+def seed_database(path, size):
+    """
+    Create a database at path holding size synthetic appointments, with
+    one patient per ten appointments. The rows are generated in SQL, which
+    is much faster than inserting them through AppointmentDatabase.
+
+    :param path: path of the database file to create
+    :param size: number of appointments
+    """
+    db = AppointmentDatabase(path)
+    patient_count = max(1, size // 10)
+    cur = db.conn.cursor()
+
+    cur.execute('BEGIN')
+    cur.executemany('INSERT INTO doctors(doctor) VALUES(?)',
+                    [('Doctor{}'.format(i),) for i in range(DOCTOR_COUNT)])
+    cur.executemany('INSERT INTO symptoms(symptom) VALUES(?)',
+                    [('Symptom{}'.format(i),) for i in range(SYMPTOM_COUNT)])
+    cur.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                'SELECT i + 1 FROM n WHERE i < ?) '
+                'INSERT INTO patients(FirstN, LastN, gender, age, birth) '
+                "SELECT 'First' || i, 'Last' || i, "
+                "CASE i % 2 WHEN 0 THEN 'Female' ELSE 'Male' END, "
+                "i % 90, '1990-01-01' FROM n", (patient_count,))
+
+    # Each appointment is at a random quarter hour of the first 28 days of
+    # its month.
+    months = ', '.join("('{}', {})".format(month, month_start(month))
+                       for month in MONTHS)
+    cur.execute('CREATE TEMP TABLE months(month TEXT, start INTEGER)')
+    cur.execute('INSERT INTO months VALUES {}'.format(months))
+    cur.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                'SELECT i + 1 FROM n WHERE i < ?) '
+                'INSERT INTO app(patient_id, doctor_id, month, symptom_id, '
+                'scheduled_at) '
+                'SELECT 1 + abs(random()) % ?, 1 + i % ?, month, '
+                '1 + abs(random()) % ?, start + 900 * (abs(random()) % ?) '
+                'FROM n JOIN temp.months ON months.rowid = 1 + i % 12',
+                (size, patient_count, DOCTOR_COUNT, SYMPTOM_COUNT,
+                 28 * DAY // 900))
+    cur.execute('DROP TABLE temp.months')
+    db.conn.commit()
+
+    cur.execute('ANALYZE')
+    db.close()
+
+
+def open_database(data_dir, size):
+    """
+    Return the path of the seeded database of the given size, seeding it
+    first if it doesn't exist yet.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, 'bench_{}.sqlite'.format(size))
+
+    if not os.path.isfile(path):
+        print('seeding {} appointments into {}'.format(size, path))
+        start = time.perf_counter()
+        seed_database(path + '.tmp', size)
+        os.replace(path + '.tmp', path)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(path + '.tmp' + suffix):
+                os.remove(path + '.tmp' + suffix)
+        print('seeded in {:.1f}s'.format(time.perf_counter() - start))
+
+    return path
+
+
+def reset_database(db, size):
+    """
+    Remove the rows added by the write cases of an earlier run, so that
+    every run starts from the seeded data set.
+    """
+    patient_count = max(1, size // 10)
+
+    # Through _transaction, so that the data versions are bumped and no
+    # response cached before the reset is served after it.
+    with db._transaction() as cur:
+        cur.execute('DELETE FROM app WHERE app_id > ?', (size,))
+        cur.execute('DELETE FROM patients WHERE patient_id > ?',
+                    (patient_count,))
+        cur.execute('DELETE FROM doctors WHERE doctor_id > ?',
+                    (DOCTOR_COUNT,))
+        cur.execute('DELETE FROM symptoms WHERE symptom_id > ?',
+                    (SYMPTOM_COUNT,))
+        db._touch('app', 'patients', 'doctors', 'symptoms')
+
+    db.clear_name_caches()
+
+
+def summarize(timings, operations):
+    """
+    :param timings: list of latencies in seconds
+    :param operations: number of operations done per timed call
+    :return: dict of latency percentiles (ms) and throughput (ops/s)
+    """
+    timings = sorted(timings)
+
+    def percentile(fraction):
+        index = int(round(fraction * (len(timings) - 1)))
+        return timings[index] * 1000
+
+    total = sum(timings)
+
+    return {'n': len(timings),
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'mean_ms': total / len(timings) * 1000,
+            'ops_per_sec': len(timings) * operations / total if total else 0}
+
+
+class Case:
+    """
+    One benchmark case: a function that is timed, called with a fresh
+    argument from make_args for every iteration.
+    """
+
+    def __init__(self, name, function, make_args=tuple, heavy=False,
+                 operations=1):
+        """
+        :param name: name of the case in the report
+        :param function: the function to time
+        :param make_args: function returning the arguments of one call
+        :param heavy: True if the case reads the whole app table
+        :param operations: number of operations done by one call, for the
+        throughput
+        """
+        self.name = name
+        self.function = function
+        self.make_args = make_args
+        self.heavy = heavy
+        self.operations = operations
+
+    def run(self, iterations):
+        """
+        :return: list of the latencies of each call in seconds
+        """
+        if self.heavy:
+            iterations = min(iterations, HEAVY_ITERATIONS)
+
+        timings = []
+
+        for _ in range(iterations):
+            args = self.make_args()
+            start = time.perf_counter()
+            self.function(*args)
+            timings.append(time.perf_counter() - start)
+
+        return timings
+
+
+def database_cases(db, size, rng):
+    """
+    Return the benchmark cases for the AppointmentDatabase methods. Write
+    cases add rows with new names and the delete cases remove some of
+    them; reset_database removes the rest after the run.
+    """
+    patient_count = max(1, size // 10)
+    counter = itertools.count(int(time.time() * 1000))
+    inserted = {'app': [], 'patients': [], 'doctors': [], 'symptoms': []}
+
+    def app_id():
+        return (rng.randint(1, size),)
+
+    def week_start():
+        return (month_start(rng.choice(MONTHS)) + rng.randrange(22) * DAY,)
+
+    def patient_id():
+        return (rng.randint(1, patient_count),)
+
+    def patient_name():
+        i = rng.randint(1, patient_count)
+        return ('First{}'.format(i), 'Last{}'.format(i))
+
+    def search_text():
+        # What is typed into a search box: the start of a patient's name.
+        name = 'First{}'.format(rng.randint(1, patient_count))
+        return (name[:rng.randint(2, len(name))],)
+
+    def new_app():
+        i = next(counter)
+        return ('BenchFirst{}'.format(i), 'BenchLast{}'.format(i), 'Female',
+                30, '1990-01-01', 'Doctor{}'.format(i % DOCTOR_COUNT),
+                MONTHS[i % 12], 'Symptom{}'.format(i % SYMPTOM_COUNT))
+
+    def insert_app(*args):
+        inserted['app'].append(db.insert_app(*args)['app_id'])
+
+    def insert_patient(*args):
+        inserted['patients'].append(db.insert_patient(*args)['patient_id'])
+
+    def insert_doctor(name):
+        inserted['doctors'].append(db.insert_doctor(name)['doctor_id'])
+
+    def insert_symptom(name):
+        inserted['symptoms'].append(db.insert_symptoms(name)['symptom_id'])
+
+    def new_bulk():
+        return ([dict(zip(APP_FIELDS, new_app())) for _ in range(1000)],)
+
+    def insert_bulk(apps):
+        inserted['app'].extend(result['app_id'] for result in
+                               db.insert_apps_bulk(apps)
+                               if 'app_id' in result)
+
+    def pop(table):
+        return lambda: (inserted[table].pop() if inserted[table] else 0,)
+
+    def new_name(prefix):
+        return lambda: ('{}{}'.format(prefix, next(counter)),)
+
+    def consume(batches):
+        for _ in batches:
+            pass
+
+    return [
+        Case('get_app_by_id', db.get_app_by_id, app_id),
+        Case('get_all_apps', db.get_all_apps, heavy=True),
+        Case('iter_all_apps', lambda: consume(db.iter_all_apps()),
+             heavy=True),
+        Case('get_apps_page', lambda after: db.get_apps_page(100, after),
+             app_id),
+        Case('get_apps_page (doctor, month)',
+             lambda doctor, month: db.get_apps_page(
+                 100, filters={'doctor': doctor, 'month': month}),
+             lambda: ('Doctor{}'.format(rng.randrange(DOCTOR_COUNT)),
+                      rng.choice(MONTHS))),
+        Case('get_app_counts_by_doctor', db.get_app_counts_by_doctor),
+        Case('get_app_counts_by_month', db.get_app_counts_by_month),
+        Case('get_app_stats (gender)', db.get_app_stats,
+             lambda: (['gender'],)),
+        Case('get_app_stats (doctor, month)', db.get_app_stats,
+             lambda: (['doctor', 'month'],)),
+        Case('get_apps_by_doctor_id',
+             lambda doctor: db.get_apps_by_doctor_id(doctor, 10),
+             lambda: (rng.randint(1, DOCTOR_COUNT),)),
+        Case('get_apps_by_month',
+             lambda month: db.get_apps_by_month(month, 10),
+             lambda: (rng.choice(MONTHS),)),
+        Case('get_apps_between (week)',
+             lambda start: db.get_apps_between(
+                 start, start + 7 * DAY, limit=100),
+             week_start),
+        Case('get_apps_between (doctor, week)',
+             lambda doctor, start: db.get_apps_between(
+                 start, start + 7 * DAY, doctor, limit=100),
+             lambda: (rng.randint(1, DOCTOR_COUNT),) + week_start()),
+        Case('find_free_slot',
+             lambda doctor, start: db.find_free_slot(doctor, start),
+             lambda: (rng.randint(1, DOCTOR_COUNT),) + week_start()),
+        Case('get_app_counts_by_day (month)',
+             lambda start: db.get_app_counts_by_day(start, start + 28 * DAY),
+             lambda: (month_start(rng.choice(MONTHS)),)),
+        Case('get_patient_by_id', db.get_patient_by_id, patient_id),
+        Case('get_patient_by_name', db.get_patient_by_name, patient_name),
+        Case('get_patients_page',
+             lambda after: db.get_patients_page(100, after), patient_id),
+        Case('get_all_patients', db.get_all_patients, heavy=True),
+        Case('get_doctor_by_id', db.get_doctor_by_id,
+             lambda: (rng.randint(1, DOCTOR_COUNT),)),
+        Case('get_doctor_by_name', db.get_doctor_by_name,
+             lambda: ('Doctor{}'.format(rng.randrange(DOCTOR_COUNT)),)),
+        Case('get_all_doctors', db.get_all_doctors),
+        Case('get_symptoms_by_id', db.get_symptoms_by_id,
+             lambda: (rng.randint(1, SYMPTOM_COUNT),)),
+        Case('get_symptoms_by_name', db.get_symptoms_by_name,
+             lambda: ('Symptom{}'.format(rng.randrange(SYMPTOM_COUNT)),)),
+        Case('get_all_symptoms', db.get_all_symptoms),
+        Case('search', db.search, search_text),
+        Case('get_data_versions', db.get_data_versions,
+             lambda: (['app', 'patients', 'doctors', 'symptoms'],)),
+        Case('insert_app', insert_app, new_app),
+        Case('insert_apps_bulk_1000', insert_bulk, new_bulk,
+             operations=1000),
+        Case('insert_patient', insert_patient, lambda: new_app()[:5]),
+        Case('insert_doctor', insert_doctor, new_name('BenchDoctor')),
+        Case('insert_symptoms', insert_symptom, new_name('BenchSymptom')),
+        Case('delete_app', db.delete_app, pop('app')),
+        Case('delete_patient', db.delete_patient, pop('patients')),
+        Case('delete_doctor', db.delete_doctor, pop('doctors')),
+        Case('delete_symptom', db.delete_symptom, pop('symptoms')),
+    ]
+
+
+def route_cases(size, rng):
+    """
+    Return the benchmark cases for the Flask routes. Each GET route is
+    timed with the response cache emptied before every call ('cold') and
+    repeating one request with the cache in use ('cached').
+    """
+    api = app_api.app.test_client()
+    html = app_api_html.app.test_client()
+    counter = itertools.count(int(time.time() * 1000))
+    created = []
+
+    def get(client, module, url, cold):
+        def request(*args):
+            if cold:
+                module.response_cache.bodies.clear()
+            response = client.get(url.format(*args))
+            response.close()
+        return request
+
+    def app_id():
+        return (rng.randint(1, size),)
+
+    def week():
+        start = month_start(rng.choice(MONTHS)) + rng.randrange(22) * DAY
+        return start, start + 7 * DAY
+
+    def new_app():
+        i = next(counter)
+        return ({'FirstN': 'RouteFirst{}'.format(i),
+                 'LastN': 'RouteLast{}'.format(i), 'gender': 'Male',
+                 'age': '40', 'birth': '1980-01-01',
+                 'doctor': 'Doctor{}'.format(i % DOCTOR_COUNT),
+                 'month': MONTHS[i % 12],
+                 'symptom': 'Symptom{}'.format(i % SYMPTOM_COUNT)},)
+
+    def post_app(form):
+        created.append(api.post('/apps', data=form).json['app_id'])
+
+    def post_bulk(apps):
+        results = api.post('/apps/bulk', json=apps).json['results']
+        created.extend(result['app_id'] for result in results
+                       if 'app_id' in result)
+
+    def delete_app(app_id):
+        api.delete('/apps/{}'.format(app_id))
+
+    cases = []
+
+    gets = [(api, app_api, 'GET /apps', '/apps', tuple, False),
+            (api, app_api, 'GET /apps?after_id', '/apps?after_id={}',
+             app_id, False),
+            (api, app_api, 'GET /apps/<id>', '/apps/{}', app_id, False),
+            (api, app_api, 'GET /apps?doctor&month',
+             '/apps?doctor=Doctor{}&month={}',
+             lambda: (rng.randrange(DOCTOR_COUNT), rng.choice(MONTHS)),
+             False),
+            (api, app_api, 'GET /apps?from&to&sort', '/apps?from={}&to={}'
+             '&sort=scheduled_at', week, False),
+            (api, app_api, 'GET /apps?age_min&age_max&sort',
+             '/apps?age_min={0}&age_max={0}&sort=-age',
+             lambda: (rng.randrange(90),), False),
+            (api, app_api, 'GET /apps?stream=1', '/apps?stream=1', tuple,
+             True),
+            (api, app_api, 'GET /patients', '/patients', tuple, False),
+            (api, app_api, 'GET /doctors', '/doctors', tuple, False),
+            (api, app_api, 'GET /symptoms', '/symptoms', tuple, False),
+            (api, app_api, 'GET /app_doctors', '/app_doctors', tuple, False),
+            (api, app_api, 'GET /app_months', '/app_months', tuple, False),
+            (api, app_api, 'GET /app_days', '/app_days?from={}&to={}', week,
+             False),
+            (api, app_api, 'GET /stats', '/stats', tuple, False),
+            (api, app_api, 'GET /search', '/search?q={}',
+             lambda: ('First{}'.format(rng.randint(1, max(1, size // 10))),),
+             False),
+            (html, app_api_html, 'GET html /apps', '/apps', tuple, True),
+            (html, app_api_html, 'GET html /app_doctors', '/app_doctors',
+             tuple, False),
+            (html, app_api_html, 'GET html /app_months', '/app_months',
+             tuple, False)]
+
+    for client, module, name, url, make_args, heavy in gets:
+        cases.append(Case('{} (cold)'.format(name),
+                          get(client, module, url, True), make_args,
+                          heavy=heavy))
+
+        # The cached case repeats one request, so that it hits the cache.
+        args = make_args()
+        cases.append(Case('{} (cached)'.format(name),
+                          get(client, module, url, False), lambda a=args: a,
+                          heavy=heavy))
+
+    cases.extend([
+        Case('POST /apps', post_app, new_app),
+        Case('POST /apps/bulk (1000)', post_bulk,
+             lambda: ([new_app()[0] for _ in range(1000)],),
+             operations=1000),
+        Case('DELETE /apps/<id>', delete_app,
+             lambda: (created.pop() if created else 0,)),
+    ])
+
+    return cases
+
+
+def run_size(size, data_dir, iterations, seed):
+    """
+    Run every case against the seeded database of the given size.
+
+    :return: dict mapping case names to their statistics
+    """
+    path = open_database(data_dir, size)
+    rng = random.Random(seed)
+    results = {}
+
+    for module in (app_api, app_api_html):
+        module.app.config['DATABASE'] = path
+        # The cold cases time the views, not ResponseStore hits; those are
+        # timed by bench_response_store.py.
+        module.app.config['RESPONSE_CACHE_FILE'] = None
+
+    db = AppointmentDatabase(path)
+    reset_database(db, size)
+    cases = database_cases(db, size, rng) + route_cases(size, rng)
+
+    for case in cases:
+        if case.heavy and size > HEAVY_SIZE_LIMIT:
+            continue
+
+        results[case.name] = summarize(case.run(iterations), case.operations)
+        print('{:>10} {:40s} p50 {p50_ms:9.3f} ms  p99 {p99_ms:9.3f} ms  '
+              '{ops_per_sec:10.0f} ops/s'.format(size, case.name,
+                                                 **results[case.name]))
+
+    reset_database(db, size)
+    db.close()
+    return results
+
+
+def run(args):
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+
+    report = {'meta': {'date': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(),
+                       'sqlite': sqlite3.sqlite_version,
+                       'platform': platform.platform(),
+                       'cpus': os.cpu_count(),
+                       'iterations': args.iterations,
+                       'seed': args.seed},
+              'results': {}}
+
+    for size in sizes:
+        report['results'][str(size)] = run_size(size, args.data_dir,
+                                                args.iterations, args.seed)
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+    print('wrote', args.output)
+
+
+def load_client(port, size, duration, threads, seed):
+    """
+    Send GET /apps/<id> requests for random appointments to the server on
+    port from several threads, each over one keep-alive connection, for
+    duration seconds.
+
+    :return: list of the latencies of the requests in seconds
+    """
+    deadline = time.monotonic() + duration
+    timings = []
+
+    def work(thread):
+        rng = random.Random(seed * 1000 + thread)
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        own = []
+
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            connection.request('GET', '/apps/{}'.format(rng.randint(1, size)))
+            connection.getresponse().read()
+            own.append(time.perf_counter() - start)
+
+        connection.close()
+        timings.extend(own)
+
+    workers = [threading.Thread(target=work, args=(thread,))
+               for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return timings
+
+
+def start_server(path, workers):
+    """
+    Start app_server.py with the given number of workers on a free port and
+    wait until it answers.
+
+    :return: (the server process, its port)
+    """
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(BENCHMARKS_DIR),
+                                      'app_server.py'),
+         '--workers', str(workers), '--port', str(port), '--database', path,
+         '--quiet'], stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            connection.request('GET', '/apps/1')
+            connection.getresponse().read()
+            connection.close()
+            return server, port
+        except OSError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                server.terminate()
+                raise RuntimeError('app_server.py did not start')
+            time.sleep(0.1)
+
+
+def scale(args):
+    size = parse_size(args.size)
+    path = open_database(args.data_dir, size)
+    workers_counts = [int(count) for count in args.workers.split(',')]
+
+    report = {'meta': {'date': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(),
+                       'sqlite': sqlite3.sqlite_version,
+                       'platform': platform.platform(),
+                       'cpus': os.cpu_count(),
+                       'size': size,
+                       'clients': args.clients,
+                       'threads_per_client': args.threads,
+                       'duration': args.duration},
+              'results': {}}
+
+    for workers in workers_counts:
+        server, port = start_server(path, workers)
+
+        try:
+            with multiprocessing.Pool(args.clients) as clients:
+                results = clients.starmap(
+                    load_client, [(port, size, args.duration, args.threads,
+                                   client) for client in range(args.clients)])
+        finally:
+            server.terminate()
+            server.wait()
+
+        timings = [timing for result in results for timing in result]
+        stats = summarize(timings, 1)
+        stats['requests_per_sec'] = len(timings) / args.duration
+        report['results'][str(workers)] = stats
+
+        print('workers {:3d}  {:8.0f} requests/s  p50 {:7.3f} ms  '
+              'p99 {:7.3f} ms'.format(workers, stats['requests_per_sec'],
+                                      stats['p50_ms'], stats['p99_ms']))
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+    print('wrote', args.output)
+
+
+def compare(args):
+    with open(args.old) as old_file, open(args.new) as new_file:
+        old = json.load(old_file)['results']
+        new = json.load(new_file)['results']
+
+    regressions = 0
+
+    for size in sorted(set(old) & set(new), key=int):
+        for name in sorted(set(old[size]) & set(new[size])):
+            before = old[size][name]['p50_ms']
+            after = new[size][name]['p50_ms']
+            change = (after - before) / before * 100 if before else 0
+
+            flag = ''
+            if change > args.threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+
+            print('{:>10} {:40s} {:9.3f} -> {:9.3f} ms  {:+7.1f}%{}'.format(
+                size, name, before, after, change, flag))
+
+    print('{} regression(s) over {}%'.format(regressions, args.threshold))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--sizes', default='10k',
+                            help='comma separated numbers of appointments')
+    run_parser.add_argument('--output', default='bench_results.json')
+    run_parser.add_argument('--data-dir',
+                            default=os.path.join(BENCHMARKS_DIR, 'data'))
+    run_parser.add_argument('--iterations', type=int, default=200)
+    run_parser.add_argument('--seed', type=int, default=0)
+
+    compare_parser = commands.add_parser('compare', help='compare two runs')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='allowed p50 increase in percent')
+
+    scale_parser = commands.add_parser(
+        'scale', help='measure read throughput against worker processes')
+    scale_parser.add_argument('--workers', default=','.join(
+        str(2 ** i) for i in range((2 * os.cpu_count()).bit_length())),
+        help='comma separated numbers of worker processes')
+    scale_parser.add_argument('--size', default='10k',
+                              help='number of appointments')
+    scale_parser.add_argument('--clients', type=int, default=4,
+                              help='number of client processes')
+    scale_parser.add_argument('--threads', type=int, default=8,
+                              help='connections per client process')
+    scale_parser.add_argument('--duration', type=float, default=10.0)
+    scale_parser.add_argument('--output', default='bench_scale.json')
+    scale_parser.add_argument('--data-dir',
+                              default=os.path.join(BENCHMARKS_DIR, 'data'))
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'scale':
+        scale(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == '__main__':
+    main()
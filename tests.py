@@ -5,7 +5,34 @@ used in the all functions of the class 'AppointmentDataBase.'
 Written by Minhwa (Mina) Lee
 """
 
-from app_db import AppointmentDatabase
+import asyncio
+import json
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Listener
+
+import pytest
+
+import app_api
+import app_api_html
+import app_resources
+import app_responses
+from app_db import (APP_DURATION, MAX_TIME, MIN_TIME, QUERIES,
+                    AppointmentConflict, AppointmentDatabase, NameCaches,
+                    parse_time)
+from app_executor import DatabaseExecutor
+from app_metrics import MetricsRegistry, fingerprint
+from app_migrations import get_version, latest_version, month_start
+from app_pool import AppointmentDatabasePool, PoolTimeout
+from app_records import Appointment, Record
+from app_responses import ResponseStore
+from app_slowlog import SlowQueryLog, app_table_names
+from app_writer import RemoteWriteQueue, WriteQueue, serve_write_queue
 
 
 def build_db_path(directory):
@@ -329,3 +356,1523 @@ def test_delete_symptom(tmp_path):
 
     symptoms = db.delete_symptom(1)
     assert symptoms is None
+
+
+def test_pool_reuses_connections(tmp_path):
+    pool = AppointmentDatabasePool(build_db_path(tmp_path), size=2)
+
+    db = pool.acquire()
+    db.insert_doctor('Amy')
+    pool.release(db)
+
+    assert pool.acquire() is db
+
+
+def test_pool_size_limit(tmp_path):
+    pool = AppointmentDatabasePool(build_db_path(tmp_path), size=1,
+                                   acquire_timeout=0.01)
+
+    db = pool.acquire()
+
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    pool.release(db)
+    assert pool.acquire() is db
+
+
+def test_pool_idle_timeout(tmp_path):
+    pool = AppointmentDatabasePool(build_db_path(tmp_path), size=1,
+                                   idle_timeout=0)
+
+    db = pool.acquire()
+    pool.release(db)
+
+    assert pool.acquire() is not db
+
+
+def test_migrations_on_new_database(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    assert [version for version, _ in db.migrations_applied] == \
+        list(range(1, latest_version() + 1))
+    assert get_version(db.conn) == latest_version()
+
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    assert db.migrations_applied == []
+
+
+def test_migrations_upgrade_existing_database(tmp_path):
+    # Build a database with the original, version 0 schema.
+    legacy = AppointmentDatabase.__new__(AppointmentDatabase)
+    legacy.conn = sqlite3.connect(build_db_path(tmp_path))
+    legacy.create_tables()
+    legacy.conn.execute("INSERT INTO doctors(doctor) VALUES('Amy')")
+    legacy.conn.execute("INSERT INTO symptoms(symptom) VALUES('Headache')")
+    legacy.conn.execute('INSERT INTO patients(FirstN, LastN, gender, age, '
+                        "birth) VALUES('Mina', 'Lee', 'Female', 22, "
+                        "'1997-11-21')")
+    legacy.conn.execute('INSERT INTO app(patient_id, doctor_id, month, '
+                        "symptom_id) VALUES(1, 1, 'April', 1)")
+    legacy.conn.commit()
+    legacy.conn.close()
+
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    assert [version for version, _ in db.migrations_applied] == \
+        list(range(1, latest_version() + 1))
+    assert len(db.get_all_apps()) == 1
+    # An appointment from before scheduled_at only has a month.
+    assert db.get_app_by_id(1)['scheduled_at'] is None
+
+    plan = db.conn.execute('EXPLAIN QUERY PLAN '
+                           'SELECT * FROM app WHERE doctor_id = 1').fetchall()
+    assert 'USING INDEX idx_app_doctor_' in plan[0]['detail']
+
+
+def test_insert_app_single_commit(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+    db.conn.set_trace_callback(None)
+
+    assert [s for s in statements if s.startswith('COMMIT')] == ['COMMIT']
+
+
+def test_insert_app_rolls_back_on_error(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    db.insert_patient('Mina', 'Lee', 'Female', 22, '1997-11-21')
+
+    with pytest.raises(sqlite3.IntegrityError):
+        db.insert_app('Mina', 'Kim', 'Female', 22, '1997-11-21', 'Amy',
+                      'April', 'Headache')
+
+    assert db.get_all_doctors() == []
+    assert db.get_all_apps() == []
+
+
+def test_insert_apps_bulk(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    apps = [{'FirstN': 'Mina', 'LastN': 'Lee', 'gender': 'Female',
+             'age': 22, 'birth': '1997-11-21', 'doctor': 'Amy',
+             'month': 'April', 'symptom': 'Headache'},
+            {'FirstN': 'Danny', 'LastN': 'Park', 'gender': 'Male'},
+            {'FirstN': 'Danny', 'LastN': 'Park', 'gender': 'Male',
+             'age': 21, 'birth': '1999-04-22', 'doctor': 'Amy',
+             'month': 'March', 'symptom': 'Knee sprain'},
+            {'FirstN': 'Mina', 'LastN': 'Lee', 'gender': 'Female',
+             'age': 22, 'birth': '1997-11-21', 'doctor': 'Robert',
+             'month': 'May', 'symptom': 'Headache'}]
+
+    results = db.insert_apps_bulk(apps, chunk_size=2)
+
+    assert results == [{'index': 0, 'app_id': 1},
+                       {'index': 1, 'error': 'parameter age required'},
+                       {'index': 2, 'app_id': 2},
+                       {'index': 3, 'app_id': 3}]
+
+    assert len(db.get_all_apps()) == 3
+    assert len(db.get_all_patients()) == 2
+    assert len(db.get_all_doctors()) == 2
+    assert len(db.get_all_symptoms()) == 2
+
+    app = db.get_app_by_id(3)
+    assert app['FirstN'] == 'Mina'
+    assert app['doctor'] == 'Robert'
+    assert app['month'] == 'May'
+
+    # The counts are added once per chunk, as the triggers would have.
+    assert db.get_app_counts_by_doctor() == [
+        {'doctor_id': 1, 'doctor': 'Amy', 'app_count': 2},
+        {'doctor_id': 2, 'doctor': 'Robert', 'app_count': 1}]
+    assert [(c['month'], c['app_count'])
+            for c in db.get_app_counts_by_month()] == \
+        [('March', 1), ('April', 1), ('May', 1)]
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy', 'May',
+                  'Headache')
+    assert db.get_app_counts_by_doctor()[0]['app_count'] == 3
+
+
+def test_bulk_endpoint(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    apps = [{'FirstN': 'Mina', 'LastN': 'Lee', 'gender': 'Female',
+             'age': 22, 'birth': '1997-11-21', 'doctor': 'Amy',
+             'month': 'April', 'symptom': 'Headache'},
+            {'FirstN': 'Danny', 'LastN': 'Park', 'gender': 'Male'}]
+
+    response = client.post('/apps/bulk', json=apps)
+    assert response.status_code == 200
+    assert response.json == {'inserted': 1, 'failed': 1, 'results': [
+        {'index': 0, 'app_id': 1},
+        {'index': 1, 'error': 'parameter age required'}]}
+
+    apps[1].update(age=21, birth='1999-04-22', doctor='Amy', month='May',
+                   symptom='Fever')
+    body = '{}\n\n{}\n'.format(*(json.dumps(app) for app in apps))
+    response = client.post('/apps/bulk', data=body,
+                           content_type='application/x-ndjson')
+    assert response.json['inserted'] == 2
+    assert len(db.get_all_apps()) == 3
+
+    response = client.post('/apps/bulk', data='{}\n{"FirstN": ',
+                           content_type='application/x-ndjson')
+    assert response.status_code == 422
+    assert response.json == {'error': 'invalid JSON on line 2'}
+
+    for body in ('{"FirstN": "Mina"}', '[{'):
+        response = client.post('/apps/bulk', data=body,
+                               content_type='application/json')
+        assert response.status_code == 422
+        assert response.json == \
+            {'error': 'a JSON array of appointments required'}
+
+    assert len(db.get_all_apps()) == 3
+
+
+def test_get_apps_page(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    assert db.get_apps_page(2) == []
+
+    apps_inserted = [db.insert_app('First{}'.format(i), 'Last{}'.format(i),
+                                   'Female', 22, '1997-11-21', 'Amy',
+                                   'April', 'Headache') for i in range(5)]
+
+    assert db.get_apps_page(2) == apps_inserted[:2]
+    assert db.get_apps_page(2, 2) == apps_inserted[2:4]
+    assert db.get_apps_page(2, 4) == apps_inserted[4:]
+    assert db.get_apps_page(2, 5) == []
+
+
+def test_get_collection_pages(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    doctors = [db.insert_doctor(name) for name in ('Amy', 'Jill', 'Molly')]
+    symptoms = [db.insert_symptoms(name) for name in ('Cold', 'Flu')]
+    patients = [db.insert_patient('Mina', 'Lee', 'Female', 22, '1997-11-21'),
+                db.insert_patient('Danny', 'Park', 'Male', 21, '1999-04-22')]
+
+    assert db.get_doctors_page(2) == doctors[:2]
+    assert db.get_doctors_page(2, 2) == doctors[2:]
+    assert db.get_symptoms_page(1, 1) == symptoms[1:]
+    assert db.get_patients_page(5) == patients
+
+
+def test_iter_all_apps(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    apps_inserted = [db.insert_app('First{}'.format(i), 'Last{}'.format(i),
+                                   'Female', 22, '1997-11-21', 'Amy',
+                                   'April', 'Headache') for i in range(5)]
+
+    batches = list(db.iter_all_apps(batch_size=2))
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert sum(batches, []) == apps_inserted
+    assert list(db.iter_all_doctors()) == [db.get_all_doctors()]
+
+
+def test_stream_apps_json_array(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    assert json.loads(client.get('/apps?stream=1').data) == []
+
+    apps_inserted = [db.insert_app('First{}'.format(i), 'Last{}'.format(i),
+                                   'Female', 22, '1997-11-21', 'Amy',
+                                   'April', 'Headache') for i in range(3)]
+
+    response = client.get('/apps?stream=1')
+    assert response.mimetype == 'application/json'
+    assert json.loads(response.data) == apps_inserted
+
+
+@pytest.fixture(scope='module')
+def million_app_client(tmp_path_factory):
+    """
+    A test client for app_api whose database holds a million appointments.
+    """
+    path = build_db_path(tmp_path_factory.mktemp('million'))
+    db = AppointmentDatabase(path)
+
+    # The export doesn't use the app indexes, and they make seeding slow.
+    for index in ('idx_app_patient', 'idx_app_symptom',
+                  'idx_app_doctor_month', 'idx_app_month_patient'):
+        db.conn.execute('DROP INDEX {}'.format(index))
+
+    db.conn.execute("INSERT INTO doctors(doctor) VALUES('Amy')")
+    db.conn.execute("INSERT INTO symptoms(symptom) VALUES('Headache')")
+    db.conn.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                    'SELECT i + 1 FROM n WHERE i < 1000) '
+                    'INSERT INTO patients(FirstN, LastN, gender, age, birth) '
+                    "SELECT 'First' || i, 'Last' || i, 'Female', 22, "
+                    "'1997-11-21' FROM n")
+    db.conn.execute('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                    'SELECT i + 1 FROM n WHERE i < 1000000) '
+                    'INSERT INTO app(patient_id, doctor_id, month, '
+                    "symptom_id) SELECT 1 + i % 1000, 1, 'April', 1 FROM n")
+    db.conn.commit()
+    db.close()
+
+    app_api.app.config['DATABASE'] = str(path)
+    return app_api.app.test_client()
+
+
+def test_stream_apps_memory_is_bounded(million_app_client):
+    # tracemalloc measures the peak of this export alone, unlike ru_maxrss,
+    # which keeps the peak of every earlier test.
+    tracemalloc.start()
+
+    try:
+        response = million_app_client.get(
+            '/apps', headers={'Accept': 'application/x-ndjson'},
+            buffered=False)
+        assert response.mimetype == 'application/x-ndjson'
+
+        lines = 0
+        for chunk in response.response:
+            lines += chunk.count(b'\n')
+        response.close()
+
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert lines == 1000000
+
+    # Materialising the appointments as a list of dicts would take several
+    # hundred megabytes.
+    assert peak < 64 * 1024 * 1024
+
+
+def test_name_cache_hits(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+    db.insert_app('Danny', 'Park', 'Male', 21, '1999-04-22', 'Amy',
+                  'March', 'Headache')
+
+    stats = db.cache_stats()
+    assert stats['doctors']['hits'] == 1
+    assert stats['symptoms']['hits'] == 1
+    assert stats['patients']['hits'] == 0
+    assert stats['patients']['size'] == 2
+
+    # A second connection to the same file shares the caches.
+    other = AppointmentDatabase(build_db_path(tmp_path))
+    other.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                     'May', 'Headache')
+    assert other.cache_stats()['patients']['hits'] == 1
+
+
+def test_name_cache_invalidation(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+    db.delete_doctor(1)
+    assert db.cache_stats()['doctors']['size'] == 0
+
+    app = db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                        'April', 'Headache')
+    assert app['doctor'] == 'Amy'
+
+    # Deleting behind the cache's back, as another process would, makes
+    # insert_app retry with fresh lookups.
+    db.conn.execute('DELETE FROM app')
+    db.conn.execute('DELETE FROM doctors')
+    db.conn.commit()
+
+    app = db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                        'April', 'Headache')
+    assert app['doctor'] == 'Amy'
+    assert len(db.get_all_doctors()) == 1
+
+
+def test_name_cache_ignores_rolled_back_rows(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    db.insert_patient('Mina', 'Lee', 'Female', 22, '1997-11-21')
+
+    with pytest.raises(sqlite3.IntegrityError):
+        db.insert_app('Mina', 'Kim', 'Female', 22, '1997-11-21', 'Amy',
+                      'April', 'Headache')
+
+    assert db.cache_stats()['doctors']['size'] == 0
+
+
+def test_name_cache_reused_ids(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+
+    # Another process, with caches of its own, deletes the doctor and
+    # inserts a new one that reuses its id.
+    other = AppointmentDatabase(build_db_path(tmp_path))
+    other._name_caches = NameCaches()
+    other.delete_doctor(1)
+    other.insert_doctor('Bob')
+    assert other.get_doctor_by_name('Bob')['doctor_id'] == 1
+
+    app = db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                        'April', 'Headache')
+    assert app['doctor'] == 'Amy'
+    assert len(db.get_all_doctors()) == 2
+
+
+def test_name_cache_ignores_failed_commits(tmp_path, monkeypatch):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    db.insert_patient('Mina', 'Lee', 'Female', 22, '1997-11-21')
+    db.insert_symptoms('Headache')
+
+    def fail():
+        raise sqlite3.OperationalError('database is locked')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(db, '_bump_data_versions', fail)
+        with pytest.raises(sqlite3.OperationalError):
+            db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                          'April', 'Headache')
+
+    db.insert_doctor('Bob')
+    app = db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                        'April', 'Headache')
+    assert app['doctor'] == 'Amy'
+    assert db.get_doctor_by_name('Bob')['doctor_id'] == 1
+
+
+def test_app_counts(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    assert db.get_app_counts_by_doctor() == []
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Robert',
+                  'April', 'Headache')
+    db.insert_app('Danny', 'Park', 'Male', 21, '1999-04-22', 'Amy',
+                  'March', 'Knee sprain')
+    db.insert_app('Grace', 'Kim', 'Female', 21, '1999-01-02', 'Amy',
+                  'April', 'Stomachache')
+
+    assert db.get_app_counts_by_doctor() == [
+        {'doctor_id': 2, 'doctor': 'Amy', 'app_count': 2},
+        {'doctor_id': 1, 'doctor': 'Robert', 'app_count': 1}]
+    # Months are in calendar order.
+    assert db.get_app_counts_by_month() == [
+        {'month': 'March', 'app_count': 1},
+        {'month': 'April', 'app_count': 2}]
+    assert db.get_app_stats(['month'], {'age_max': 30}) == \
+        db.get_app_counts_by_month()
+
+    db.delete_app(3)
+    db.delete_doctor(1)
+
+    assert db.get_app_counts_by_doctor() == [
+        {'doctor_id': 2, 'doctor': 'Amy', 'app_count': 1}]
+    assert db.get_app_counts_by_month() == [
+        {'month': 'March', 'app_count': 1}]
+
+
+def test_get_apps_by_doctor_and_month(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    may = db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                        'May', 'Headache')
+    april = db.insert_app('Danny', 'Park', 'Male', 21, '1999-04-22', 'Amy',
+                          'April', 'Knee sprain')
+    other = db.insert_app('Grace', 'Kim', 'Female', 21, '1999-01-02',
+                          'Robert', 'April', 'Stomachache')
+
+    august = db.insert_app('Jin', 'Choi', 'Male', 30, '1994-01-02', 'Amy',
+                           'August', 'Headache')
+
+    # In calendar order of month.
+    assert db.get_apps_by_doctor_id(1) == [april, may, august]
+    assert db.get_apps_by_doctor_id(1, 1) == [april]
+    assert db.get_apps_by_month('April') == [april, other]
+    assert db.get_apps_by_month('June') == []
+
+
+def test_data_versions(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    tables = ['app', 'patients', 'doctors', 'symptoms']
+
+    before = db.get_data_versions(tables)
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+    after_insert = db.get_data_versions(tables)
+
+    assert all(new[0] == old[0] + 1
+               for old, new in zip(before, after_insert))
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'May', 'Headache')
+    versions = db.get_data_versions(tables)
+
+    # Only the app table changed.
+    assert versions[0][0] == after_insert[0][0] + 1
+    assert versions[1:] == after_insert[1:]
+
+    db.delete_doctor(1)
+    assert db.get_data_versions(['doctors'])[0][0] == versions[2][0] + 1
+
+
+def test_api_conditional_get(tmp_path):
+    AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    client.post('/doctors', data={'doctor': 'Amy'})
+
+    response = client.get('/doctors')
+    etag = response.headers['ETag']
+
+    assert client.get('/doctors',
+                      headers={'If-None-Match': etag}).status_code == 304
+
+    # Writes to other tables don't change the doctors' ETag.
+    client.post('/symptoms', data={'symptom': 'Flu'})
+    assert client.get('/doctors',
+                      headers={'If-None-Match': etag}).status_code == 304
+
+    client.post('/doctors', data={'doctor': 'Jill'})
+    response = client.get('/doctors', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert len(response.json) == 2
+    assert response.headers['ETag'] != etag
+
+
+def test_api_if_modified_since(tmp_path, monkeypatch):
+    AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    monkeypatch.setattr(time, 'time', lambda: 1712000000.25)
+    client.post('/doctors', data={'doctor': 'Amy'})
+    last_modified = client.get('/doctors').headers['Last-Modified']
+
+    # A write in the same second isn't hidden by the whole seconds of
+    # Last-Modified.
+    monkeypatch.setattr(time, 'time', lambda: 1712000000.75)
+    client.post('/doctors', data={'doctor': 'Jill'})
+    response = client.get('/doctors',
+                          headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+    assert len(response.json) == 2
+
+    assert client.get('/doctors', headers={
+        'If-Modified-Since': 'Mon, 01 Apr 2024 19:33:22 GMT'}).status_code \
+        == 304
+
+
+def test_api_cached_pages(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    for first, last in (('Mina', 'Lee'), ('Danny', 'Park'), ('Jin', 'Kim')):
+        db.insert_app(first, last, 'Female', 22, '1997-11-21', 'Amy',
+                      'April', 'Headache')
+
+    # The second request is answered from the cache, with the same
+    # pagination headers.
+    first = client.get('/apps?limit=2')
+    second = client.get('/apps?limit=2')
+    assert second.data == first.data
+    for header in ('Link', 'X-Next-After-Id', 'ETag'):
+        assert second.headers[header] == first.headers[header]
+
+    # The JSON array and the NDJSON stream are different representations.
+    ndjson = client.get('/apps', headers={'Accept': 'application/x-ndjson'})
+    array = client.get('/apps', headers={'Accept': 'application/json'})
+    assert ndjson.mimetype == 'application/x-ndjson'
+    assert ndjson.headers['Vary'] == 'Accept'
+    assert ndjson.headers['ETag'] != array.headers['ETag']
+    assert client.get('/apps', headers={
+        'Accept': 'application/json',
+        'If-None-Match': ndjson.headers['ETag']}).status_code == 200
+
+
+def test_query_fingerprint():
+    assert fingerprint("SELECT * FROM app WHERE app_id = 5") == \
+        'SELECT * FROM app WHERE app_id = ?'
+    assert fingerprint("SELECT name FROM t WHERE name IN (?, ?, ?)") == \
+        fingerprint("SELECT name FROM t WHERE name IN (?)")
+    assert fingerprint("INSERT INTO t VALUES (?, ?), (?, ?)") == \
+        'INSERT INTO t VALUES (?), ...'
+
+
+def test_metrics_endpoint(tmp_path):
+    AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    app_api.metrics.reset()
+    client = app_api.app.test_client()
+
+    client.post('/doctors', data={'doctor': 'Amy'})
+    client.get('/doctors/1')
+
+    text = client.get('/metrics').text
+
+    assert ('statement="SELECT doctor_id, doctor FROM doctors '
+            'WHERE doctor_id = ?"') in text
+    assert 'sqlite_commits_total 1' in text
+    assert ('http_requests_total{method="GET",route="/doctors/<int:doctor_id>"'
+            ',status="200"} 1') in text
+
+    app_api.app.config['METRICS_ENABLED'] = False
+    try:
+        assert client.get('/metrics').status_code == 404
+        pool = app_resources.get_pool(app_api.app)
+        assert not isinstance(pool.metrics, MetricsRegistry)
+    finally:
+        app_api.app.config['METRICS_ENABLED'] = True
+
+
+def test_slow_query_log(tmp_path):
+    log_path = tmp_path / 'slow.log'
+    db = AppointmentDatabase(build_db_path(tmp_path),
+                             slow_log=SlowQueryLog(str(log_path), 0))
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy', 'April',
+                  'Headache')
+    db.get_all_apps()
+    db.get_app_by_id(1)
+
+    entries = [json.loads(line) for line in log_path.read_text().splitlines()]
+    by_id = [entry for entry in entries if entry['parameters'] == [1]]
+    scans = [entry for entry in entries if entry['full_scan_of_app']]
+
+    assert by_id and by_id[-1]['plan']
+    assert not by_id[-1]['full_scan_of_app']
+    assert any('FROM app_details' in entry['statement'] for entry in scans)
+    assert app_table_names('SELECT * FROM app a JOIN patients p '
+                           'USING (patient_id)') == {'app', 'a'}
+
+
+def test_database_executor(tmp_path):
+    executor = DatabaseExecutor(str(build_db_path(tmp_path)), readers=2)
+
+    async def run():
+        app = await executor.insert_app('Mina', 'Lee', 'Female', 22,
+                                        '1997-11-21', 'Amy', 'April',
+                                        'Headache')
+        found = await asyncio.gather(*[executor.get_app_by_id(app['app_id'])
+                                       for _ in range(10)])
+        await executor.delete_app(app['app_id'])
+
+        return app, found, await executor.get_app_by_id(app['app_id'])
+
+    try:
+        app, found, deleted = asyncio.run(run())
+    finally:
+        executor.close()
+
+    assert found == [app] * 10
+    assert deleted is None
+
+    with pytest.raises(AttributeError):
+        executor.iter_all_apps
+
+
+def test_async_api(tmp_path):
+    pytest.importorskip('quart')
+    import app_api_async
+
+    app_api_async.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api_async.app.test_client()
+
+    async def run():
+        response = await client.post('/doctors', form={'doctor': 'Amy'})
+        assert (await response.get_json())['doctor'] == 'Amy'
+
+        response = await client.get('/doctors')
+        assert [doctor['doctor'] for doctor in await response.get_json()] \
+            == ['Amy']
+
+        response = await client.get(
+            '/doctors', headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+        response = await client.get('/doctors/2')
+        assert response.status_code == 404
+
+        response = await client.delete('/doctors?ids=1,2')
+        assert await response.get_json() == {'deleted': 1}
+
+        response = await client.delete('/doctors/1')
+        assert response.status_code == 404
+
+        response = await client.post('/apps', form={
+            'FirstN': 'Mina', 'LastN': 'Lee', 'gender': 'Female', 'age': 22,
+            'birth': '1997-11-21', 'doctor': 'Amy', 'symptom': 'Headache',
+            'scheduled_at': '2024-04-02T09:00:00'})
+        assert (await response.get_json())['month'] == 'April'
+        response = await client.post('/apps', form={
+            'FirstN': 'Danny', 'LastN': 'Park', 'gender': 'Male', 'age': 21,
+            'birth': '1999-04-22', 'doctor': 'Amy', 'symptom': 'Fever',
+            'scheduled_at': '2024-04-02T09:15:00'})
+        assert response.status_code == 409
+
+        response = await client.get('/apps?from=2024-04-02&to=2024-04-03')
+        assert len(await response.get_json()) == 1
+        response = await client.get('/apps?from=April')
+        assert response.status_code == 422
+        response = await client.get('/apps?limit=0')
+        assert (await response.get_json()) == \
+            {'error': 'parameter limit out of range'}
+
+        # A cached page keeps its pagination headers.
+        await client.post('/apps', form={
+            'FirstN': 'Danny', 'LastN': 'Park', 'gender': 'Male', 'age': 21,
+            'birth': '1999-04-22', 'doctor': 'Amy', 'symptom': 'Fever',
+            'month': 'May'})
+        first = await client.get('/apps?limit=1')
+        hits = app_api_async.response_bodies.lru.hits
+        second = await client.get('/apps?limit=1')
+        assert app_api_async.response_bodies.lru.hits == hits + 1
+        assert second.headers['Link'] == first.headers['Link']
+        assert second.headers['Vary'] == 'Accept'
+
+        response = await client.get('/apps?sort=-age&limit=1')
+        link = response.headers['Link'][1:].split('>')[0]
+        assert 'after=22%2C1' in link
+        response = await client.get(link)
+        assert [app['age'] for app in await response.get_json()] == [21]
+
+    asyncio.run(run())
+
+
+def test_write_queue_group_commit(tmp_path):
+    writer = WriteQueue(str(build_db_path(tmp_path)), batch_delay=0.01)
+
+    def insert(thread):
+        return [writer.insert_doctor('Doctor{}-{}'.format(thread, i))
+                for i in range(20)]
+
+    try:
+        with ThreadPoolExecutor(8) as threads:
+            doctors = [doctor for result in threads.map(insert, range(8))
+                       for doctor in result]
+    finally:
+        writer.close()
+
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    assert len(db.get_all_doctors()) == len(doctors) == 160
+    assert writer.operations == 160
+    assert writer.batches < writer.operations
+
+
+def test_write_queue_isolates_failures(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    db.insert_patient('Mina', 'Lee', 'Female', 22, '1997-11-21')
+
+    writer = WriteQueue(str(build_db_path(tmp_path)), batch_delay=0.1)
+
+    try:
+        first = writer.submit('insert_doctor', 'Amy')
+        # FirstN is unique, so this patient can't be added.
+        conflict = writer.submit('insert_app', 'Mina', 'Kim', 'Female', 30,
+                                 '1990-01-01', 'Jill', 'May', 'Cold')
+        last = writer.submit('insert_doctor', 'Robert')
+
+        assert first.result()['doctor'] == 'Amy'
+        assert last.result()['doctor'] == 'Robert'
+        with pytest.raises(sqlite3.IntegrityError):
+            conflict.result()
+    finally:
+        writer.close()
+
+    assert writer.batches == 1
+    assert [doctor['doctor'] for doctor in db.get_all_doctors()] == \
+        ['Amy', 'Robert']
+    assert db.get_all_apps() == []
+
+
+def test_write_queue_deletes_drop_cached_keys(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    writer = WriteQueue(str(build_db_path(tmp_path)), batch_delay=0.1)
+
+    try:
+        first = writer.submit('insert_app', 'Mina', 'Lee', 'Female', 22,
+                              '1997-11-21', 'Amy', 'April', 'Headache')
+        deleted = writer.submit('delete_doctor', 1)
+        first.result()
+        deleted.result()
+        assert writer.batches == 1
+
+        # Bob reuses the id of Amy, which must not stay cached.
+        assert writer.insert_doctor('Bob')['doctor_id'] == 1
+        app = writer.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21',
+                                'Amy', 'May', 'Headache')
+        assert app['doctor'] == 'Amy'
+    finally:
+        writer.close()
+
+    assert [doctor['doctor'] for doctor in db.get_all_doctors()] == \
+        ['Bob', 'Amy']
+
+
+def test_read_only_database(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    db.insert_doctor('Amy')
+
+    reader = AppointmentDatabase(build_db_path(tmp_path), read_only=True)
+
+    assert reader.get_doctor_by_id(1)['doctor'] == 'Amy'
+    with pytest.raises(sqlite3.OperationalError):
+        reader.insert_doctor('Jill')
+
+
+def test_remote_write_queue(tmp_path):
+    AppointmentDatabase(build_db_path(tmp_path)).insert_patient(
+        'Mina', 'Lee', 'Female', 22, '1997-11-21')
+
+    write_queue = WriteQueue(str(build_db_path(tmp_path)))
+    listener = Listener(family='AF_UNIX', authkey=b'secret')
+    # A thread blocked in accept() isn't woken by closing the listener, so
+    # the server thread is left to end with the test process.
+    threading.Thread(target=serve_write_queue, args=(write_queue, listener),
+                     daemon=True).start()
+
+    remote = RemoteWriteQueue(listener.address, b'secret')
+
+    try:
+        assert remote.insert_doctor('Amy')['doctor_id'] == 1
+        with pytest.raises(sqlite3.IntegrityError):
+            remote.insert_app('Mina', 'Kim', 'Female', 30, '1990-01-01',
+                              'Jill', 'May', 'Cold')
+        assert remote.insert_doctor('Jill')['doctor_id'] == 2
+    finally:
+        remote.close()
+        listener.close()
+        write_queue.close()
+
+
+def test_search(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    db.insert_app('Minato', 'Leeds', 'Male', 30, '1990-01-01', 'Amy',
+                  'April', 'Head cold')
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amelia',
+                  'April', 'Headache')
+
+    results = db.search('min')
+    # The shorter, closer name comes first.
+    assert [p['FirstN'] for p in results['patients']] == ['Mina', 'Minato']
+    assert results['doctors'] == [] and results['symptoms'] == []
+
+    # A whole word ranks before a longer word sharing it as a prefix.
+    assert [s['symptom'] for s in db.search('head')['symptoms']] == \
+        ['Head cold', 'Headache']
+    assert db.search('lee mina', kinds=['patients'])['patients'][0] == \
+        db.get_patient_by_name('Mina', 'Lee')
+    assert db.search('"*', limit=1) == \
+        {'patients': [], 'doctors': [], 'symptoms': []}
+
+    # Every match is ranked, however many there are before the best one.
+    db.conn.executemany('INSERT INTO symptoms(symptom) VALUES(?)',
+                        [('Headaches {}'.format(i),) for i in range(1500)])
+    db.conn.execute("INSERT INTO symptoms(symptom) VALUES('Heat')")
+    db.conn.commit()
+    assert [s['symptom'] for s in db.search('hea', 2)['symptoms']] == \
+        ['Heat', 'Headache']
+
+    # The triggers keep the indexes up to date.
+    db.delete_doctor(1)
+    db.conn.execute("UPDATE symptoms SET symptom = 'Fever' "
+                    "WHERE symptom = 'Headache'")
+    assert [d['doctor'] for d in db.search('am')['doctors']] == ['Amelia']
+    assert db.search('fev')['symptoms'] == [{'symptom_id': 2,
+                                             'symptom': 'Fever'}]
+
+
+def test_search_endpoint(tmp_path):
+    AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    client.post('/doctors', data={'doctor': 'Amy'})
+    client.post('/symptoms', data={'symptom': 'Amnesia'})
+
+    response = client.get('/search?q=am&type=doctors')
+    assert response.json == {'doctors': [{'doctor_id': 1, 'doctor': 'Amy'}]}
+
+    assert len(client.get('/search?q=am').json['symptoms']) == 1
+    assert client.get('/search').status_code == 422
+    assert client.get('/search?q=am&type=apps').status_code == 422
+
+
+def test_get_apps_page_filters_and_sort(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    for i in range(6):
+        db.insert_app('First{}'.format(i), 'Last{}'.format(i),
+                      'Female' if i % 2 else 'Male', 20 + i % 3,
+                      '1997-11-21', 'Amy' if i < 3 else 'Jill',
+                      'April' if i % 2 else 'May', 'Headache')
+
+    def ids(**kwargs):
+        return [app['app_id'] for app in db.get_apps_page(10, **kwargs)]
+
+    assert ids(filters={'doctor': 'Jill'}) == [4, 5, 6]
+    assert ids(filters={'doctor': 'Jill', 'month': 'April'}) == [4, 6]
+    assert ids(filters={'gender': 'Male', 'age_min': 21}) == [3, 5]
+    assert ids(filters={'age_max': 20, 'patient_id': 4}) == [4]
+    assert ids(filters={'doctor': 'Nobody'}) == []
+
+    # Equal ages are in order of app_id, in the same direction.
+    assert ids(sort='-age') == [6, 3, 5, 2, 4, 1]
+    # after_id continues from that appointment in the sorted order.
+    assert ids(sort='-age', after_id=5) == [2, 4, 1]
+    assert ids(sort='age', after_id=4, filters={'month': 'April'}) == [2, 6]
+    # after gives the sort value itself, so the row may be gone.
+    assert ids(sort='-age', after=(21, 5)) == [2, 4, 1]
+    assert ids(sort='-age', after=('21', 5)) == [2, 4, 1]
+
+    with pytest.raises(ValueError):
+        db.get_apps_page(10, sort='month')
+    with pytest.raises(ValueError):
+        db.get_apps_page(10, sort='age', after_id=99)
+
+    batches = db.iter_all_apps(batch_size=2, sort='-app_id',
+                               filters={'doctor': 'Amy'})
+    assert [[app['app_id'] for app in batch] for batch in batches] == \
+        [[3, 2], [1]]
+
+
+def test_api_filter_apps(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    for i in range(4):
+        db.insert_app('First{}'.format(i), 'Last{}'.format(i), 'Female',
+                      30 + i, '1997-11-21', 'Amy', 'April', 'Headache')
+
+    response = client.get('/apps?age_min=31&sort=-age&limit=2')
+    assert [app['age'] for app in response.json] == [33, 32]
+
+    # The next page keeps the filters and the order.
+    response = client.get(response.headers['Link'][1:].split('>')[0])
+    assert [app['age'] for app in response.json] == [31]
+
+    assert client.get('/apps?sort=birth').status_code == 422
+    assert client.get('/apps?age_min=old').status_code == 422
+    assert client.get('/apps?sort=age&after_id=99').status_code == 404
+    assert client.get('/apps?sort=age&after=30,x').status_code == 422
+
+    # The next page of a sorted collection doesn't need its last
+    # appointment to still exist.
+    response = client.get('/apps?sort=age&limit=2')
+    link = response.headers['Link'][1:].split('>')[0]
+    assert 'after=31%2C2' in link
+    assert response.headers['X-Next-After-Id'] == '2'
+
+    client.delete('/apps/2')
+    response = client.get(link)
+    assert response.status_code == 200
+    assert [app['age'] for app in response.json] == [32, 33]
+
+
+def test_get_app_stats(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    for i in range(6):
+        db.insert_app('First{}'.format(i), 'Last{}'.format(i),
+                      'Female' if i % 2 else 'Male', 15 + 5 * i,
+                      '1997-11-21', 'Amy' if i < 4 else 'Jill',
+                      'April' if i % 3 else 'May',
+                      'Flu' if i % 2 else 'Headache')
+
+    assert db.get_app_stats(['doctor']) == \
+        [{'doctor': 'Amy', 'app_count': 4}, {'doctor': 'Jill', 'app_count': 2}]
+    assert db.get_app_stats(['age'], age_bucket=20) == \
+        [{'age': 0, 'app_count': 1}, {'age': 20, 'app_count': 4},
+         {'age': 40, 'app_count': 1}]
+    assert db.get_app_stats(['symptom'], {'doctor': 'Jill'}) == \
+        [{'symptom': 'Flu', 'app_count': 1},
+         {'symptom': 'Headache', 'app_count': 1}]
+    assert db.get_app_stats(['month', 'gender'], {'age_min': 20}) == \
+        [{'month': 'April', 'gender': 'Female', 'app_count': 2},
+         {'month': 'April', 'gender': 'Male', 'app_count': 2},
+         {'month': 'May', 'gender': 'Female', 'app_count': 1}]
+    assert db.get_app_stats(['doctor', 'month']) == \
+        [{'doctor': 'Amy', 'month': 'April', 'app_count': 2},
+         {'doctor': 'Amy', 'month': 'May', 'app_count': 2},
+         {'doctor': 'Jill', 'month': 'April', 'app_count': 2}]
+
+    # With a patient filter too, the names of doctors and symptoms are
+    # only looked up once the appointments are grouped, so the planner
+    # can't drive the count from their tables.
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    db.get_app_stats(['symptom', 'doctor'], {'gender': 'Female'})
+    db.conn.set_trace_callback(None)
+    plan = [row['detail'] for row in db.conn.execute(
+        'EXPLAIN QUERY PLAN ' + statements[-1])]
+    grouped = plan.index('USE TEMP B-TREE FOR GROUP BY')
+    assert all(index > grouped for index, detail in enumerate(plan)
+               if ' doctors ' in detail or ' symptoms ' in detail)
+
+    for by in ([], ['doctor', 'doctor'], ['birth'],
+               ['age', 'month', 'doctor']):
+        with pytest.raises(ValueError):
+            db.get_app_stats(by)
+
+
+def test_stats_endpoint(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+
+    stats = client.get('/stats').json
+    assert stats['total'] == 1
+    assert stats['gender'] == [{'gender': 'Female', 'app_count': 1}]
+
+    etag = client.get('/stats?by=doctor,age&bucket=5').headers['ETag']
+    assert client.get('/stats?by=doctor,age&bucket=5').json == \
+        [{'doctor': 'Amy', 'age': 20, 'app_count': 1}]
+
+    # A write changes the counts and the ETag.
+    client.post('/apps', data={'FirstN': 'Danny', 'LastN': 'Park',
+                               'gender': 'Male', 'age': 21,
+                               'birth': '1999-04-22', 'doctor': 'Amy',
+                               'month': 'May', 'symptom': 'Headache'})
+    response = client.get('/stats?by=doctor,age&bucket=5',
+                          headers={'If-None-Match': etag})
+    assert response.json == [{'doctor': 'Amy', 'age': 20, 'app_count': 2}]
+
+    assert client.get('/stats?by=birth').status_code == 422
+    assert client.get('/stats?by=age&bucket=0').status_code == 422
+
+
+def test_appointment_columns(tmp_path):
+    pytest.importorskip('numpy')
+    from app_analytics import AppointmentColumns
+
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    columns = AppointmentColumns()
+
+    def insert(i):
+        db.insert_app('First{}'.format(i), 'Last{}'.format(i),
+                      'Female' if i % 2 else 'Male', 15 + 7 * i,
+                      '1997-11-21', 'Amy' if i < 4 else 'Jill',
+                      'April' if i % 3 else 'May',
+                      'Flu' if i % 2 else 'Headache')
+
+    for i in range(5):
+        insert(i)
+
+    assert columns.refresh(db) == 5
+    assert columns.refresh(db) == 0
+
+    insert(5)
+    assert columns.refresh(db) == 1
+    assert columns.high_water['app'] == 6
+
+    for by, filters in ((['doctor'], None), (['age'], None),
+                        (['month', 'gender'], {'age_min': 20}),
+                        (['symptom', 'age'], {'doctor': 'Jill'}),
+                        (['gender'], {'month': 'May', 'age_max': 40}),
+                        (['doctor'], {'symptom': 'Cold'}),
+                        (['doctor'], {'from': month_start('May')}),
+                        (['gender'], {'to': month_start('May')})):
+        assert columns.get_app_stats(by, filters) == \
+            db.get_app_stats(by, filters)
+
+    # A delete makes the next refresh load everything again.
+    db.delete_app(2)
+    assert columns.refresh(db) == 5
+    assert columns.get_app_stats(['doctor']) == db.get_app_stats(['doctor'])
+
+    counts, edges = columns.age_histogram([0, 30, 60])
+    assert counts == [2, 3] and edges == [0, 30, 60]
+
+    # A doctor deleted and replaced between refreshes gets the same
+    # primary key, which must not keep the old name.
+    zed = db.insert_doctor('Zed')['doctor_id']
+    assert columns.refresh(db) == 0
+    db.delete_doctor(zed)
+    assert db.insert_doctor('Yan')['doctor_id'] == zed
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Yan',
+                  'April', 'Flu')
+    assert columns.refresh(db) == 1
+    assert columns.get_app_stats(['doctor']) == db.get_app_stats(['doctor'])
+    assert columns.get_app_stats(['gender'], {'doctor': 'Yan'}) == \
+        [{'gender': 'Female', 'app_count': 1}]
+
+    # So does a deleted patient.
+    patient = db.insert_patient('Nobody', 'Here', 'Male', 80, '1940-01-01')
+    assert columns.refresh(db) == 0
+    db.delete_patient(patient['patient_id'])
+    assert columns.refresh(db) == len(db.get_all_apps())
+    assert columns.get_app_stats(['age']) == db.get_app_stats(['age'])
+
+    with pytest.raises(ValueError):
+        columns.get_app_stats(['birth'])
+
+
+def test_stats_endpoint_analytics(tmp_path):
+    pytest.importorskip('numpy')
+
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+    expected = client.get('/stats?by=doctor,age').json
+
+    app_api.app.config['STATS_ANALYTICS'] = True
+    try:
+        assert client.get('/stats?by=doctor,age&v=1').json == expected
+        assert client.get('/stats?v=1').json['total'] == 1
+    finally:
+        app_api.app.config['STATS_ANALYTICS'] = False
+
+
+def test_records(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    app = db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                        'April', 'Headache')
+    expected = {'FirstN': 'Mina', 'LastN': 'Lee', 'gender': 'Female',
+                'age': 22, 'birth': '1997-11-21', 'doctor': 'Amy',
+                'month': 'April', 'app_id': 1, 'symptom': 'Headache',
+                'scheduled_at': None, 'ends_at': None}
+
+    assert isinstance(app, Appointment)
+    assert app == expected and expected == app
+    assert app != dict(expected, age=23)
+    assert dict(app) == expected and app.to_dict() == expected
+    assert app['doctor'] == app.doctor == 'Amy'
+    assert 'doctor' in app and 'patient_id' not in app
+    with pytest.raises(KeyError):
+        app['patient_id']
+
+    assert not hasattr(app, '__dict__')
+    assert sys.getsizeof(app) < sys.getsizeof(expected) / 2
+    assert pickle.loads(pickle.dumps(app)) == app
+    assert json.loads(app_api.app.json.dumps(app)) == expected
+
+    db.insert_app('Danny', 'Park', 'Male', 21, '1999-04-22', 'Amy',
+                  'April', 'Headache')
+    first, second = db.get_all_apps()
+    # The records of one query share the values that repeat.
+    assert first.doctor is second.doctor
+    assert first.month is second.month
+
+    # A record's __init__ must take its fields in the order of __slots__.
+    with pytest.raises(TypeError):
+        class Misordered(Record):
+            __slots__ = ('doctor_id', 'doctor')
+
+            def __init__(self, doctor, doctor_id):
+                self.doctor = doctor
+                self.doctor_id = doctor_id
+
+
+def test_query_registry(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+
+    view = db.conn.execute('SELECT * FROM app_details').fetchone()
+    assert dict(view) == dict(db.get_app_by_id(1), patient_id=1,
+                              doctor_id=1, symptom_id=1)
+
+    parameters = {'app_by_id': (1,), 'all_apps': (),
+                  'apps_by_doctor_id': (1, 10),
+                  'apps_by_month': ('April', 10),
+                  'patient_by_id': (1,), 'patient_by_name': ('Mina', 'Lee'),
+                  'doctor_by_id': (1,), 'doctor_by_name': ('Amy',),
+                  'symptom_by_id': (1,), 'symptom_by_name': ('Headache',),
+                  'apps_between': (0, 2 ** 40, 10),
+                  'doctor_apps_between': (1, 0, 2 ** 40, 10),
+                  'app_counts_by_day': (0, 2 ** 40),
+                  'doctor_slot_before': (1, 2 ** 40),
+                  'doctor_slots_from': (1, 0)}
+    assert set(parameters) == set(QUERIES)
+
+    def plan(name):
+        return ' '.join(row[3] for row in db.conn.execute(
+            'EXPLAIN QUERY PLAN ' + QUERIES[name], parameters[name]))
+
+    # The view is flattened into each query, so the app indexes are used.
+    assert 'idx_app_doctor_month' in plan('apps_by_doctor_id')
+    assert 'idx_app_month_patient' in plan('apps_by_month')
+    # Ranges of time are read in order from the scheduled_at indexes.
+    assert 'idx_app_scheduled (scheduled_at>? AND scheduled_at<?)' in \
+        plan('apps_between')
+    assert 'idx_app_doctor_scheduled' in plan('doctor_apps_between')
+    assert 'COVERING INDEX idx_app_scheduled' in plan('app_counts_by_day')
+    assert 'TEMP B-TREE' not in plan('apps_between') + \
+        plan('doctor_apps_between')
+    for name in ('doctor_slot_before', 'doctor_slots_from'):
+        assert 'COVERING INDEX idx_app_doctor_slots' in plan(name)
+        assert 'TEMP B-TREE' not in plan(name)
+    for name in parameters:
+        if name != 'all_apps':
+            assert 'SCAN' not in plan(name)
+
+
+def test_delete_many_cascades(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Robert',
+                  'May', 'Fever')
+    db.insert_app('Danny', 'Park', 'Male', 21, '1999-04-22', 'Amy',
+                  'April', 'Fever')
+    db.insert_app('Grace', 'Kim', 'Female', 21, '1999-01-02', 'Nathan',
+                  'March', 'Headache')
+
+    assert db.delete_app_many([4, 5]) == 1
+    assert db.delete_patient_many([1, 2, 99]) == 2
+    assert db.get_all_apps() == []
+    assert [patient['FirstN'] for patient in db.get_all_patients()] \
+        == ['Grace']
+    assert db.get_app_counts_by_month() == []
+
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+    db.insert_app('Danny', 'Park', 'Male', 21, '1999-04-22', 'Robert',
+                  'May', 'Fever')
+    assert db.delete_doctor_many([]) == 0
+    assert db.delete_symptom_many(range(1, 1000)) == 2
+    assert db.get_all_apps() == []
+    assert db.get_all_doctors() != []
+
+
+def test_batch_delete_endpoint(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    for i in range(5):
+        db.insert_app('First{}'.format(i), 'Last{}'.format(i), 'Female', 22,
+                      '1997-11-21', 'Amy', 'April', 'Headache')
+
+    response = client.delete('/apps?ids=1,2&ids=3,42')
+    assert response.status_code == 200
+    assert response.get_json() == {'deleted': 3}
+    assert [app['app_id'] for app in db.get_all_apps()] == [4, 5]
+
+    assert client.delete('/apps').status_code == 422
+    assert client.delete('/apps?ids=1,x').status_code == 422
+    assert client.delete('/apps/1').status_code == 404
+    assert client.delete('/apps/4').status_code == 200
+
+    response = client.delete('/patients?ids=5')
+    assert response.get_json() == {'deleted': 1}
+    assert db.get_all_apps() == []
+
+
+def test_scheduled_at(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+
+    assert parse_time(1712000000) == parse_time('1712000000') == 1712000000
+    assert parse_time('2024-04-01') == 1711929600
+    assert parse_time('2024-04-01T09:00:00+09:00') == 1711929600
+    for value in ('April', '', True, 2 ** 63, float('nan')):
+        with pytest.raises(ValueError):
+            parse_time(value)
+
+    assert month_start('apr', 2024) == month_start('April', 2024) == \
+        1711929600
+    assert month_start('Someday') is None
+
+    app = db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                        'April', 'Headache', '2024-05-31T23:30:00')
+    assert app['month'] == 'May'
+    assert app['scheduled_at'] == parse_time('2024-05-31T23:30:00')
+
+    results = db.insert_apps_bulk([
+        {'FirstN': 'Danny', 'LastN': 'Park', 'gender': 'Male', 'age': 21,
+         'birth': '1999-04-22', 'doctor': 'Jill', 'month': 'June',
+         'symptom': 'Fever', 'scheduled_at': parse_time('2024-06-03')},
+        {'FirstN': 'Grace', 'LastN': 'Kim', 'gender': 'Female', 'age': 21,
+         'birth': '1999-01-02', 'doctor': 'Amy', 'month': 'June',
+         'symptom': 'Fever', 'scheduled_at': 'soon'},
+        {'FirstN': 'Grace', 'LastN': 'Kim', 'gender': 'Female', 'age': 21,
+         'birth': '1999-01-02', 'doctor': 'Amy', 'month': 'Jun',
+         'symptom': 'Fever'}])
+    assert [result.get('app_id') for result in results] == [2, None, 3]
+    # An appointment with only a month has no time.
+    assert db.get_app_by_id(3)['scheduled_at'] is None
+
+    june = parse_time('2024-06-01')
+    assert [app['app_id'] for app in db.get_apps_between(0, june)] == [1]
+    assert len(db.get_apps_between(MIN_TIME, MAX_TIME)) == 2
+    assert len(db.get_apps_page(10, filters={'from': MIN_TIME})) == 2
+    assert [app['app_id'] for app in
+            db.get_apps_between(june, june + 7 * 86400, 2)] == [2]
+    assert db.get_apps_between(june, june + 7 * 86400, 1) == []
+    assert db.get_app_counts_by_day(0, june + 86400 * 7) == [
+        {'day': parse_time('2024-05-31'), 'app_count': 1},
+        {'day': parse_time('2024-06-03'), 'app_count': 1}]
+
+    page = db.get_apps_page(10, sort='-scheduled_at',
+                            filters={'from': parse_time('2024-05-01'),
+                                     'to': june + 7 * 86400})
+    assert [app['app_id'] for app in page] == [2, 1]
+    assert [app['app_id'] for app in db.get_apps_page(
+        1, after_id=2, sort='-scheduled_at')] == [1]
+
+    # Appointments without a time sort first, and pages continue from
+    # them or to them.
+    def ids(sort, after):
+        return [app['app_id'] for app in db.get_apps_page(
+            10, sort=sort, after=after)]
+
+    assert ids('scheduled_at', None) == [3, 1, 2]
+    assert ids('scheduled_at', (None, 3)) == [1, 2]
+    assert ids('scheduled_at', (None, 2)) == [3, 1, 2]
+    assert ids('-scheduled_at', None) == [2, 1, 3]
+    assert ids('-scheduled_at', (parse_time('2024-05-31T23:30:00'), 1)) == \
+        [3]
+    assert ids('-scheduled_at', (None, 3)) == []
+    assert [app['app_id'] for app in db.get_apps_page(
+        10, after_id=3, sort='scheduled_at')] == [1, 2]
+
+
+def test_api_time_range(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    for day, hour in ((1, 10), (2, 10), (2, 12), (9, 10)):
+        db.insert_app('First{}'.format(day), 'Last{}'.format(day), 'Female',
+                      22, '1997-11-21', 'Amy', 'April', 'Headache',
+                      '2024-04-{:02d}T{}:00:00'.format(day, hour))
+
+    response = client.get('/apps?from=2024-04-02&to=2024-04-09')
+    assert [app['app_id'] for app in response.json] == [2, 3]
+    response = client.get('/apps?from={}&sort=-scheduled_at&limit=2'.format(
+        parse_time('2024-04-02')))
+    assert [app['app_id'] for app in response.json] == [4, 3]
+    assert client.get('/apps?to=tomorrow').status_code == 422
+
+    response = client.get('/app_days?from=2024-04-01&to=2024-04-08')
+    assert response.json == [
+        {'day': parse_time('2024-04-01'), 'app_count': 1},
+        {'day': parse_time('2024-04-02'), 'app_count': 2}]
+    assert client.get('/app_days?from=2024-04-01').status_code == 422
+
+    # An appointment with only a month is in no range of times, and sorts
+    # before the others.
+    db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                  'April', 'Headache')
+    response = client.get('/app_days?from=2024-04-01&to=2024-04-08')
+    assert response.json[0]['app_count'] == 1
+    response = client.get('/apps?from=2024-04-01')
+    assert len(response.json) == 4
+    response = client.get('/apps?sort=scheduled_at&limit=1')
+    assert [app['app_id'] for app in response.json] == [5]
+    link = response.headers['Link'][1:].split('>')[0]
+    assert 'after=%2C5' in link
+    assert [app['app_id'] for app in client.get(link).json] == [1]
+
+    form = {'FirstN': 'Danny', 'LastN': 'Park', 'gender': 'Male',
+            'age': 21, 'birth': '1999-04-22', 'doctor': 'Amy',
+            'symptom': 'Fever'}
+    assert client.post('/apps', data=form).status_code == 422
+    assert client.post('/apps', data=dict(
+        form, scheduled_at='x')).status_code == 422
+    response = client.post('/apps', data=dict(
+        form, scheduled_at='2024-04-02T11:00:00Z'))
+    assert response.json['month'] == 'April'
+
+    stats = client.get('/stats?by=doctor&from=2024-04-02&to=2024-04-03')
+    assert stats.json == [{'doctor': 'Amy', 'app_count': 3}]
+
+
+def test_slot_conflicts(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    nine = parse_time('2024-04-01T09:00:00')
+
+    def insert(name, doctor, start, end=None):
+        return db.insert_app(name, name, 'Female', 22, '1997-11-21', doctor,
+                             'April', 'Headache', start, end)
+
+    assert insert('A', 'Amy', nine)['ends_at'] == nine + APP_DURATION
+    insert('B', 'Amy', nine + 3600, nine + 5400)
+    # Another doctor, and appointments with only a month, take no slot.
+    insert('C', 'Jill', nine)
+    db.insert_app('D', 'D', 'Female', 22, '1997-11-21', 'Amy', 'April',
+                  'Headache')
+
+    for start, end in ((nine, None), (nine + 1200, nine + 1500),
+                       (nine - 600, nine + 60), (nine + 1799, nine + 3601),
+                       (nine + 4000, nine + 9000)):
+        with pytest.raises(AppointmentConflict):
+            insert('E', 'Amy', start, end)
+
+    # Back-to-back appointments don't overlap.
+    assert insert('E', 'Amy', nine + 1800)['app_id'] == 5
+    with pytest.raises(ValueError):
+        insert('F', 'Amy', nine + 9000, nine + 9000)
+    assert len(db.get_all_apps()) == 5
+
+    assert db.find_free_slot(1, nine) == nine + 5400
+    assert db.find_free_slot(1, nine - 3600) == nine - 3600
+    assert db.find_free_slot(1, nine - 3600, 3601) == nine + 5400
+    assert db.find_free_slot(1, nine, 60, nine + 5400) is None
+    assert db.find_free_slot(2, nine + 60) == nine + 1800
+
+    apps = [{'FirstN': 'G{}'.format(i), 'LastN': 'G{}'.format(i),
+             'gender': 'Male',
+             'age': 30, 'birth': '1994-01-01', 'doctor': 'Amy',
+             'month': 'April', 'symptom': 'Cold',
+             'scheduled_at': nine + 5400 + 900 * i, 'ends_at':
+                 nine + 5400 + 900 * i + 1200} for i in range(3)]
+    results = db.insert_apps_bulk(apps + [dict(apps[0], FirstN='H',
+                                               LastN='H')])
+    assert [result.get('app_id') for result in results] == [6, None, 7,
+                                                            None]
+    assert 'appointment 6' in results[1]['error']
+    assert 'appointment 6' in results[3]['error']
+
+    # A conflict raised in a writer process reaches its caller.
+    error = pickle.loads(pickle.dumps(AppointmentConflict(6)))
+    assert error.app_id == 6 and 'appointment 6' in str(error)
+
+
+def test_slot_endpoints(tmp_path):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    client = app_api.app.test_client()
+
+    form = {'FirstN': 'Mina', 'LastN': 'Lee', 'gender': 'Female',
+            'age': 22, 'birth': '1997-11-21', 'doctor': 'Amy',
+            'symptom': 'Headache', 'scheduled_at': '2024-04-01T09:00:00',
+            'ends_at': '2024-04-01T10:00:00'}
+    response = client.post('/apps', data=form)
+    assert response.json['ends_at'] == parse_time('2024-04-01T10:00:00')
+
+    response = client.post('/apps', data=dict(
+        form, scheduled_at='2024-04-01T09:30:00', ends_at=None))
+    assert response.status_code == 409
+    assert 'appointment 1' in response.json['error']
+    assert client.post('/apps', data=dict(
+        form, ends_at='2024-04-01T08:00:00')).status_code == 422
+
+    response = client.get('/doctors/1/free_slot?from=2024-04-01T08:30:00'
+                          '&duration=60')
+    assert response.json == {'doctor_id': 1,
+                             'scheduled_at': parse_time('2024-04-01T10:00'),
+                             'ends_at': parse_time('2024-04-01T11:00')}
+    response = client.get('/doctors/1/free_slot?from=2024-04-01T08:30:00'
+                          '&duration=30')
+    assert response.json['scheduled_at'] == parse_time('2024-04-01T08:30')
+    assert client.get('/doctors/1/free_slot?from=2024-04-01T09:00:00'
+                      '&to=2024-04-01T10:00:00').status_code == 404
+    assert client.get('/doctors/2/free_slot').status_code == 404
+
+    html = app_api_html.app.test_client()
+    app_api_html.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    page = html.post('/add', data={
+        'first_name': 'Danny', 'last_name': 'Park', 'gender': 'Male',
+        'age': '21', 'birth': '1999-04-22', 'doctor': 'Amy', 'month': '',
+        'symptom': 'Fever', 'scheduled_at': '2024-04-01T09:45'})
+    assert b'already has an appointment' in page.data
+    assert len(db.get_all_apps()) == 1
+
+
+def test_response_store(tmp_path):
+    path = str(tmp_path / 'responses.sqlite')
+    store = ResponseStore(path, max_bytes=1000)
+    # Every hit moves its entry to the front.
+    store.TOUCH_INTERVAL = 0
+
+    assert store.get('/apps', '1-1') is None
+    store.put('/apps', '1-1', b'[1]', 'application/json',
+              [('X-Next-After-Id', '1')])
+    assert store.get('/apps', '1-1') == (b'[1]', 'application/json',
+                                         [('X-Next-After-Id', '1')])
+    assert store.get('/apps', '1-2') is None
+
+    # A body for newer versions replaces the old one.
+    store.put('/apps', '1-2', b'[1, 2]', 'application/json')
+    assert store.get('/apps', '1-1') is None
+    assert store.stats()['size'] == 1 and store.stats()['bytes'] == 6
+
+    # Another process sees the same entries.
+    other = ResponseStore(path, max_bytes=1000)
+    assert other.get('/apps', '1-2') == (b'[1, 2]', 'application/json', [])
+
+    # Bodies over an eighth of max_bytes are not kept, and the least
+    # recently used are evicted past max_bytes.
+    store.put('/big', '1', b'x' * 126, 'text/plain')
+    assert store.get('/big', '1') is None
+    for i in range(20):
+        store.put('/page/{}'.format(i), '1', b'x' * 100, 'text/plain')
+        store.get('/apps', '1-2')
+
+    stats = store.stats()
+    assert stats['bytes'] <= 1000 and stats['errors'] == 0
+    assert store.get('/apps', '1-2') is not None
+    assert store.get('/page/19', '1') is not None
+    assert store.get('/page/0', '1') is None
+
+    store.clear()
+    assert store.stats()['bytes'] == 0
+    store.close()
+    other.close()
+
+
+def test_response_store_endpoints(tmp_path, monkeypatch):
+    db = AppointmentDatabase(build_db_path(tmp_path))
+    app_api.app.config['DATABASE'] = str(build_db_path(tmp_path))
+    default_file = app_api.app.config['RESPONSE_CACHE_FILE']
+    app_api.app.config['RESPONSE_CACHE_FILE'] = str(tmp_path / 'cache.sqlite')
+    client = app_api.app.test_client()
+
+    try:
+        db.insert_app('Mina', 'Lee', 'Female', 22, '1997-11-21', 'Amy',
+                      'April', 'Headache')
+        store = app_resources.get_response_store(app_api.app)
+
+        first = client.get('/stats?by=doctor')
+        assert store.stats()['size'] == 1
+        client.get('/doctors')
+        assert store.stats()['size'] == 1
+
+        # A restarted worker, with an empty in-memory cache, finds the
+        # body in the store.
+        app_api.response_cache.bodies.clear()
+        hits = store.stats()['hits']
+        second = client.get('/stats?by=doctor')
+        assert second.data == first.data
+        assert second.headers['ETag'] == first.headers['ETag']
+        assert store.stats()['hits'] == hits + 1
+
+        # Responses stored by code with another output format don't match.
+        app_api.response_cache.bodies.clear()
+        monkeypatch.setattr(app_responses, 'RESPONSE_FORMAT',
+                            app_responses.RESPONSE_FORMAT + 1)
+        assert client.get('/stats?by=doctor').data == first.data
+        assert store.stats()['hits'] == hits + 1
+        assert store.stats()['size'] == 2
+        monkeypatch.undo()
+
+        db.insert_app('Danny', 'Park', 'Male', 21, '1999-04-22', 'Amy',
+                      'May', 'Fever')
+        assert client.get('/stats?by=doctor').json == \
+            [{'doctor': 'Amy', 'app_count': 2}]
+        assert store.stats()['size'] == 2
+    finally:
+        app_api.app.config['RESPONSE_CACHE_FILE'] = default_file